@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project_common.settings')
 
 application = get_asgi_application()
+
+# Imported after the setup, the stream needs the models.
+from slogger.stream import with_child_state_stream
+
+application = with_child_state_stream(application)
@@ -87,6 +87,24 @@ if DEBUG and USE_VUE_FRONTEND:
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
+# Summaries not covered by the daily rollups are aggregated either in Python
+# ("python") or grouped by day in the database ("sql").
+SLOGGER_SUMMARY_BACKEND = 'python'
+
+# Changes of the child state are streamed to the subscribers of the same
+# process ("local"), or of all processes connected to the event_broker
+# command at SLOGGER_EVENTS_BROKER ("broker").
+SLOGGER_EVENTS_BACKEND = 'local'
+SLOGGER_EVENTS_BROKER = '127.0.0.1:8765'
+
+# Decimal places floats are rounded to in compact chart responses
+# (?format=compact).
+SLOGGER_COMPACT_PRECISION = 3
+
+# Name of a cache in CACHES shared by all processes, to keep the user
+# settings in besides the per-process cache. None to use only the latter.
+SLOGGER_SETTINGS_CACHE = None
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -2,3 +2,7 @@ from django.apps import AppConfig
 
 class SloggerConfig(AppConfig):
     name = 'slogger'
+
+    def ready(self):
+        # Connects the signal handlers publishing the child state.
+        from . import events
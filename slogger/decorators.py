@@ -1,23 +1,81 @@
-from django.shortcuts import get_object_or_404
 from django.core.exceptions import PermissionDenied
+from django.http import Http404
+from django.utils.http import http_date
+from django.views.decorators.http import condition
+from functools import wraps
 
 from . import models
+from . import helpers
+
+def check_child_access(user, child_id):
+    """
+    Raises Http404 if the child doesn't exist and PermissionDenied if the
+    user is neither a parent nor the creator of it.
+    """
+    if not child_id:
+        raise PermissionDenied("Invalid child requested")
+
+    if not user.is_authenticated or not models.has_child_access(user, child_id):
+        if not models.Child.objects.filter(id=child_id).exists():
+            raise Http404("No child matches the given query.")
+        raise PermissionDenied("Invalid child requested")
 
-def only_own_children(view):
-    def wrapper(request, *args, **kwargs):
-        child_id = kwargs.get('child_id')
 
-        if not child_id:
-            raise PermissionDenied("Invalid child requested")
+def authorize_child(request, child_id):
+    """
+    Checks the access of the request's user to the child like
+    check_child_access, but only once per request.
+    """
+    checked = request.__dict__.setdefault('_child_access', set())
+    if child_id not in checked:
+        check_child_access(request.user, child_id)
+        checked.add(child_id)
 
-        child = get_object_or_404(models.Child, id=child_id)
 
-        if not request.user.is_authenticated:
-            raise PermissionDenied("Invalid child requested")
+def get_child(request, child_id):
+    """
+    Returns the child after authorize_child, fetching it once per request.
+    """
+    authorize_child(request, child_id)
 
-        if (request.user not in child.parents.all()) and (request.user != child.created_by):
-            raise PermissionDenied("Invalid child requested")
+    children = request.__dict__.setdefault('_children', {})
+    if child_id not in children:
+        children[child_id] = models.Child.objects.get(id=child_id)
+    return children[child_id]
 
+
+def only_own_children(view):
+    def wrapper(request, *args, **kwargs):
+        authorize_child(request, kwargs.get('child_id'))
         return view(request, *args, **kwargs)
     
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+def child_data_etag(*extra):
+    """
+    Answers GET requests for a child's data whose If-None-Match header holds
+    the current ETag with 304 Not Modified, before the view computes
+    anything, see helpers.get_data_etag. The extra functions are called with
+    the request and their results are part of the ETag. If one of them
+    returns None, the response depends on more than the data and is always
+    computed.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            values = [ f(request) for f in extra ]
+            if any(v is None for v in values):
+                return view(request, *args, **kwargs)
+
+            etag, changed = helpers.get_data_etag(request, kwargs.get('child_id'), *values)
+            response = condition(etag_func=lambda *a, **kw: etag)(view)(request, *args, **kwargs)
+
+            if response.status_code in (200, 304):
+                response['Last-Modified'] = http_date(changed.timestamp())
+
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,248 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import signals
+from django.dispatch import receiver
+
+import asyncio
+import json
+import logging
+import socket
+import threading
+
+from . import models
+from .json import state_data
+
+logger = logging.getLogger(__name__)
+
+BROKER_RECONNECT_SECONDS = 1
+
+
+class Subscription:
+    """
+    The pending message of one subscriber. Every message holds the whole
+    state of a child, so a subscriber that is slower than the writes only
+    gets the latest one instead of a growing queue.
+    """
+    def __init__(self, child_id):
+        self.child_id = child_id
+        self.loop = asyncio.get_running_loop()
+        self.message = None
+        self.closed = False
+        self.ready = asyncio.Event()
+
+    def put(self, message):
+        self.message = message
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def get(self):
+        """
+        Waits for the next message and returns it, or None once closed.
+        """
+        await self.ready.wait()
+        self.ready.clear()
+        if self.closed:
+            return None
+        message, self.message = self.message, None
+        return message
+
+
+class LocalBackend:
+    """
+    Delivers the messages published in this process to the subscribers of
+    this process. Publishing is thread safe, the subscribers are woken up in
+    their event loop.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, child_id):
+        subscription = Subscription(child_id)
+        with self.lock:
+            self.subscribers.setdefault(child_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.child_id, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self.subscribers.pop(subscription.child_id, None)
+
+    def has_subscribers(self, child_id):
+        return child_id in self.subscribers
+
+    def deliver(self, child_id, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(child_id, ()))
+        for s in subscribers:
+            s.loop.call_soon_threadsafe(s.put, message)
+
+    def publish(self, child_id, message):
+        self.deliver(child_id, message)
+
+
+class BrokerBackend(LocalBackend):
+    """
+    Shares the messages of several processes through the event_broker
+    command. Messages are sent to the broker, which sends them back to every
+    process with subscribers, this one included. They are sent by a thread
+    of their own, so writes never wait for the broker; like a subscription,
+    it only keeps the latest message of a child it didn't get to yet.
+    Messages published while the broker is unreachable are lost; clients get
+    the current state again when they reconnect.
+    """
+    def __init__(self, address):
+        super().__init__()
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.publisher = None
+        self.pending = {}
+        self.pending_ready = threading.Condition()
+        self.sender = None
+        self.listeners = {}
+
+    def subscribe(self, child_id):
+        loop = asyncio.get_running_loop()
+        if loop not in self.listeners:
+            self.listeners[loop] = loop.create_task(self.listen())
+        return super().subscribe(child_id)
+
+    def has_subscribers(self, child_id):
+        # Other processes might have some.
+        return True
+
+    async def listen(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(*self.address)
+                writer.write(b"subscribe\n")
+                await writer.drain()
+                while line := await reader.readline():
+                    try:
+                        child_id, message = line.split(b" ", 1)
+                        child_id = int(child_id)
+                    except ValueError:
+                        logger.warning("Bad line from the event broker: %r", line[:100])
+                        continue
+                    self.deliver(child_id, message.rstrip(b"\n"))
+                writer.close()
+            except OSError as e:
+                logger.warning("Event broker at %s:%s unreachable: %s", *self.address, e)
+            await asyncio.sleep(BROKER_RECONNECT_SECONDS)
+
+    def publish(self, child_id, message):
+        with self.pending_ready:
+            if self.sender is None:
+                self.sender = threading.Thread(target=self.send_pending, name="event-publisher", daemon=True)
+                self.sender.start()
+            self.pending[child_id] = message
+            self.pending_ready.notify()
+
+    def send_pending(self):
+        while True:
+            with self.pending_ready:
+                while not self.pending:
+                    self.pending_ready.wait()
+                pending, self.pending = self.pending, {}
+
+            for child_id, message in pending.items():
+                self.send(child_id, message)
+
+    def send(self, child_id, message):
+        line = b"%d %s\n" % (child_id, message)
+        for attempt in range(2):
+            try:
+                if self.publisher is None:
+                    self.publisher = socket.create_connection(self.address, timeout=BROKER_RECONNECT_SECONDS)
+                    self.publisher.sendall(b"publish\n")
+                self.publisher.sendall(line)
+                return
+            except OSError as e:
+                if self.publisher is not None:
+                    self.publisher.close()
+                    self.publisher = None
+                error = e
+        logger.warning("Event for child %s not published: %s", child_id, error)
+
+
+async def run_broker(host, port):
+    """
+    Serves the BrokerBackend of all processes: every line a publishing
+    connection sends goes to all subscribing connections.
+    """
+    subscribers = set()
+
+    async def handle(reader, writer):
+        try:
+            role = await reader.readline()
+            if role == b"subscribe\n":
+                subscribers.add(writer)
+                await reader.read()
+            elif role == b"publish\n":
+                while line := await reader.readline():
+                    for w in list(subscribers):
+                        w.write(line)
+        except OSError:
+            pass
+        finally:
+            subscribers.discard(writer)
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+_backend = None
+
+def get_backend():
+    """
+    Returns the backend chosen by settings.SLOGGER_EVENTS_BACKEND, "local"
+    or "broker".
+    """
+    global _backend
+
+    if _backend is None:
+        if settings.SLOGGER_EVENTS_BACKEND == "broker":
+            _backend = BrokerBackend(settings.SLOGGER_EVENTS_BROKER)
+        else:
+            _backend = LocalBackend()
+
+    return _backend
+
+
+def encode_state(state):
+    return json.dumps(state_data(*state.latest_rows()), cls=DjangoJSONEncoder).encode()
+
+
+def publish_child_state(child_id):
+    """
+    Sends the current state of a child to its subscribers, if there are any.
+    """
+    backend = get_backend()
+    if not backend.has_subscribers(child_id):
+        return
+
+    state = models.ChildState.objects.filter(child=child_id).first()
+    if state:
+        backend.publish(child_id, encode_state(state))
+
+
+@receiver(signals.post_save, sender=models.SleepPhase)
+@receiver(signals.post_save, sender=models.Meal)
+@receiver(signals.post_save, sender=models.Diaper)
+@receiver(signals.post_delete, sender=models.SleepPhase)
+@receiver(signals.post_delete, sender=models.Meal)
+@receiver(signals.post_delete, sender=models.Diaper)
+def publish_child_state_on_change(sender, instance, **kwargs):
+    child_id = instance.child_id
+    if models.child_deleted(child_id):
+        return
+
+    transaction.on_commit(lambda: publish_child_state(child_id))
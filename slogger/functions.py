@@ -1,41 +1,70 @@
 from datetime import datetime, timedelta, time
 from django.utils import timezone as tz
 from datetime import time, date
-
-def merge_totals(totals, *args):
-    for arg in args:
-        totals.extend(arg)
-    totals.sort(key=lambda k: k[0])
-
-    i = 0
-    while i < len(totals):
-        if i < len(totals)-1 and totals[i][0] == totals[i+1][0]:
-            totals[i] = list(totals[i])
-            totals[i][1] = { **totals[i][1], **totals[i+1][1] }
-            totals.pop(i+1)
+from itertools import accumulate, groupby
+from operator import itemgetter
+from bisect import bisect_left, bisect_right
+from array import array
+from statistics import NormalDist
+import heapq
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def merge_totals(*series, reverse=False):
+    """
+    Lazily merges lists of (day, data) tuples, each already ordered by day,
+    into one (day, data) tuple per day. The data dicts of a day are combined,
+    later series take precedence on duplicate keys. Pass reverse=True if the
+    series are ordered by descending day.
+    """
+    merged = heapq.merge(*series, key=itemgetter(0), reverse=reverse)
+
+    for day, entries in groupby(merged, key=itemgetter(0)):
+        data = {}
+        for entry in entries:
+            data.update(entry[1])
+        yield day, data
+
+def as_intervals(data):
+    """
+    Yields (dt, dt_end) tuples for model instances or for rows as returned by
+    values_list("dt", "dt_end") or values_list("dt"). dt_end is None for
+    records without one.
+    """
+    for d in data:
+        if type(d) is tuple:
+            yield d if len(d) == 2 else (d[0], None)
         else:
-            i += 1
-
-    return totals
-
-def convert_to_totals(data, dict_key, *attributes):
+            yield d.dt, getattr(d, 'dt_end', None)
+
+def convert_to_totals(data, dict_key, *attributes, boundaries=None):
+    """
+    Groups records by local day. data may hold model instances or rows as
+    returned by values_list("dt", *attributes).
+    """
+    days = boundaries or DayBoundaries()
     totals = {}
 
     for d in data:
-        my_dt = tz.localtime(d.dt)
-        main_key = str(my_dt.date())
-
-        if not totals.get(main_key):
-            totals[main_key] = { dict_key: [] }
+        if type(d) is tuple:
+            dt, values = d[0], d[1:]
+        else:
+            dt, values = d.dt, [ getattr(d, a) for a in attributes ]
 
-        entry = {}
+        day = days.ordinal(dt)
 
-        for a in attributes:
-            entry[a] = getattr(d, a)
+        try:
+            entries = totals[day]
+        except KeyError:
+            entries = totals[day] = []
 
-        totals[main_key][dict_key].append(entry)
+        entries.append(dict(zip(attributes, values)))
 
-    return sorted(totals.items(), key=lambda kv: date.fromisoformat(kv[0]))
+    return [ (str(date.fromordinal(day)), { dict_key: totals[day] }) for day in sorted(totals) ]
 
 def calculate_average(totals, key):
     total_sleep = 0
@@ -56,144 +85,772 @@ def calculate_average(totals, key):
     except ZeroDivisionError:
         return 0
 
-def calculate_totals(data, dict_key, h_day=8, h_night=19):
-    totals = {}
-
-    carried_secs = {
-        'sum' : 0,
-        'daynight' : 0,
-    }
-
-    last_d = None
-    for d in data:
-        my_dt = tz.localtime(d.dt)
-        main_key = str(my_dt.date())
-
-        if not totals.get(main_key):
-            totals[main_key] = {
-            }
-
-        if not totals[main_key].get(dict_key):
-            totals[main_key][dict_key] = {
-                'sum':   { "count": 0, "time": 0, 'interval': 0 },
-                'day':   { "count": 0, "time": 0, 'interval': 0 },
-                'night': { "count": 0, "time": 0, 'interval': 0 },
-            }
-
-        interval_secs = 0
-        totals[main_key][dict_key]['sum']['count'] += 1
-
-        key = 'night'
-        if  my_dt.time() >= time(hour=h_day) and my_dt.time() <= time(hour=h_night):
-            key = 'day'
-
+class RollingStats:
+    """
+    Prefix sums over a daily series, answering the mean, min and max of any
+    range of days [lo, hi) in O(1). None values are skipped. The sparse
+    tables for min/max are only built when first needed.
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.sums = [0] + list(accumulate(v or 0 for v in values))
+        self.counts = [0] + list(accumulate(v is not None for v in values))
+        self._mins = None
+        self._maxs = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def _sparse_table(self, func, missing):
+        table = [ [missing if v is None else v for v in self.values] ]
+
+        width = 1
+        while width * 2 <= len(self.values):
+            prev = table[-1]
+            table.append([ func(prev[i], prev[i + width]) for i in range(len(prev) - width) ])
+            width *= 2
+
+        return table
+
+    def _range(self, table, func, lo, hi, missing):
+        if hi <= lo:
+            return None
+
+        k = (hi - lo).bit_length() - 1
+        v = func(table[k][lo], table[k][hi - (1 << k)])
+        return None if v == missing else v
+
+    def mean(self, lo=0, hi=None):
+        hi = len(self) if hi is None else hi
+        count = self.counts[hi] - self.counts[lo]
+        if not count:
+            return None
+        return (self.sums[hi] - self.sums[lo]) / count
+
+    def min(self, lo=0, hi=None):
+        if self._mins is None:
+            self._mins = self._sparse_table(min, float('inf'))
+        return self._range(self._mins, min, lo, len(self) if hi is None else hi, float('inf'))
+
+    def max(self, lo=0, hi=None):
+        if self._maxs is None:
+            self._maxs = self._sparse_table(max, float('-inf'))
+        return self._range(self._maxs, max, lo, len(self) if hi is None else hi, float('-inf'))
+
+    def rolling(self, starts):
+        """
+        Returns mean, min and max of the ranges ending with each day, with
+        starts holding the index of the first day of each range.
+        """
+        ranges = [ (lo, hi + 1) for hi, lo in enumerate(starts) ]
+        return {
+            'mean': [ self.mean(lo, hi) for lo, hi in ranges ],
+            'min': [ self.min(lo, hi) for lo, hi in ranges ],
+            'max': [ self.max(lo, hi) for lo, hi in ranges ],
+        }
+
+def window_starts(days, window):
+    """
+    For each of the ascending ISO dates in days, returns the index of the
+    first one within the `window` calendar days ending with it.
+    """
+    ordinals = [ date.fromisoformat(d).toordinal() for d in days ]
+
+    starts = []
+    lo = 0
+    for o in ordinals:
+        while ordinals[lo] <= o - window:
+            lo += 1
+        starts.append(lo)
+
+    return starts
+
+def daily_series(totals, dict_key, category, *keys, missing=None):
+    """
+    Extracts one list per key from merged totals in a single pass. Days
+    without data for dict_key get the missing value.
+    """
+    series = tuple([] for k in keys)
+
+    for day, data in totals:
         try:
-            d_today = d.duration_sec_day()
-            d_tomorrow = d.duration_sec_day(tomorrow=True)
-
-            totals[main_key][dict_key]['sum']['time'] += d_today
-            totals[main_key][dict_key]['sum']['time'] += carried_secs['sum']
-            totals[main_key][dict_key][key]['time'] += d_today
-            totals[main_key][dict_key][key]['time'] += carried_secs['daynight']
-
-            carried_secs['sum'] = d_tomorrow
-            carried_secs['daynight'] = d_tomorrow
-        except AttributeError:
-            pass
-
-        if last_d:
-            try:
-                interval_secs = (d.dt-last_d.dt_end).total_seconds()
-            except (AttributeError, TypeError):
-                interval_secs = (d.dt-last_d.dt).total_seconds()
-            if interval_secs < 0:
-                interval_secs = 0
-            totals[main_key][dict_key]['sum']['interval'] += interval_secs
-
-        totals[main_key][dict_key][key]['interval'] += interval_secs
-        totals[main_key][dict_key][key]['count'] += 1
-
-        last_d = d
-
-    return sorted(totals.items(), key=lambda kv: date.fromisoformat(kv[0]))
-
-def calculate_duration_totals(data, h_day=8, h_night=19):
-    totals = {}
+            values = data[dict_key][category]
+        except KeyError:
+            for s in series:
+                s.append(missing)
+            continue
 
-    carried_secs = {
-        'sum' : 0,
-        'daynight' : 0,
-    }
+        for s, k in zip(series, keys):
+            s.append(values[k])
+
+    return series
+
+class DailyTotals:
+    """
+    Per-day accumulators for a series of (dt, dt_end) intervals. Every metric
+    is kept in a flat column (one list per sum/day/night category), indexed by
+    the local day's ordinal relative to the first day seen.
+    """
+
+    CATEGORIES = ('sum', 'day', 'night')
+
+    def __init__(self):
+        self.base = None
+        self.present = []
+        self.count = ([], [], [])
+        self.time = ([], [], [])
+        self.interval = ([], [], [])
+
+    def _columns(self):
+        yield self.present
+        yield from self.count
+        yield from self.time
+        yield from self.interval
+
+    def index(self, ordinal):
+        if self.base is None:
+            self.base = ordinal
+
+        i = ordinal - self.base
+
+        if i < 0:
+            for col in self._columns():
+                col[0:0] = [0] * -i
+            self.base = ordinal
+            i = 0
+        elif i >= len(self.present):
+            grow = i - len(self.present) + 1
+            for col in self._columns():
+                col.extend([0] * grow)
+
+        return i
+
+    def days(self):
+        for i, present in enumerate(self.present):
+            if present:
+                yield i, date.fromordinal(self.base + i)
+
+    def totals(self, dict_key):
+        return [
+            (str(day), { dict_key: {
+                c: {
+                    'count': self.count[k][i],
+                    'time': self.time[k][i],
+                    'interval': self.interval[k][i],
+                } for k, c in enumerate(self.CATEGORIES)
+            }}) for i, day in self.days()
+        ]
+
+    def duration_totals(self):
+        return [
+            (str(day), {
+                c: {
+                    'time': self.time[k][i],
+                    'count': self.count[k][i],
+                } for k, c in enumerate(self.CATEGORIES)
+            }) for i, day in self.days()
+        ]
+
+
+class DayBoundaries:
+    """
+    Local midnights and day/night start times (as UTC datetimes) for a range
+    of days. The range grows as needed, so mapping a datetime to its local
+    day or splitting an interval at midnight takes a bisect instead of a
+    timezone conversion per record.
+    """
+
+    def __init__(self, h_day=8, h_night=19, first_day=None, last_day=None):
+        self.h_day = h_day
+        self.h_night = h_night
+
+        self.first = None
+        self.last = None
+        self.midnights = []
+        self.day_starts = []
+        self.night_starts = []
+
+        if first_day and last_day:
+            self._add_days(first_day.toordinal(), last_day.toordinal())
+
+    def _local(self, ordinal, hour=0):
+        # Like comparing the local time of day, an hour that comes twice
+        # starts with its first occurrence, one that is skipped when it would
+        # have started.
+        d = date.fromordinal(ordinal)
+        naive = datetime(d.year, d.month, d.day, hour)
+        first = tz.make_aware(naive, is_dst=True)
+        if tz.make_naive(first) != naive:
+            first = tz.make_aware(naive, is_dst=False)
+        return first.astimezone(tz.utc)
+
+    def _add_days(self, first, last):
+        one_day = timedelta(days=1)
+
+        # Localizing is expensive, so the next midnight is assumed to be 24h
+        # later unless that turns out wrong on days the UTC offset changes.
+        midnights = [ self._local(first) ]
+        for o in range(first + 1, last + 2):
+            m = midnights[-1] + one_day
+            if tz.localtime(m).hour != 0:
+                m = self._local(o)
+            midnights.append(m)
+
+        day_starts = []
+        night_starts = []
+        for k, o in enumerate(range(first, last + 1)):
+            if midnights[k+1] - midnights[k] == one_day:
+                day_starts.append(midnights[k] + timedelta(hours=self.h_day))
+                night_starts.append(midnights[k] + timedelta(hours=self.h_night))
+            else:
+                day_starts.append(self._local(o, self.h_day))
+                night_starts.append(self._local(o, self.h_night))
+
+        if self.first is None:
+            self.first, self.last = first, last
+            self.midnights[:] = midnights
+            self.day_starts[:] = day_starts
+            self.night_starts[:] = night_starts
+        elif first < self.first:
+            self.first = first
+            self.midnights[0:1] = midnights
+            self.day_starts[0:0] = day_starts
+            self.night_starts[0:0] = night_starts
+        else:
+            self.last = last
+            self.midnights[-1:] = midnights
+            self.day_starts.extend(day_starts)
+            self.night_starts.extend(night_starts)
+
+    def index(self, dt):
+        """
+        Returns the index of the local day dt lies in. Indexes stay valid
+        unless days before the first one are added.
+        """
+        m = self.midnights
+
+        if not m:
+            ordinal = tz.localdate(dt).toordinal()
+            self._add_days(ordinal, ordinal)
+        elif dt < m[0]:
+            self._add_days(tz.localdate(dt).toordinal(), self.first - 1)
+        elif dt >= m[-1]:
+            self._add_days(self.last + 1, self.last + 1 + (dt - m[-1]).days)
+            while dt >= m[-1]:
+                self._add_days(self.last + 1, self.last + 1)
+
+        return bisect_right(m, dt) - 1
+
+    def ordinal(self, dt):
+        i = self.index(dt)
+        return self.first + i
+
+    def is_day(self, i, dt):
+        return self.day_starts[i] <= dt <= self.night_starts[i]
+
+    def is_regular(self, i):
+        return self.midnights[i+1] - self.midnights[i] == timedelta(days=1)
+
+    def split(self, dt, dt_end):
+        """
+        Splits [dt, dt_end] at local midnight and yields the ordinal of every
+        day it covers along with the number of seconds on that day.
+        """
+        if dt_end <= dt:
+            yield self.ordinal(dt), (dt_end - dt).total_seconds()
+            return
+
+        self.index(dt_end)
+        i = self.index(dt)
+        m = self.midnights
+
+        # Intervals ending at midnight don't cover the following day.
+        j = bisect_left(m, dt_end) - 1
+
+        if j == i:
+            yield self.first + i, (dt_end - dt).total_seconds()
+            return
+
+        yield self.first + i, (m[i+1] - dt).total_seconds()
+        for k in range(i+1, j):
+            yield self.first + k, (m[k+1] - m[k]).total_seconds()
+        yield self.first + j, (dt_end - m[j]).total_seconds()
+
+
+def day_boundaries(h_day=None, h_night=None, boundaries=None):
+    """
+    Returns boundaries, or new DayBoundaries for the given hours (the default
+    ones if None). Raises ValueError if both are given, as the hours of the
+    boundaries would silently win.
+    """
+    if boundaries is None:
+        hours = { 'h_day': h_day, 'h_night': h_night }
+        return DayBoundaries(**{ k: h for k, h in hours.items() if h is not None })
+
+    if h_day is not None or h_night is not None:
+        raise ValueError("Either the hours or boundaries can be given, not both.")
+
+    return boundaries
+
+
+def aggregate_daily(intervals, h_day=None, h_night=None, boundaries=None):
+    """
+    Single pass over (dt, dt_end) tuples, which are expected to be ordered by
+    dt. Durations are split at local midnight between all days they cover,
+    the parts after midnight are accounted to the category of the phase they
+    belong to. dt_end may be None for open phases or events without a
+    duration. Pass boundaries instead of the hours to share them between
+    several series.
+    """
+    acc = DailyTotals()
+    days = day_boundaries(h_day, h_night, boundaries)
+
+    present = acc.present
+    count_sum, count_day, count_night = acc.count
+    time_sum, time_day, time_night = acc.time
+    interval_sum, interval_day, interval_night = acc.interval
+
+    midnights = days.midnights
+    day_starts = days.day_starts
+    night_starts = days.night_starts
+
+    last_end = None
+
+    for dt, dt_end in intervals:
+        d = days.index(dt)
+        i = acc.index(days.first + d)
+
+        if day_starts[d] <= dt <= night_starts[d]:
+            count_key, time_key, interval_key = count_day, time_day, interval_day
+        else:
+            count_key, time_key, interval_key = count_night, time_night, interval_night
+
+        present[i] = 1
+        count_sum[i] += 1
+        count_key[i] += 1
+
+        if dt_end:
+            if dt_end > midnights[d+1]:
+                for ordinal, secs in days.split(dt, dt_end):
+                    j = acc.index(ordinal)
+                    present[j] = 1
+                    time_sum[j] += secs
+                    time_key[j] += secs
+            else:
+                secs = (dt_end - dt).total_seconds()
+                time_sum[i] += secs
+                time_key[i] += secs
 
-    for d in data:
-        my_dt = tz.localtime(d.dt)
-        main_key = str(my_dt.date())
-        if not totals.get(main_key):
-            totals[main_key] = {
-                'sum':   {'time': 0, 'count': 0},
-                'day':   {'time': 0, 'count': 0},
-                'night': {'time': 0, 'count': 0},
-            }
+        if last_end is not None:
+            secs = (dt - last_end).total_seconds()
+            if secs < 0:
+                secs = 0.0
+            interval_sum[i] += secs
+            interval_key[i] += secs
 
-        totals[main_key]['sum']['time'] += carried_secs['sum']
-        totals[main_key]['sum']['time'] += d.duration_sec_day()
-        totals[main_key]['sum']['count'] += 1
+        last_end = dt_end if dt_end else dt
 
-        carried_secs['sum'] = d.duration_sec_day(tomorrow=True)
+    return acc
 
-        key = 'night'
-        if  my_dt.time() >= time(hour=h_day) and my_dt.time() <= time(hour=h_night):
-            key = 'day'
+def calculate_totals(data, dict_key, h_day=None, h_night=None, boundaries=None):
+    return aggregate_daily(as_intervals(data), h_day, h_night, boundaries).totals(dict_key)
 
-        totals[main_key][key]['time'] += carried_secs['daynight']
-        totals[main_key][key]['time'] += d.duration_sec_day()
-        totals[main_key][key]['count'] += 1
+def calculate_duration_totals(data, h_day=None, h_night=None, boundaries=None):
+    return aggregate_daily(as_intervals(data), h_day, h_night, boundaries).duration_totals()
 
-        carried_secs['daynight'] = d.duration_sec_day(tomorrow=True)
+def _next_offset_change(dt, dt_end, offset):
+    lo, hi = dt, dt_end
 
-    return sorted(totals.items(), key=lambda kv: date.fromisoformat(kv[0]))
+    while hi - lo > timedelta(seconds=1):
+        mid = lo + (hi - lo) / 2
+        if tz.localtime(mid).utcoffset() == offset:
+            lo = mid
+        else:
+            hi = mid
+
+    # Offset changes happen on full seconds.
+    return lo.replace(microsecond=0) + timedelta(seconds=1)
+
+def local_segments(dt, dt_end):
+    """
+    Splits [dt, dt_end] into parts with a constant UTC offset and yields them
+    as pairs of naive local (wall clock) datetimes. All but the last part
+    exclude their end.
+    """
+    start = tz.localtime(dt)
+    end = tz.localtime(dt_end)
+
+    while start.utcoffset() != end.utcoffset():
+        change = _next_offset_change(dt, dt_end, start.utcoffset())
+        yield start.replace(tzinfo=None), tz.localtime(change - timedelta(microseconds=1)).replace(tzinfo=None)
+        dt = change
+        start = tz.localtime(dt)
+
+    yield start.replace(tzinfo=None), end.replace(tzinfo=None)
+
+def _accumulate_ranges(ranges, slots, base=0):
+    if np is not None and ranges:
+        r = np.array(ranges, dtype=np.int64)
+        diff = np.zeros(slots + 1, dtype=np.int64)
+        np.add.at(diff, r[:, 0], 1)
+        np.add.at(diff, r[:, 1] + 1, -1)
+        return (np.cumsum(diff[:-1]) + base).tolist()
+
+    diff = [0] * (slots + 1)
+    for first, last in ranges:
+        diff[first] += 1
+        diff[last + 1] -= 1
+
+    return [c + base for c in accumulate(diff[:-1])]
 
 def get_hist_data(data, raster, resolution):
-    hist_data = {}
-    my_delta = timedelta(minutes=raster)
+    """
+    Counts how often each raster point of the day (every `raster` minutes,
+    starting at local midnight) lies within one of the (dt, dt_end) intervals
+    of data. Entries without an end count once in the slot they start in.
+    The result is returned in buckets of `resolution` minutes: coarser buckets
+    sum up the raster slots they contain, finer buckets repeat the value of
+    the raster slot they are part of.
+    """
+    if raster < 1 or resolution < 1:
+        raise ValueError("Histogram raster and resolution must be >= 1 minute.")
+
+    slots = -(-24*60 // raster)
+    step = timedelta(minutes=raster)
+    minute = timedelta(minutes=1)
+    midnight = time()
+    days = DayBoundaries()
+    m = days.midnights
+
+    ranges = []
+    full_days = 0
+
+    def add_range(lo, hi, nr_days):
+        nonlocal full_days
+
+        first = -(-lo // step)
+        last = min(hi // step, slots-1)
+
+        if nr_days == 0:
+            if first <= last:
+                ranges.append((first, last))
+        else:
+            if first < slots:
+                ranges.append((first, slots-1))
+            ranges.append((0, last))
+            full_days += nr_days - 1
+
+    for dt, dt_end in as_intervals(data):
+        i = days.index(dt)
 
-    hist_start = tz.make_aware(tz.datetime(2000, 1, 1))
-    hist_end = hist_start + timedelta(days=1)
+        if not dt_end:
+            if days.is_regular(i):
+                slot = ((dt - m[i]) // minute) // raster
+            else:
+                start = tz.localtime(dt)
+                slot = (start.hour*60 + start.minute) // raster
+            ranges.append((slot, slot))
+            continue
 
-    while hist_start <= hist_end:
-        time_str = tz.localtime(hist_start).time().strftime("%H:%M")
-        hist_data[time_str] = 0
-        hist_start += my_delta
+        # Ends before it starts, so it covers no raster point.
+        if dt_end < dt:
+            continue
 
-    for d in data:
-        s = d.dt.replace(second=0, microsecond=0)
+        j = days.index(dt_end)
+        i = days.index(dt)
 
-        while (s.minute % raster) != 0:
-            s -= timedelta(minutes=1)
+        # Wall clock time equals the time elapsed since midnight, unless the
+        # UTC offset changes on one of the days.
+        if all(days.is_regular(k) for k in range(i, j+1)):
+            add_range(dt - m[i], dt_end - m[j], j - i)
+            continue
 
-        try:
-            e = d.dt_end.replace(second=0, microsecond=0)
-        except AttributeError:
-            # We have no end date. Just increase a single time and go on.
-            k = tz.localtime(s).time().strftime("%H:%M")
-            if not hist_data.get(k):
-                hist_data[k] = 1
+        for start, end in local_segments(dt, dt_end):
+            add_range(start - datetime.combine(start.date(), midnight),
+                      end - datetime.combine(end.date(), midnight),
+                      (end.date() - start.date()).days)
+
+    counts = _accumulate_ranges(ranges, slots, full_days)
+
+    buckets = -(-24*60 // resolution)
+    if resolution >= raster:
+        hist = [0] * buckets
+        for k, c in enumerate(counts):
+            hist[(k*raster) // resolution] += c
+    else:
+        hist = [counts[(j*resolution) // raster] for j in range(buckets)]
+
+    return [
+        (f"{(j*resolution)//60:02d}:{(j*resolution)%60:02d}", c) for j, c in enumerate(hist)
+    ]
+
+def day_slot_ranges(data, raster):
+    """
+    Returns (ordinal, first, last) for every local day one of the (dt,
+    dt_end) intervals of data covers: the ordinal of the day and the first
+    and last raster point of it within the interval, counted like
+    get_hist_data() does. Entries without an end cover the slot they start
+    in.
+    """
+    if raster < 1:
+        raise ValueError("Heatmap raster must be >= 1 minute.")
+
+    slots = -(-24*60 // raster)
+    step = timedelta(minutes=raster)
+    minute = timedelta(minutes=1)
+    midnight = time()
+    days = DayBoundaries()
+    m = days.midnights
+
+    ranges = []
+
+    def add_range(ordinal, lo, hi, nr_days):
+        first = -(-lo // step)
+        last = min(hi // step, slots-1)
+
+        if nr_days == 0:
+            if first <= last:
+                ranges.append((ordinal, first, last))
+        else:
+            if first < slots:
+                ranges.append((ordinal, first, slots-1))
+            for o in range(ordinal + 1, ordinal + nr_days):
+                ranges.append((o, 0, slots-1))
+            ranges.append((ordinal + nr_days, 0, last))
+
+    for dt, dt_end in as_intervals(data):
+        i = days.index(dt)
+
+        if not dt_end:
+            if days.is_regular(i):
+                slot = ((dt - m[i]) // minute) // raster
             else:
-                hist_data[k] += 1
+                start = tz.localtime(dt)
+                slot = (start.hour*60 + start.minute) // raster
+            ranges.append((days.first + i, slot, slot))
             continue
 
-        while (e.minute % raster) != 0:
-            e += timedelta(minutes=1)
-
-        while s <= e:
-            time_str = tz.localtime(s).time().strftime("%H:%M")
+        if dt_end < dt:
+            continue
 
-            if not hist_data.get(time_str):
-                hist_data[time_str] = 0
+        j = days.index(dt_end)
 
-            if d.time_in_range(s):
-                hist_data[time_str] += 1
+        if all(days.is_regular(k) for k in range(i, j+1)):
+            add_range(days.first + i, dt - m[i], dt_end - m[j], j - i)
+            continue
 
-            s += my_delta
-    
-    return sorted(hist_data.items(), key=lambda kv: time.fromisoformat(kv[0]))
+        for start, end in local_segments(dt, dt_end):
+            add_range(start.toordinal(),
+                      start - datetime.combine(start.date(), midnight),
+                      end - datetime.combine(end.date(), midnight),
+                      (end.date() - start.date()).days)
+
+    return ranges
+
+def get_heatmap_data(ranges, raster, first, last, weekdays=False):
+    """
+    Counts the day_slot_ranges() of the days first to last (ordinals) into
+    a matrix with one row per day, or per weekday (Monday first) with
+    weekdays=True, and one column per raster slot. All ranges are summed up
+    in a single pass over one flat array.
+    """
+    slots = -(-24*60 // raster)
+    width = slots + 1
+
+    if weekdays:
+        # date.fromordinal(1) is a Monday.
+        rows = 7
+        row = lambda o: (o - 1) % 7
+    else:
+        rows = last - first + 1
+        row = lambda o: o - first
+
+    flat = [
+        (row(o)*width + lo, row(o)*width + hi)
+        for o, lo, hi in ranges if first <= o <= last
+    ]
+    counts = _accumulate_ranges(flat, rows*width)
+
+    return [ counts[r*width:r*width + slots] for r in range(rows) ]
+
+def downsample(xs, real, points=None, resolution=None):
+    """
+    Returns the ascending indices of the rows to keep of a chart series with
+    the (ascending, integer) x values xs. Rows with real data are always
+    kept, even if there are more than points of them. The other rows are
+    sampled every resolution x units, or evenly to fill up points. Without
+    points and resolution all rows are kept.
+    """
+    n = len(xs)
+    if not n or (not points and not resolution):
+        return list(range(n))
+
+    keep = { i for i in range(n) if real[i] }
+
+    step = resolution
+    if not step:
+        step = math.ceil((xs[-1] - xs[0] + 1) / max(points - len(keep), 1))
+    step = max(step, 1)
+
+    keep.update(i for i in range(n) if not real[i] and (xs[i] - xs[0]) % step == 0)
+    keep.add(n - 1)
+
+    return sorted(keep)
+
+class PercentileCurves:
+    """
+    Packed percentile curves of one gender and measurement type: one array of
+    floats per column, indexed by the age in days. Built from (day, p01, ...,
+    p999) rows ordered by day, later rows of the same day replace earlier
+    ones. Days missing in between are interpolated linearly.
+    """
+    COLUMNS = ("p01", "p1", "p3", "p5", "p10", "p15", "p25", "p50", "p75", "p85", "p90", "p95", "p97", "p99", "p999")
+    RANKS = (0.1, 1, 3, 5, 10, 15, 25, 50, 75, 85, 90, 95, 97, 99, 99.9)
+    Z = tuple(NormalDist().inv_cdf(r/100) for r in RANKS)
+
+    def __init__(self, rows):
+        known = {}
+        for day, *values in rows:
+            known[day] = values
+
+        days = sorted(known)
+        size = days[-1] + 1 if days else 0
+        self.columns = { c: array('d', [0.0]) * size for c in self.COLUMNS }
+
+        columns = [ self.columns[c] for c in self.COLUMNS ]
+        for a, b in zip(days, days[1:] + days[-1:]):
+            for col, va, vb in zip(columns, known[a], known[b]):
+                col[a] = va
+                for day in range(a+1, b):
+                    col[day] = va + (vb - va) * (day - a) / (b - a)
+
+        # The curves start at birth, fill a missing start with the first day.
+        for day in range(days[0] if days else 0):
+            for col, v in zip(columns, known[days[0]]):
+                col[day] = v
+
+    def __len__(self):
+        return len(self.columns[self.COLUMNS[0]])
+
+    def value(self, column, day):
+        """
+        Returns the value of a column at an age in days, which may be
+        fractional, or None beyond the available days.
+        """
+        col = self.columns[column]
+        if day < 0 or day > len(col) - 1:
+            return None
+
+        i = int(day)
+        if i == day:
+            return col[i]
+        return col[i] + (col[i+1] - col[i]) * (day - i)
+
+    def zscore(self, day, value):
+        """
+        Returns the z-score of a measurement, interpolated between the two
+        neighbouring percentiles in normal quantile space, or None beyond the
+        available days.
+        """
+        if value is None or self.value(self.COLUMNS[0], day) is None:
+            return None
+
+        values = [ self.value(c, day) for c in self.COLUMNS ]
+        i = min(max(bisect_right(values, value), 1), len(values) - 1)
+
+        va, vb = values[i-1], values[i]
+        za, zb = self.Z[i-1], self.Z[i]
+        if vb == va:
+            return za
+        return za + (value - va) * (zb - za) / (vb - va)
+
+    def rank(self, day, value):
+        """
+        Returns the percentile rank (0-100) of a measurement, or None.
+        """
+        z = self.zscore(day, value)
+        if z is None:
+            return None
+        return 50 * (1 + math.erf(z / math.sqrt(2)))
+
+
+def run_lengths(values):
+    """
+    Returns the distinct consecutive values and how often each is repeated.
+    """
+    runs, counts = [], []
+
+    for v in values:
+        if counts and runs[-1] == v:
+            counts[-1] += 1
+        else:
+            runs.append(v)
+            counts.append(1)
+
+    return runs, counts
+
+
+def compact_column(values, precision=3):
+    """
+    Encodes a list of scalars as typed column: dates as day offsets from the
+    first one, floats rounded to precision and repeated values, None
+    included, run-length encoded. The values are kept as they are, without
+    counts, unless that at least halves their number. Returns None for lists
+    of mixed or unsupported types.
+    """
+    types = { type(v) for v in values if v is not None }
+    column = {}
+
+    if not types:
+        column['type'] = "null"
+    elif types <= {bool}:
+        column['type'] = "bool"
+    elif types <= {int}:
+        column['type'] = "int"
+    elif types <= {int, float}:
+        column['type'] = "float"
+        values = [ v if v is None else round(v, precision) for v in values ]
+    elif types <= {str, date}:
+        try:
+            days = [ v if v is None or isinstance(v, date) else date.fromisoformat(v) for v in values ]
+        except ValueError:
+            days = None
+
+        if days is not None:
+            base = next(d for d in days if d is not None)
+            column['type'] = "date"
+            column['base'] = base.isoformat()
+            values = [ d if d is None else (d - base).days for d in days ]
+        elif types == {str}:
+            column['type'] = "str"
+        else:
+            return None
+    else:
+        return None
+
+    runs, counts = run_lengths(values)
+    if runs and 2*len(runs) <= len(values):
+        column['values'] = runs
+        column['counts'] = counts
+    else:
+        column['values'] = values
+
+    return column
+
+
+def compact(data, precision=3):
+    """
+    Replaces every list of scalars in a (nested) chart response by its
+    compact_column(). Other values are kept.
+    """
+    if isinstance(data, dict):
+        return { k: compact(v, precision) for k, v in data.items() }
+
+    if isinstance(data, list):
+        column = compact_column(data, precision)
+        if column is not None:
+            return column
+        return [ compact(v, precision) for v in data ]
+
+    return data
@@ -1,8 +1,21 @@
+from django.conf import settings
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.http import HttpResponse, JsonResponse
 from datetime import datetime
 from django.utils import timezone as tz
+import base64
+import hashlib
+import json
 
-from . import models
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from . import functions, models
 
 
 def filter_GET_daterage(request, data):
@@ -23,6 +36,237 @@ def filter_GET_daterage(request, data):
     return data
 
 
+def filter_days(data, days):
+    """
+    Filters rows by dt to the local days from the first to the last of the
+    given "YYYY-MM-DD" days.
+    """
+    if not days:
+        return data.none()
+
+    first = datetime.strptime(min(days), "%Y-%m-%d").date()
+    last = datetime.strptime(max(days), "%Y-%m-%d").date()
+
+    return data.filter(dt__gte=models.local_midnight(first),
+                       dt__lt=models.local_midnight(last + tz.timedelta(days=1)))
+
+
+def filter_GET_dayrange(request, data):
+    date_from = request.GET.get("from")
+    date_to = request.GET.get("to")
+
+    if date_from and date_to:
+        try:
+            date_from = datetime.strptime(date_from, "%Y-%m-%d").date()
+            date_to   = datetime.strptime(date_to,   "%Y-%m-%d").date()
+        except ValueError:
+            raise ValidationError("Invalid date supplied.")
+
+        data = data.filter(day__range=[date_from, date_to])
+
+    return data
+
+
+MAX_PAGE_SIZE = 1000
+
+
+class CursorPage(list):
+    """
+    A page of rows and the cursor of the following page, None on the last.
+    """
+    def __init__(self, rows, next):
+        super().__init__(rows)
+        self.next = next
+
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row.dt.isoformat(), row.id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        dt, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(dt), int(id)
+    except (ValueError, TypeError):
+        raise ValidationError("Invalid cursor supplied.")
+
+
+def paginate_GET_cursor(request, data):
+    """
+    Returns the page of data, ordered by ("-dt", "-id"), requested by
+    ?limit= and ?cursor= as CursorPage. The page is fetched by a single range
+    query on (dt, id) starting after the cursor, so it costs the same on any
+    page. Without either parameter, data is returned unchanged.
+    """
+    limit = request.GET.get("limit")
+    cursor = request.GET.get("cursor")
+
+    if not limit and not cursor:
+        return data
+
+    try:
+        limit = int(limit) if limit else get_user_settings(request.user).paginate_by
+    except ValueError:
+        raise ValidationError("Invalid limit supplied.")
+
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValidationError("Invalid limit supplied.")
+
+    if cursor:
+        dt, id = decode_cursor(cursor)
+        data = data.filter(dt__lte=dt).exclude(dt=dt, id__gte=id)
+
+    rows = list(data[:limit+1])
+    return CursorPage(rows[:limit], encode_cursor(rows[limit-1]) if len(rows) > limit else None)
+
+
+def list_response(data, rows):
+    """
+    Returns the rows of a list view as JSON list, or as {'results': rows,
+    'next': cursor} if data is a CursorPage.
+    """
+    if isinstance(data, CursorPage):
+        return JsonResponse({'results': rows, 'next': data.next})
+    return JsonResponse(rows, safe=False)
+
+
+def get_GET_windows(request):
+    windows = request.GET.get("rolling")
+
+    if not windows:
+        return []
+
+    try:
+        windows = [ int(w) for w in windows.split(",") ]
+    except ValueError:
+        raise ValidationError("Invalid window supplied.")
+
+    if any(w < 1 for w in windows):
+        raise ValidationError("Invalid window supplied.")
+
+    return windows
+
+
+def get_GET_downsampling(request):
+    points = request.GET.get("points")
+    resolution = request.GET.get("resolution")
+
+    try:
+        points = int(points) if points else None
+        resolution = int(resolution) if resolution else None
+    except ValueError:
+        raise ValidationError("Invalid downsampling supplied.")
+
+    if (points is not None and points < 3) or (resolution is not None and resolution < 1):
+        raise ValidationError("Invalid downsampling supplied.")
+
+    return points, resolution
+
+
+def downsample_response(request, response, x, *series, real=None):
+    """
+    Downsamples the lists of a chart response, all of the same length, as
+    requested by ?points= and ?resolution=. Rows for which real is true (by
+    default those with any of the series set) hold real data.
+    """
+    points, resolution = get_GET_downsampling(request)
+    if not points and not resolution:
+        return response
+
+    xs = response[x]
+    ys = [ response[s] for s in series ]
+    if real is None:
+        real = [ any(y[i] is not None for y in ys) for i in range(len(xs)) ]
+
+    keep = functions.downsample(xs, real, points, resolution)
+
+    return { k: [v[i] for i in keep] if isinstance(v, list) else v for k, v in response.items() }
+
+
+def encode_json(data):
+    """
+    Serializes a response with orjson if installed, otherwise with the
+    standard library the way JsonResponse does, but without whitespace.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":")).encode()
+
+
+def chart_response(request, response, default="json"):
+    """
+    Returns the chart data in the format requested by ?format=, or the
+    default one: "json" as is, "compact" with the lists encoded as typed,
+    run-length encoded columns, see functions.compact().
+    """
+    fmt = request.GET.get("format") or default
+
+    if fmt == "json":
+        return JsonResponse(response)
+
+    if fmt != "compact":
+        raise ValidationError("Invalid format supplied.")
+
+    response = functions.compact(response, settings.SLOGGER_COMPACT_PRECISION)
+    return HttpResponse(encode_json(response), content_type="application/json")
+
+
+def get_sync_token(child_id, h_day, h_night):
+    """
+    Returns the token of the current state of a child's summary: its data
+    version and the hours days are split by.
+    """
+    return f"{models.data_version(child_id)[0]}-{h_day}-{h_night}"
+
+
+def get_GET_since(request, h_day, h_night):
+    """
+    Returns the data version of the ?since= token, or None if there is none
+    or it was issued for other hours, so all days must be sent.
+    """
+    token = request.GET.get("since")
+
+    if not token:
+        return None
+
+    try:
+        version, since_h_day, since_h_night = ( int(v) for v in token.split("-") )
+    except ValueError:
+        raise ValidationError("Invalid token supplied.")
+
+    if (since_h_day, since_h_night) != (h_day, h_night):
+        return None
+
+    return version
+
+
+def get_GET_sections(request, choices):
+    sections = request.GET.get("sections")
+
+    if not sections:
+        return list(choices)
+
+    sections = sections.split(",")
+    if any(s not in choices for s in sections):
+        raise ValidationError("Invalid section supplied.")
+
+    return sections
+
+
+def get_data_etag(request, child_id, *extra):
+    """
+    Returns a strong ETag for a JSON response with a child's data and when
+    that data last changed. Besides the child's data version, the ETag covers
+    the requested URL, the user's settings and the extra values.
+    """
+    version, changed = models.data_version(child_id)
+
+    s = get_user_settings(request.user)
+    key = repr((request.get_full_path(), [ getattr(s, f.attname) for f in s._meta.concrete_fields ], extra))
+
+    return f"{child_id}-{version}-{hashlib.sha1(key.encode()).hexdigest()[:16]}", changed
+
+
 def fetch_growth_from_db(request, child_id):
     measurements = models.Measurement.objects.filter(child=child_id).order_by("dt")
     measurements = filter_GET_daterage(request, measurements)
@@ -34,18 +278,129 @@ def fetch_growth_from_db(request, child_id):
 
 
 def fetch_summary_from_db(request, child_id):
-    sleep = models.SleepPhase.objects.filter(child=child_id).order_by("dt")
+    sleep = models.SleepPhase.objects.filter(child=child_id).order_by("dt", "id")
     sleep = filter_GET_daterage(request, sleep)
 
-    meal = models.Meal.objects.filter(child=child_id).order_by("dt")
+    meal = models.Meal.objects.filter(child=child_id).order_by("dt", "id")
     meal = filter_GET_daterage(request, meal)
 
-    diaper = models.Diaper.objects.filter(child=child_id).order_by("dt")
+    diaper = models.Diaper.objects.filter(child=child_id).order_by("dt", "id")
     diaper = filter_GET_daterage(request, diaper)
 
     return sleep, meal, diaper
 
 
+def fetch_summary_rows(request, child_id):
+    """
+    Same as fetch_summary_from_db, but streams (dt, dt_end) tuples instead of
+    model objects. Every iterator can only be consumed once.
+    """
+    sleep, meal, diaper = fetch_summary_from_db(request, child_id)
+    return models.interval_rows(sleep), models.interval_rows(meal), models.interval_rows(diaper)
+
+
+def fetch_specials_rows(request, child_id, days=None):
+    """
+    Same as fetch_specials_from_db, but streams (dt, ...) tuples holding the
+    fields needed for the summary instead of model objects. With days, only
+    the rows from the first to the last of them are fetched.
+    """
+    events, diary, measurements = fetch_specials_from_db(request, child_id)
+
+    if days is not None:
+        events, diary, measurements = ( filter_days(q, days) for q in (events, diary, measurements) )
+
+    return (
+        events.values_list("dt", "event", "description").iterator(chunk_size=models.ROW_CHUNK_SIZE),
+        diary.values_list("dt", "title", "content").iterator(chunk_size=models.ROW_CHUNK_SIZE),
+        measurements.values_list("dt", "height", "weight").iterator(chunk_size=models.ROW_CHUNK_SIZE),
+    )
+
+
+def fetch_child_state(child_id, *related):
+    """
+    Returns the ChildState of a child, computing it from the raw tables if
+    the child has none yet. The given relations are fetched along with it.
+    """
+    try:
+        return models.ChildState.objects.select_related(*related).get(child=child_id)
+    except ObjectDoesNotExist:
+        return models.ChildState.objects.create(child_id=child_id, **models.compute_child_state(child_id))
+
+
+def fetch_summary_totals(request, child_id, h_day, h_night, days=None):
+    """
+    Returns the daily sleep, meal and diaper totals from the DailySummary
+    table, or None if those were split into day and night by other hours.
+    With days, only the totals of those days are returned.
+    """
+    summaries = models.DailySummary.objects.filter(child=child_id).order_by("series", "day")
+    summaries = filter_GET_dayrange(request, summaries)
+    if days is not None:
+        summaries = summaries.filter(day__in=days)
+
+    totals = { series: [] for series in models.SUMMARY_SOURCES }
+
+    for s in summaries:
+        if s.h_day != h_day or s.h_night != h_night:
+            return None
+        totals[s.series].append((str(s.day), { s.series: s.as_totals() }))
+
+    return totals["sleep"], totals["meals"], totals["diapers"]
+
+
+def fetch_summary_averages(request, child_id, h_day, h_night):
+    """
+    Returns the mean daily sleep time and sleep phases and the mean interval
+    between the phases, over all days of the summary, as the summary of
+    every day would give them. Computed by the database from the
+    DailySummary table, None if those were split by other hours.
+    """
+    summaries = filter_GET_dayrange(request, models.DailySummary.objects.filter(child=child_id))
+    sleep = summaries.filter(series="sleep").aggregate(
+        time=Sum("sum_time"), count=Sum("sum_count"), interval=Sum("sum_interval"),
+        other_hours=Count("id", filter=~Q(h_day=h_day, h_night=h_night)))
+
+    if sleep["other_hours"]:
+        return None
+
+    # The days of the summary are the ones with any record, specials included.
+    days = [ summaries.order_by().values_list("day") ]
+    days += [ q.order_by().annotate(day=TruncDate("dt")).values_list("day")
+              for q in fetch_specials_from_db(request, child_id) ]
+    days = days[0].union(*days[1:]).count()
+
+    if not days:
+        return 0, 0, 0
+
+    return tuple( (sleep[k] or 0)/days for k in ("time", "count", "interval") )
+
+
+def calculate_summary_totals(request, child_id, h_day, h_night, rows=None):
+    """
+    Calculates the daily sleep, meal and diaper totals from the raw data,
+    either in Python or, if SLOGGER_SUMMARY_BACKEND is "sql", mostly in the
+    database. Both return the same totals. The Python backend uses the rows
+    of fetch_summary_rows if they were already fetched.
+    """
+    days = functions.DayBoundaries(h_day, h_night)
+
+    if getattr(settings, "SLOGGER_SUMMARY_BACKEND", "python") == "sql":
+        sleep, meal, diaper = fetch_summary_from_db(request, child_id)
+        return (
+            models.aggregate_daily_sql(sleep, boundaries=days).totals("sleep"),
+            models.aggregate_daily_sql(meal, boundaries=days).totals("meals"),
+            models.aggregate_daily_sql(diaper, boundaries=days).totals("diapers"),
+        )
+
+    sleep, meal, diaper = rows or fetch_summary_rows(request, child_id)
+    return (
+        functions.calculate_totals(sleep, "sleep", boundaries=days),
+        functions.calculate_totals(meal, "meals", boundaries=days),
+        functions.calculate_totals(diaper, "diapers", boundaries=days),
+    )
+
+
 def  fetch_specials_from_db(request, child_id):
     events = models.Event.objects.filter(child=child_id).order_by("dt")
     events = filter_GET_daterage(request, events)
@@ -60,10 +415,15 @@ def  fetch_specials_from_db(request, child_id):
 
 
 def get_user_settings(user):
-    try:
-        s = models.UserSettings.objects.get(user=user)
-    except ObjectDoesNotExist:
-        s = models.UserSettings(user=user)
-        s.save()
+    """
+    Returns the settings of a user from models.user_settings. They are kept
+    as user.usersettings, so they are looked up once per request.
+    """
+    rel = models.UserSettings.user.field.remote_field
+
+    if not rel.is_cached(user):
+        s = models.user_settings(user.id)
+        models.UserSettings.user.field.set_cached_value(s, user)
+        rel.set_cached_value(user, s)
 
-    return s
\ No newline at end of file
+    return rel.get_cached_value(user)
\ No newline at end of file
@@ -1,9 +1,10 @@
 from django.http import HttpResponse, JsonResponse
-from django.shortcuts import get_object_or_404, redirect
-from django.core.exceptions import PermissionDenied
+from django.shortcuts import redirect
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone as tz
 from django.db.models import Q
+from datetime import date
 
 from . import models
 from . import functions
@@ -13,15 +14,18 @@ from . import decorators
 
 @login_required
 @decorators.only_own_children
+@decorators.child_data_etag()
 def get_growth_data(request, child_id=None):
     def get_weeks(delta):
         return delta.days/7
 
     measurements, events = helpers.fetch_growth_from_db(request, child_id)
-    c = models.Child.objects.get(id=child_id)
+    c = decorators.get_child(request, child_id)
 
-    e = functions.convert_to_totals(events, "events", "event", "description")
-    m =functions.convert_to_totals(measurements, "measurements", "weight", "height")
+    e = functions.convert_to_totals(events.values_list("dt", "event", "description"),
+                                    "events", "event", "description")
+    m = functions.convert_to_totals(measurements.values_list("dt", "weight", "height"),
+                                    "measurements", "weight", "height")
 
     totals = functions.merge_totals(e, m)
 
@@ -67,14 +71,19 @@ def get_growth_data(request, child_id=None):
                 response['events'].append(e['event'])
                 response['descriptions'].append(e['description'])
 
-    return JsonResponse(response)
+    real = [ w is not None or h is not None or n > 0
+             for w, h, n in zip(response['weight'], response['height'], response['nr_events']) ]
+    response = helpers.downsample_response(request, response, 'age_weeks', 'weight', 'height', real=real)
+
+    return helpers.chart_response(request, response)
 
 @login_required
 @decorators.only_own_children
+@decorators.child_data_etag(lambda request: models.percentile_digest())
 def get_percentile_data(request, child_id=None, m_type=None):
     measurements = models.Measurement.objects.filter(child=child_id).order_by("dt")
 
-    c = models.Child.objects.get(id=child_id)
+    c = decorators.get_child(request, child_id)
 
     if m_type == "height":
         attr = "height"
@@ -85,21 +94,20 @@ def get_percentile_data(request, child_id=None, m_type=None):
     else:
         raise ValueError("Wrong percentile type specified: " + str(m_type))
 
-    try:
-        end_day = c.age_days(measurements.last().dt.date())
-    except AttributeError:
+    if not measurements.exists():
         return JsonResponse({'Error': 'No measurements available.'}, status=404)
 
-    percentiles = models.Percentile.objects.filter(
-            Q(gender=c.gender) & Q(m_type=type_filter) & Q(day__lte=end_day)
-        ).order_by('day')
+    percentiles = models.percentile_curves(c.gender, type_filter)
 
     if len(percentiles) == 0:
         return JsonResponse({'Error': 'Percentile data not available.'}, status=500)
 
+    columns = ('p5', 'p10', 'p25', 'p50', 'p75', 'p90', 'p95')
+
     response = {
         'days':  [],
         'value': [],
+        'zscore': [],
         'p5': [],
         'p10': [],
         'p25': [],
@@ -109,50 +117,36 @@ def get_percentile_data(request, child_id=None, m_type=None):
         'p95': [],
     }
 
+    def append(day, value):
+        response['days'].append(day)
+        response['value'].append(value)
+        response['zscore'].append(percentiles.zscore(day, value))
+        for p in columns:
+            response[p].append(percentiles.value(p, day))
+
     cur_day = 0
-    for m in measurements:
-        target_day = round(c.age_days(m.dt.date()))
+    for dt, value in measurements.values_list("dt", attr):
+        target_day = round(c.age_days(dt.date()))
 
         while cur_day < target_day:
             if len(response['days']) == 0 or response['days'][-1] != cur_day:
-                response['days'].append(cur_day)
-                response['value'].append(None)
-                response['p5'].append(percentiles[cur_day].p5)
-                response['p10'].append(percentiles[cur_day].p10)
-                response['p25'].append(percentiles[cur_day].p25)
-                response['p50'].append(percentiles[cur_day].p50)
-                response['p75'].append(percentiles[cur_day].p75)
-                response['p90'].append(percentiles[cur_day].p90)
-                response['p95'].append(percentiles[cur_day].p95)
+                append(cur_day, None)
             cur_day += 1
 
-        response['days'].append(cur_day)
-        response['value'].append(getattr(m, attr))
-        response['p5'].append(percentiles[cur_day].p5)
-        response['p10'].append(percentiles[cur_day].p10)
-        response['p25'].append(percentiles[cur_day].p25)
-        response['p50'].append(percentiles[cur_day].p50)
-        response['p75'].append(percentiles[cur_day].p75)
-        response['p90'].append(percentiles[cur_day].p90)
-        response['p95'].append(percentiles[cur_day].p95)
-
-    #totals = functions.merge_totals()
+        append(cur_day, value)
 
-    return JsonResponse(response)
+    response = helpers.downsample_response(request, response, 'days', 'value')
 
+    return helpers.chart_response(request, response)
 
-@login_required
-@decorators.only_own_children
-def get_histogram_data(request, child_id=None):
 
-    mdfactor = request.user.usersettings.histogram_factor_md
-    raster = request.user.usersettings.histogram_raster
-
-    sleep, meal, diaper = helpers.fetch_summary_from_db(request, child_id)
+def histogram_data(request, sleep, meal, diaper):
+    mdfactor = helpers.get_user_settings(request.user).histogram_factor_md
+    raster = helpers.get_user_settings(request.user).histogram_raster
 
     sleepdata = functions.get_hist_data(sleep, raster, raster)
-    mealdata = functions.get_hist_data(meal, raster*mdfactor, raster*mdfactor)
-    diaperdata = functions.get_hist_data(diaper, raster*mdfactor, raster*mdfactor)
+    mealdata = functions.get_hist_data(meal, raster*mdfactor, raster)
+    diaperdata = functions.get_hist_data(diaper, raster*mdfactor, raster)
 
     response = {
         'time':  [],
@@ -166,46 +160,132 @@ def get_histogram_data(request, child_id=None):
         response['sleep'].append(d[1])
 
     for d in mealdata:
-        for i in range(mdfactor):
-            response['meals'].append(d[1])
+        response['meals'].append(d[1])
 
     for d in diaperdata:
-        for i in range(mdfactor):
-            response['diapers'].append(d[1])
+        response['diapers'].append(d[1])
+
+    return response
+
+
+@login_required
+@decorators.only_own_children
+@decorators.child_data_etag()
+def get_histogram_data(request, child_id=None):
+    sleep, meal, diaper = helpers.fetch_summary_rows(request, child_id)
+    return helpers.chart_response(request, histogram_data(request, sleep, meal, diaper))
+
+
+HEATMAP_ROWS = ('weekday', 'day')
+
+def heatmap_data(request, sleep, meal, diaper):
+    """
+    Returns how often every raster slot of the day lies within a sleep
+    phase, meal or diaper change, per weekday or, with ?rows=day, per day.
+    Unlike the histogram, meals and diapers use the same raster as sleep, so
+    the matrices line up.
+    """
+    rows = request.GET.get("rows") or HEATMAP_ROWS[0]
+    if rows not in HEATMAP_ROWS:
+        raise ValidationError("Invalid rows supplied.")
+
+    raster = helpers.get_user_settings(request.user).histogram_raster
+    weekdays = rows == 'weekday'
+
+    ranges = [ functions.day_slot_ranges(data, raster) for data in (sleep, meal, diaper) ]
+    ordinals = [ o for r in ranges for o, lo, hi in r ]
+    first, last = (min(ordinals), max(ordinals)) if ordinals else (0, -1)
 
-    return JsonResponse(response)
+    if weekdays:
+        keys = list(range(7))
+        days = [ len(range(first + (k - first + 1) % 7, last + 1, 7)) for k in keys ]
+    else:
+        keys = [ date.fromordinal(o) for o in range(first, last + 1) ]
+        days = [ 1 ] * len(keys)
+
+    response = {
+        rows: keys,
+        'days': days,
+        'time': [ f"{(j*raster)//60:02d}:{(j*raster)%60:02d}" for j in range(-(-24*60 // raster)) ],
+    }
+
+    for key, r in zip(('sleep', 'meals', 'diapers'), ranges):
+        response[key] = functions.get_heatmap_data(r, raster, first, last, weekdays)
+
+    return response
+
+
+@login_required
+@decorators.only_own_children
+@decorators.child_data_etag()
+def get_heatmap_data(request, child_id=None):
+    sleep, meal, diaper = helpers.fetch_summary_rows(request, child_id)
+    return helpers.chart_response(request, heatmap_data(request, sleep, meal, diaper), default="compact")
 
 
 @login_required
 @decorators.only_own_children
+@decorators.child_data_etag()
 def get_summary_data_list(request, child_id=None):
-    sleep, meal, diaper = helpers.fetch_summary_from_db(request, child_id)
-    events, diary, measurements = helpers.fetch_specials_from_db(request, child_id)
+    """
+    Returns the summary of every day, newest first, along with a token. With
+    ?since=<token>, only the days changed since then are returned, and the
+    days left without data are listed in 'removed'.
+    """
+    h_day = helpers.get_user_settings(request.user).start_hour_day
+    h_night = helpers.get_user_settings(request.user).start_hour_night
+
+    # Taken first, so changes while computing are sent again next time.
+    token = helpers.get_sync_token(child_id, h_day, h_night)
+    since = helpers.get_GET_since(request, h_day, h_night)
+
+    changed = None
+    if since is not None:
+        changed = models.DayChange.objects.filter(child=child_id, version__gt=since) \
+                                          .values_list("day", flat=True)
+        changed = { str(d) for d in helpers.filter_GET_dayrange(request, changed) }
+
+    # With since=, only the changed days are fetched, the averages over all
+    # days are left to the database.
+    totals = helpers.fetch_summary_totals(request, child_id, h_day, h_night, days=changed)
+    averages = None
+    if totals and changed is not None:
+        averages = helpers.fetch_summary_averages(request, child_id, h_day, h_night)
+        if averages is None:
+            totals = None
+    if not totals:
+        totals = helpers.calculate_summary_totals(request, child_id, h_day, h_night)
+    sleeptotals, mealtotals, diapertotals = totals
+
+    events, diary, measurements = helpers.fetch_specials_rows(request, child_id,
+                                                              days=None if averages is None else changed)
 
     measurements = functions.convert_to_totals(measurements, "measurements", "height", "weight")
     events = functions.convert_to_totals(events, "events", "event", "description")
     diary = functions.convert_to_totals(diary, "diary", "title", "content")
 
-    h_day = request.user.usersettings.start_hour_day
-    h_night = request.user.usersettings.start_hour_night
+    totals = list(functions.merge_totals(
+        *(reversed(t) for t in (sleeptotals, mealtotals, diapertotals, measurements, events, diary)),
+        reverse=True))
 
-    sleeptotals = functions.calculate_totals(sleep, "sleep", h_day, h_night)
-    mealtotals = functions.calculate_totals(meal, "meals", h_day, h_night)
-    diapertotals = functions.calculate_totals(diaper, "diapers", h_day, h_night)
-
-    totals = functions.merge_totals(sleeptotals, mealtotals, diapertotals, measurements, events, diary)
+    if averages is not None:
+        time, phases, interval = averages
+    else:
+        time, phases, interval = [
+            functions.RollingStats(s).mean() or 0
+            for s in functions.daily_series(totals, "sleep", "sum", "time", "count", "interval", missing=0)
+        ]
 
-    time     = functions.calculate_average(totals, 'time')
-    phases   = functions.calculate_average(totals, 'count')
-    interval = functions.calculate_average(totals, 'interval')
+    diapers = models.Diaper.objects.filter(child=child_id).order_by("dt")
+    diapers = helpers.filter_GET_daterage(request, diapers)
 
     diaperstats = {}
-    for d in diaper:
-        if d.diaper_type:
-            if not diaperstats.get(str(d.diaper_type)):
-                diaperstats[str(d.diaper_type)] = 1
+    for name in diapers.values_list("diaper_type__name", flat=True).iterator(chunk_size=models.ROW_CHUNK_SIZE):
+        if name:
+            if not diaperstats.get(name):
+                diaperstats[name] = 1
             else:
-                diaperstats[str(d.diaper_type)] += 1
+                diaperstats[name] += 1
 
     try:
         interval = interval/phases
@@ -218,28 +298,27 @@ def get_summary_data_list(request, child_id=None):
         'interval': f"{interval:.1f}",
     }
 
-    return JsonResponse({
+    response = {
         'avg': avg,
         'diaperstats': diaperstats,
-        'data': [{'day': t[0], 'data': t[1]} for t in totals][::-1]
-    }, safe=False)
+        'token': token,
+    }
 
+    if changed is None:
+        response['data'] = [{'day': t[0], 'data': t[1]} for t in totals]
+    else:
+        response['data'] = [{'day': t[0], 'data': t[1]} for t in totals if t[0] in changed]
+        response['removed'] = sorted(changed - { t[0] for t in totals }, reverse=True)
 
-@login_required
-@decorators.only_own_children
-def get_summary_data_graph(request, child_id=None):
+    return JsonResponse(response, safe=False)
 
-    def sec_to_h(sec):
-        return sec/3600.0
 
-    sleep, meal, diaper = helpers.fetch_summary_from_db(request, child_id)
+def summary_graph_data(request, totals):
 
-    h_day = request.user.usersettings.start_hour_day
-    h_night = request.user.usersettings.start_hour_night
+    def sec_to_h(sec):
+        return sec/3600.0
 
-    sleeptotals = functions.calculate_totals(sleep, "sleep", h_day, h_night)
-    mealtotals = functions.calculate_totals(meal, "meals", h_day, h_night)
-    diapertotals = functions.calculate_totals(diaper, "diapers", h_day, h_night)
+    sleeptotals, mealtotals, diapertotals = totals
 
     totals = functions.merge_totals(sleeptotals, mealtotals, diapertotals)
 
@@ -291,78 +370,149 @@ def get_summary_data_graph(request, child_id=None):
         except:
             response['meals'].append(None)
 
-    return JsonResponse(response)
+    windows = helpers.get_GET_windows(request) or [ helpers.get_user_settings(request.user).date_range_days ]
+    stats = { key: functions.RollingStats(response[key]) for key in response if key != 'day' }
+
+    response['rolling'] = {}
+    for w in windows:
+        starts = functions.window_starts(response['day'], w)
+        response['rolling'][w] = { key: s.rolling(starts) for key, s in stats.items() }
+
+    return response
+
 
 @login_required
 @decorators.only_own_children
-def get_check(request, child_id=None):
-    children = models.Child.objects.filter(parents__id=request.user.id)
-    child = get_object_or_404(models.Child, id=child_id)
+@decorators.child_data_etag()
+def get_summary_data_graph(request, child_id=None):
+    h_day = helpers.get_user_settings(request.user).start_hour_day
+    h_night = helpers.get_user_settings(request.user).start_hour_night
+
+    totals = helpers.fetch_summary_totals(request, child_id, h_day, h_night)
+    if not totals:
+        totals = helpers.calculate_summary_totals(request, child_id, h_day, h_night)
 
+    return helpers.chart_response(request, summary_graph_data(request, totals))
+
+def check_data(sleep, meal, diaper):
+    """
+    Returns the state of the latest sleep phase, meal and diaper, given as
+    (id, dt, dt_end) or (id, dt) tuples or None, and the time since then.
+    """
     response = {
         'eat':    {},
         'sleep':  {},
         'diaper': {},
     }
 
-    try:
-        s = models.SleepPhase.objects.filter(child=child_id).latest('dt')
+    def since(key, dt):
+        diff = tz.now() - dt
+        secs = diff.seconds
+        days = diff.days
+        response[key]["since_h"] = f"{int(secs/3600)}"
+        response[key]["since_m"] = f"{int((secs%3600)/60)}"
+        response[key]["since_d"] = f"{int(days)}"
 
-        if s.dt and not s.dt_end:
+    if sleep:
+        id, dt, dt_end = sleep
+        if dt and not dt_end:
             response['sleep']["state"] = 0
-            diff = (tz.now() - s.dt)
+            since('sleep', dt)
         else:
             response['sleep']["state"] = 1
-            diff = (tz.now() - s.dt_end)
-
-        secs = diff.seconds
-        days = diff.days
-        response['sleep']["since_h"] = f"{int(secs/3600)}"
-        response['sleep']["since_m"] = f"{int((secs%3600)/60)}"
-        response['sleep']["since_d"] = f"{int(days)}"
-    except Exception as e:
+            since('sleep', dt_end)
+    else:
         response['sleep']["state"] = -1
 
-    try:
-        m = models.Meal.objects.filter(child=child_id).latest('dt')
-
-        if not m.dt_end:
-            diff = (tz.now() - m.dt)
-        else:
-            diff = (tz.now() - m.dt_end)
-        secs = diff.seconds
-        days = diff.days
-        response['eat']["since_h"] = f"{int(secs/3600)}"
-        response['eat']["since_m"] = f"{int((secs%3600)/60)}"
-        response['eat']["since_d"] = f"{int(days)}"
+    if meal:
+        id, dt, dt_end = meal
+        since('eat', dt_end or dt)
         response['eat']["state"] = 1
-    except Exception as e:
+    else:
         response['eat']["state"] = -1
 
-    try:
-        d = models.Diaper.objects.filter(child=child_id).latest('dt')
-
-        diff = (tz.now() - d.dt)
-        secs = diff.seconds
-        days = diff.days
-        response['diaper']["since_h"] = f"{int(secs/3600)}"
-        response['diaper']["since_m"] = f"{int((secs%3600)/60)}"
-        response['diaper']["since_d"] = f"{int(days)}"
+    if diaper:
+        id, dt = diaper
+        since('diaper', dt)
         response['diaper']["state"] = 1
-    except Exception as e:
+    else:
         response['diaper']["state"] = 0
 
-    return JsonResponse(response)
+    return response
+
+def state_data(sleep, meal, diaper):
+    """
+    Returns the check data together with the time every timer counts from
+    as 'since_dt' and the current sleep phase, so clients can keep the
+    timers running without asking again.
+    """
+    response = check_data(sleep, meal, diaper)
+
+    for key, row in (('sleep', sleep), ('eat', meal), ('diaper', diaper)):
+        if row:
+            response[key]['since_dt'] = row[2] if len(row) > 2 and row[2] else row[1]
+
+    response['current_phase'] = current_phase_data(sleep)
+    return response
+
+def current_phase_data(sleep):
+    if not sleep or (sleep[1] and sleep[2]):
+        return { 'id': 0 }
+    else:
+        return { 'id': sleep[0] }
 
 @login_required
 @decorators.only_own_children
+def get_check(request, child_id=None):
+    state = helpers.fetch_child_state(child_id)
+    return JsonResponse(check_data(*state.latest_rows()))
+
+@login_required
+@decorators.only_own_children
+@decorators.child_data_etag()
 def get_current_sleepphase(request, child_id=None):
-    sp = models.SleepPhase.objects.filter(child=child_id)
+    state = helpers.fetch_child_state(child_id)
+    return JsonResponse(current_phase_data(state.latest_rows()[0]))
 
-    if sp:
-        sp = sp.latest('dt')
+DASHBOARD_SECTIONS = ('check', 'current_phase', 'graph', 'histogram')
 
-    if not sp or (sp.dt and sp.dt_end):
-        return JsonResponse({ 'id': 0 })
-    else:
-        return JsonResponse({ 'id': sp.id })
\ No newline at end of file
+@login_required
+@decorators.only_own_children
+@decorators.child_data_etag(lambda request: None if 'check' in helpers.get_GET_sections(request, DASHBOARD_SECTIONS) else '')
+def get_dashboard_data(request, child_id=None):
+    """
+    Combines the check, current phase, summary graph and histogram data,
+    selected by ?sections=, into one response. Authorization happens once
+    and every series is fetched once for all sections.
+    """
+    sections = helpers.get_GET_sections(request, DASHBOARD_SECTIONS)
+
+    h_day = helpers.get_user_settings(request.user).start_hour_day
+    h_night = helpers.get_user_settings(request.user).start_hour_night
+
+    totals = None
+    if 'graph' in sections:
+        totals = helpers.fetch_summary_totals(request, child_id, h_day, h_night)
+
+    rows = None
+    if 'histogram' in sections or ('graph' in sections and not totals):
+        rows = [ list(r) for r in helpers.fetch_summary_rows(request, child_id) ]
+
+    response = {}
+
+    if 'check' in sections or 'current_phase' in sections:
+        latest = helpers.fetch_child_state(child_id).latest_rows()
+        if 'check' in sections:
+            response['check'] = check_data(*latest)
+        if 'current_phase' in sections:
+            response['current_phase'] = current_phase_data(latest[0])
+
+    if 'graph' in sections:
+        if not totals:
+            totals = helpers.calculate_summary_totals(request, child_id, h_day, h_night, rows=rows)
+        response['graph'] = summary_graph_data(request, totals)
+
+    if 'histogram' in sections:
+        response['histogram'] = histogram_data(request, *rows)
+
+    return helpers.chart_response(request, response)
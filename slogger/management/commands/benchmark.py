@@ -0,0 +1,587 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.http import JsonResponse
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone as tz
+
+from asgiref.sync import sync_to_async
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from time import perf_counter
+import asyncio
+import django
+import json
+import platform
+import random
+import sys
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from slogger import events, functions, helpers, models
+from slogger.stream import with_child_state_stream
+
+def generate_intervals(days, seed=0, min_gap=30, max_gap=300, min_len=10, max_len=600):
+    """
+    Returns a list of (dt, dt_end) tuples covering the given number of days,
+    ordered by dt. Gaps and durations are given in minutes. Like the ones
+    loaded from the DB, the datetimes are in UTC.
+    """
+    r = random.Random(seed)
+
+    data = []
+    dt = tz.make_aware(datetime(2020, 1, 1, 6)).astimezone(tz.utc)
+    end = dt + timedelta(days=days)
+
+    while dt < end:
+        dt += timedelta(minutes=r.randint(min_gap, max_gap))
+        dt_end = dt + timedelta(minutes=r.randint(min_len, max_len))
+        data.append((dt, dt_end))
+        dt = dt_end
+
+    return data
+
+def measure(func, *args, repeat=3):
+    """
+    Runs func repeatedly and returns the best wall time in seconds and the
+    peak number of bytes allocated during a single (traced) run.
+    """
+    best = None
+    for i in range(repeat):
+        start = perf_counter()
+        func(*args)
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak
+
+def max_rss():
+    """
+    Returns the peak resident set size of the process so far in bytes, or
+    None where it is not available. Unlike the traced peak, it includes the
+    memory of the DB driver and the interpreter itself.
+    """
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss*1024
+
+def format_rss(rss, width):
+    return f"{rss/2**20:>{width}.1f}" if rss is not None else f"{'':>{width}}"
+
+def count_queries(func, *args):
+    """
+    Returns the number of DB queries a single run of func executes.
+    """
+    queries = 0
+
+    def counter(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(counter):
+        func(*args)
+
+    return queries
+
+def bench_totals(out, years, repeat):
+    out.write("calculate_totals")
+    out.write(f"{'years':>5} {'records':>8} {'days':>6} {'ms':>9} {'us/rec':>7} {'peak kB':>9} {'B/rec':>6}")
+
+    for y in years:
+        data = generate_intervals(365*y)
+        days = len(functions.aggregate_daily(data).present)
+
+        secs, peak = measure(
+            lambda d: functions.aggregate_daily(d).totals("sleep"), data, repeat=repeat)
+
+        out.write(f"{y:>5} {len(data):>8} {days:>6} {secs*1000:>9.1f} "
+                  f"{secs*1e6/len(data):>7.2f} {peak/1024:>9.1f} {peak/len(data):>6.0f}")
+
+def generate_daily_series(days, keys=("sleep", "meals", "diapers", "measurements", "events", "diary"), seed=0):
+    """
+    Returns one list of (day, data) tuples per key, as produced by
+    calculate_totals and convert_to_totals. The daily series cover every day,
+    the others (every key after the third) only a few of them.
+    """
+    r = random.Random(seed)
+    first = datetime(2020, 1, 1).toordinal()
+
+    series = []
+    for n, key in enumerate(keys):
+        if n < 3:
+            ordinals = range(first, first + days)
+        else:
+            ordinals = sorted(r.sample(range(first, first + days), max(1, days // 30)))
+        series.append([ (str(date.fromordinal(o)), { key: {} }) for o in ordinals ])
+
+    return series
+
+def bench_merge(out, day_counts, repeat):
+    out.write("merge_totals")
+    out.write(f"{'days':>6} {'records':>8} {'ms':>9} {'us/day':>7} {'peak kB':>9}")
+
+    for days in day_counts:
+        series = generate_daily_series(days)
+        records = sum(len(s) for s in series)
+
+        secs, peak = measure(
+            lambda s: sum(1 for t in functions.merge_totals(*s)), series, repeat=repeat)
+
+        out.write(f"{days:>6} {records:>8} {secs*1000:>9.1f} {secs*1e6/days:>7.2f} {peak/1024:>9.1f}")
+
+@contextmanager
+def test_database():
+    """
+    Runs the enclosed code against a freshly created test database, so the
+    benchmark never touches real data.
+    """
+    old_name = connection.settings_dict['NAME']
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+def generate_specials(days, seed=0):
+    """
+    Returns lists of (dt, ...) tuples for weekly measurements, monthly
+    events and diary entries every three days.
+    """
+    r = random.Random(seed)
+    start = tz.make_aware(datetime(2020, 1, 1, 9)).astimezone(tz.utc)
+
+    def at(day):
+        return start + timedelta(days=day, minutes=r.randint(0, 600))
+
+    measurements = [ (at(d), 3.5 + d*0.01 + r.random()*0.2, 50 + d*0.04 + r.random())
+                     for d in range(0, days, 7) ]
+    events = [ (at(d), f"Event {n}", "Something happened.") for n, d in enumerate(range(0, days, 30)) ]
+    diary = [ (at(d), f"Entry {n}", "Lorem ipsum " * r.randint(1, 50)) for n, d in enumerate(range(0, days, 3)) ]
+
+    return measurements, events, diary
+
+def populate(user, days, seed=0):
+    """
+    Creates a child with sleep phases, meals, diapers, measurements, events
+    and diary entries for the given number of days and returns it.
+    """
+    c = models.Child.objects.create(created_by=user, name=f"Child {seed}",
+                                    birthday=date(2020, 1, 1), gender="MF"[seed % 2])
+    c.parents.add(user)
+
+    sleep = generate_intervals(days, seed)
+    meals = generate_intervals(days, seed+1, 120, 240, 5, 30)
+    measurements, events, diary = generate_specials(days, seed)
+
+    diaper_types = list(models.DiaperType.objects.filter(created_by=user)) or [
+        models.DiaperType.objects.create(created_by=user, name=name) for name in ("Wet", "Dirty")
+    ]
+
+    models.SleepPhase.objects.bulk_create([
+        models.SleepPhase(child=c, created_by=user, dt=dt, dt_end=dt_end) for dt, dt_end in sleep
+    ], batch_size=500)
+    models.Meal.objects.bulk_create([
+        models.Meal(child=c, created_by=user, dt=dt, dt_end=dt_end) for dt, dt_end in meals
+    ], batch_size=500)
+    models.Diaper.objects.bulk_create([
+        models.Diaper(child=c, created_by=user, dt=dt_end, diaper_type=diaper_types[n % len(diaper_types)])
+        for n, (dt, dt_end) in enumerate(meals)
+    ], batch_size=500)
+    models.Measurement.objects.bulk_create([
+        models.Measurement(child=c, created_by=user, dt=dt, weight=weight, height=height)
+        for dt, weight, height in measurements
+    ], batch_size=500)
+    models.Event.objects.bulk_create([
+        models.Event(child=c, created_by=user, dt=dt, event=event, description=description)
+        for dt, event, description in events
+    ], batch_size=500)
+    models.DiaryEntry.objects.bulk_create([
+        models.DiaryEntry(child=c, created_by=user, dt=dt, title=title, content=content)
+        for dt, title, content in diary
+    ], batch_size=500)
+
+    models.rebuild_daily_summaries(c.id)
+    models.update_child_state(c.id)
+
+    return c
+
+def populate_percentiles(days=1857):
+    """
+    Creates smooth synthetic percentile curves for both genders, height and
+    weight, like the ones loaded by load_percentiles.
+    """
+    fields = ("p01", "p1", "p3", "p5", "p10", "p15", "p25", "p50", "p75", "p85", "p90", "p95", "p97", "p99", "p999")
+
+    percentiles = []
+    for gender in ("M", "F"):
+        for m_type, base, growth in (("L", 50, 0.03), ("W", 3.3, 0.008)):
+            for day in range(days):
+                median = base + growth*day
+                percentiles.append(models.Percentile(gender=gender, m_type=m_type, day=day, **{
+                    f: median * (0.8 + 0.4*n/(len(fields) - 1)) for n, f in enumerate(fields)
+                }))
+
+    models.Percentile.objects.bulk_create(percentiles, batch_size=500)
+    models.invalidate_percentiles()
+
+def bench_rows(out, years, repeat):
+    out.write("calculate_totals: model objects vs. values_list rows")
+    out.write(f"{'years':>5} {'records':>8} {'obj ms':>9} {'obj peak kB':>12} {'row ms':>9} {'row peak kB':>12} "
+              f"{'max RSS MB':>10}")
+
+    with test_database():
+        user = get_user_model().objects.create(username="benchmark")
+
+        for y in years:
+            c = populate(user, 365*y, seed=y)
+            data = models.SleepPhase.objects.filter(child=c).order_by("dt")
+
+            obj_secs, obj_peak = measure(
+                lambda d: functions.calculate_totals(d.all(), "sleep"), data, repeat=repeat)
+            row_secs, row_peak = measure(
+                lambda d: functions.calculate_totals(models.interval_rows(d), "sleep"), data, repeat=repeat)
+
+            out.write(f"{y:>5} {data.count():>8} {obj_secs*1000:>9.1f} {obj_peak/1024:>12.1f} "
+                      f"{row_secs*1000:>9.1f} {row_peak/1024:>12.1f} {format_rss(max_rss(), 10)}")
+
+        out.write("endpoints, raw data path (summaries disabled)")
+        out.write(f"{'years':>5} {'endpoint':<22} {'ms':>9} {'peak kB':>9}")
+
+        client = Client()
+        client.force_login(user)
+        models.DailySummary.objects.update(h_day=-1)
+
+        for y in years:
+            c = models.Child.objects.get(name=f"Child {y}")
+            for endpoint in ("summary/list", "summary/graph", "histogram"):
+                secs, peak = measure(client.get, f"/{c.id}/data/{endpoint}/", repeat=repeat)
+                out.write(f"{y:>5} {endpoint:<22} {secs*1000:>9.1f} {peak/1024:>9.1f}")
+
+def bench_backends(out, day_counts, repeat):
+    """
+    Times the Python and SQL summary backends on the same data, to show where
+    one overtakes the other. That both return the same totals is tested.
+    """
+    out.write("summary backends: python vs. sql")
+    out.write(f"{'days':>6} {'records':>8} {'python ms':>10} {'sql ms':>9} {'faster':>7}")
+
+    with test_database():
+        user = get_user_model().objects.create(username="benchmark")
+
+        for days in day_counts:
+            c = populate(user, days, seed=days)
+
+            data = models.SleepPhase.objects.filter(child=c).order_by("dt", "id")
+            py_secs, py_peak = measure(
+                lambda d: functions.calculate_totals(models.interval_rows(d), "sleep"), data, repeat=repeat)
+            sql_secs, sql_peak = measure(
+                lambda d: models.aggregate_daily_sql(d).totals("sleep"), data, repeat=repeat)
+
+            faster = "python" if py_secs < sql_secs else "sql"
+            out.write(f"{days:>6} {data.count():>8} {py_secs*1000:>10.1f} {sql_secs*1000:>9.1f} {faster:>7}")
+
+
+DATA_ENDPOINTS = ("check", "current_phase", "summary/graph", "summary/list", "histogram", "heatmap", "dashboard",
+                  "measurements", "percentiles/height", "percentiles/weight")
+LIST_VIEWS = {
+    "sleep": models.SleepPhase,
+    "meals": models.Meal,
+    "diapers": models.Diaper,
+    "measurements": models.Measurement,
+    "events": models.Event,
+    "diary": models.DiaryEntry,
+}
+PAGE_SIZE = 50
+CHART_ENDPOINTS = ("summary/graph", "measurements", "histogram", "percentiles/height", "percentiles/weight",
+                   "dashboard")
+
+def payload_size(result):
+    """
+    Returns the number of bytes of a response or encoded payload, or None.
+    """
+    if isinstance(result, bytes):
+        return len(result)
+    if hasattr(result, "content"):
+        return len(result.content)
+    return None
+
+def bench_suite(out, day_counts, child_counts, repeat, seed=0):
+    """
+    Times the aggregation functions and the JSON endpoints for every number
+    of days and children on seeded synthetic data and returns the results.
+    The functions only depend on the data of a single child, so they are
+    measured once per number of days.
+    """
+    results = []
+
+    out.write("suite")
+    out.write(f"{'days':>5} {'children':>8} {'target':<44} {'ms':>9} {'queries':>7} {'peak kB':>9} {'bytes':>8} "
+              f"{'max RSS MB':>10}")
+
+    def record(days, children, target, func, *args):
+        secs, peak = measure(func, *args, repeat=repeat)
+        queries = count_queries(func, *args)
+        size = payload_size(func(*args))
+        rss = max_rss()
+        results.append({
+            'days': days,
+            'children': children,
+            'target': target,
+            'ms': secs*1000,
+            'queries': queries,
+            'peak_kb': peak/1024,
+            'bytes': size,
+            'max_rss_kb': rss/1024 if rss is not None else None,
+        })
+        out.write(f"{days:>5} {children:>8} {target:<44} {secs*1000:>9.1f} {queries:>7} {peak/1024:>9.1f} "
+                  f"{size if size is not None else '':>8} {format_rss(rss, 10)}")
+
+    for days in day_counts:
+        with test_database():
+            user = get_user_model().objects.create(username="benchmark")
+            populate_percentiles()
+
+            client = Client()
+            client.force_login(user)
+
+            children = []
+            for n in sorted(child_counts):
+                while len(children) < n:
+                    children.append(populate(user, days, seed=seed + len(children)))
+                c = children[0]
+
+                if n == min(child_counts):
+                    h_day, h_night = models.summary_hours(c.id)
+                    sleep, meals, diapers = [
+                        list(models.interval_rows(model.objects.filter(child=c).order_by("dt", "id")))
+                        for model in models.SUMMARY_SOURCES.values()
+                    ]
+                    totals = [
+                        functions.calculate_totals(rows, series, h_day, h_night)
+                        for rows, series in ((sleep, "sleep"), (meals, "meals"), (diapers, "diapers"))
+                    ]
+
+                    record(days, n, "calculate_totals", functions.calculate_totals, sleep, "sleep", h_day, h_night)
+                    record(days, n, "calculate_duration_totals",
+                           functions.calculate_duration_totals, sleep, h_day, h_night)
+                    record(days, n, "merge_totals", lambda t: sum(1 for d in functions.merge_totals(*t)), totals)
+                    record(days, n, "get_hist_data", functions.get_hist_data, sleep, 10, 10)
+
+                for endpoint in DATA_ENDPOINTS:
+                    record(days, n, f"/data/{endpoint}/", client.get, f"/{c.id}/data/{endpoint}/")
+
+                for endpoint in CHART_ENDPOINTS:
+                    url = f"/{c.id}/data/{endpoint}/"
+                    record(days, n, f"{url[url.index('/data'):]}?format=compact", client.get, url + "?format=compact")
+
+                    if n == min(child_counts):
+                        data = json.loads(client.get(url).content)
+                        record(days, n, f"encode /data/{endpoint}/", lambda d: JsonResponse(d).content, data)
+                        record(days, n, f"encode /data/{endpoint}/ compact", lambda d: helpers.encode_json(
+                            functions.compact(d, settings.SLOGGER_COMPACT_PRECISION)), data)
+
+                get_json = lambda url: client.get(url, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+
+                for view, model in LIST_VIEWS.items():
+                    record(days, n, f"/{view}/ (json)", get_json, f"/{c.id}/{view}/")
+
+                    # The first page and the one after the middle of the history.
+                    rows = model.objects.filter(child=c).order_by("-dt", "-id")
+                    middle = rows[rows.count()//2] if rows.exists() else None
+                    url = f"/{c.id}/{view}/?limit={PAGE_SIZE}"
+                    record(days, n, f"/{view}/?limit={PAGE_SIZE} (json)", get_json, url)
+                    if middle:
+                        record(days, n, f"/{view}/?limit={PAGE_SIZE}&cursor=middle (json)", get_json,
+                               f"{url}&cursor={helpers.encode_cursor(middle)}")
+
+    return results
+
+async def stream_subscribers(app, child_id, cookie, subscribers, user_id):
+    """
+    Opens the state stream of a child for the given number of subscribers,
+    stays idle for a second, saves a sleep phase and closes the streams.
+    Returns the connect time, the memory held per subscriber, the idle
+    queries and the delivery latencies.
+    """
+    received = [ [] for i in range(subscribers) ]
+    connected = asyncio.Event()
+    delivered = asyncio.Event()
+    disconnect = asyncio.Event()
+
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': f"/{child_id}/data/stream/",
+        'root_path': '',
+        'query_string': b'',
+        'headers': [(b'host', b'testserver'), (b'cookie', cookie.encode())],
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 0),
+    }
+
+    async def subscriber(n):
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start' and message['status'] != 200:
+                raise CommandError(f"The stream answered with {message['status']}.")
+            if message.get('body', b'').startswith(b"data:"):
+                received[n].append(perf_counter())
+                counts = [ len(r) for r in received ]
+                if min(counts) == 1:
+                    connected.set()
+                if min(counts) == 2:
+                    delivered.set()
+
+        await app(scope, receive, send)
+
+    queries = 0
+
+    def counter(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    def add_phase():
+        models.SleepPhase.objects.create(child_id=child_id, created_by_id=user_id, dt=tz.now())
+
+    tracemalloc.start()
+    start = perf_counter()
+    tasks = [ asyncio.ensure_future(subscriber(n)) for n in range(subscribers) ]
+    await connected.wait()
+    connect = perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] / subscribers
+    tracemalloc.stop()
+
+    # The DB is only used in the thread the sync code runs in.
+    wrapper = connection.execute_wrapper(counter)
+    await sync_to_async(wrapper.__enter__)()
+    await asyncio.sleep(1)
+    idle_queries = queries
+    await sync_to_async(wrapper.__exit__)(None, None, None)
+
+    start = perf_counter()
+    await sync_to_async(add_phase)()
+    await delivered.wait()
+    latencies = sorted(r[1] - start for r in received)
+
+    disconnect.set()
+    await asyncio.gather(*tasks)
+
+    return connect, memory, idle_queries, latencies
+
+def bench_stream(out, subscribers, seed=0):
+    """
+    Load tests the state stream with concurrent subscribers of one child,
+    calling the ASGI application directly.
+    """
+    out.write("state stream")
+    out.write(f"{'subscribers':>11} {'connect ms':>10} {'idle queries':>12} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7} {'kB/sub':>7}")
+
+    with test_database():
+        user = get_user_model().objects.create(username="benchmark")
+        c = populate(user, 7, seed=seed)
+
+        client = Client()
+        client.force_login(user)
+        cookie = f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+        app = with_child_state_stream(None)
+
+        connect, memory, idle_queries, latencies = asyncio.run(
+            stream_subscribers(app, c.id, cookie, subscribers, user.id))
+
+        if c.id in events.get_backend().subscribers:
+            raise CommandError("Subscriptions left after disconnecting.")
+
+    p50 = latencies[len(latencies)//2]*1000
+    p99 = latencies[min(len(latencies) - 1, len(latencies)*99//100)]*1000
+    out.write(f"{subscribers:>11} {connect*1000:>10.1f} {idle_queries:>12} {p50:>7.1f} {p99:>7.1f} "
+              f"{latencies[-1]*1000:>7.1f} {memory/1024:>7.1f}")
+
+    if idle_queries:
+        raise CommandError(f"Idle subscribers ran {idle_queries} queries.")
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the aggregation functions on synthetic data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--db', action='store_true',
+                            help="Also run the benchmarks against a temporary test database.")
+        parser.add_argument('--suite', action='store_true',
+                            help="Run the function and endpoint suite instead, against a temporary test database.")
+        parser.add_argument('--days', type=int, nargs='+', default=[7, 365, 1825],
+                            help="Days of data per child in the suite.")
+        parser.add_argument('--children', type=int, nargs='+', default=[1, 10, 100],
+                            help="Numbers of children in the suite.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', help="Write the suite results to this file.")
+        parser.add_argument('--subscribers', type=int,
+                            help="Load test the state stream with this many concurrent subscribers instead.")
+
+    def handle(self, *args, **options):
+        if options['subscribers'] is not None:
+            if options['subscribers'] < 1:
+                raise CommandError("At least one subscriber is required.")
+            bench_stream(self.stdout, options['subscribers'], options['seed'])
+            return
+
+        if options['suite']:
+            if min(options['days']) < 1 or min(options['children']) < 1:
+                raise CommandError("At least one day and one child are required.")
+
+            results = bench_suite(self.stdout, options['days'], options['children'], options['repeat'], options['seed'])
+
+            if options['json']:
+                with open(options['json'], "w") as f:
+                    json.dump({
+                        'created': tz.now().isoformat(),
+                        'python': platform.python_version(),
+                        'django': django.get_version(),
+                        'database': connection.vendor,
+                        'seed': options['seed'],
+                        'repeat': options['repeat'],
+                        'results': results,
+                    }, f, indent=2)
+            return
+
+        if options['years'] < 1:
+            raise CommandError("At least one year of data is required.")
+
+        bench_totals(self.stdout, range(1, options['years']+1), options['repeat'])
+        bench_merge(self.stdout, (1000, 10000), options['repeat'])
+
+        if options['db']:
+            bench_rows(self.stdout, range(1, options['years']+1), options['repeat'])
+            bench_backends(self.stdout, sorted({7, 30, 90, 365, 365*options['years']}), options['repeat'])
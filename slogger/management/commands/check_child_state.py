@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from slogger.models import Child, ChildState, compute_child_state, update_child_state
+
+def verify_child(child_id):
+    """
+    Returns the ChildState fields of a child that differ from the raw data,
+    all of them if the child has no state.
+    """
+    expected = compute_child_state(child_id)
+
+    actual = ChildState.objects.filter(child=child_id).values(*expected).first()
+    if actual is None:
+        return list(expected)
+
+    return [ field for field, value in expected.items() if actual[field] != value ]
+
+class Command(BaseCommand):
+    help = 'Verifies the current state of children against the raw data and repairs it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('child_id', type=int, nargs='*')
+        parser.add_argument('--check', action='store_true',
+                            help="Only report differences, don't repair them.")
+
+    def handle(self, *args, **options):
+        children = Child.objects.order_by("id")
+        if options['child_id']:
+            children = children.filter(id__in=options['child_id'])
+
+        drifted = 0
+
+        for child in children:
+            fields = verify_child(child.id)
+            if not fields:
+                continue
+
+            drifted += 1
+            self.stdout.write(f"{child}: {', '.join(fields)} differ")
+
+            if not options['check']:
+                ChildState.objects.get_or_create(child=child)
+                update_child_state(child.id)
+
+        if options['check'] and drifted:
+            raise CommandError(f"The state of {drifted} child(ren) differs from the raw data.")
+
+        self.stdout.write(f"Checked {children.count()} child(ren), {drifted} with differences.")
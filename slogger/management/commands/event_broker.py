@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import asyncio
+
+from slogger.events import run_broker
+
+class Command(BaseCommand):
+    help = 'Runs the broker sharing the child state events of several ASGI processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('address', nargs='?', default=settings.SLOGGER_EVENTS_BROKER,
+                            help="host:port to listen on, SLOGGER_EVENTS_BROKER by default.")
+
+    def handle(self, *args, **options):
+        host, port = options['address'].rsplit(":", 1)
+        self.stdout.write(f"Event broker listening on {host}:{port}")
+        asyncio.run(run_broker(host, int(port)))
@@ -1,8 +1,9 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from django.utils import timezone as tz
 from urllib import request
 
-from slogger.models import Percentile
+from slogger.models import Percentile, invalidate_percentiles
 
 def import_percentiles(type, gender, dt, data):
     if type == "lhfa":
@@ -17,6 +18,9 @@ def import_percentiles(type, gender, dt, data):
     elif gender == "boys":
         g = "M"
 
+    # Replaces the curve loaded before, if any.
+    Percentile.objects.filter(gender=g, m_type=t).delete()
+
     for row in data.split("\r\n")[1:]:
         r = row.split("\t")
 
@@ -61,4 +65,7 @@ class Command(BaseCommand):
             fname = url.split("/")[-1].split("_")
             with request.urlopen(url) as response:
                 data = response.read()
-                import_percentiles(fname[0], fname[1], dt, data.decode('ascii'))
\ No newline at end of file
+                with transaction.atomic():
+                    import_percentiles(fname[0], fname[1], dt, data.decode('ascii'))
+
+        invalidate_percentiles()
\ No newline at end of file
@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from slogger import functions
+from slogger.models import Child, DailySummary, SUMMARY_SOURCES, summary_hours, update_daily_summaries
+
+def differences(expected, actual):
+    """
+    Compares two lists of daily totals and returns the days that differ.
+    """
+    expected = dict(expected)
+    actual = dict(actual)
+
+    days = []
+    for day in sorted(set(expected) | set(actual)):
+        e = expected.get(day)
+        a = actual.get(day)
+
+        if e is None or a is None:
+            days.append(day)
+            continue
+
+        for c in functions.DailyTotals.CATEGORIES:
+            if any(abs(e[c][k] - a[c][k]) > 0.001 for k in ('count', 'time', 'interval')):
+                days.append(day)
+                break
+
+    return days
+
+def verify_child(child_id):
+    h_day, h_night = summary_hours(child_id)
+    drift = {}
+
+    for series, model in SUMMARY_SOURCES.items():
+        data = model.objects.filter(child=child_id).order_by("dt")
+        expected = [ (day, t[series]) for day, t in functions.calculate_totals(data, series, h_day, h_night) ]
+
+        summaries = DailySummary.objects.filter(child=child_id, series=series).order_by("day")
+        actual = []
+        for s in summaries:
+            if s.h_day != h_day or s.h_night != h_night:
+                actual = []
+                break
+            actual.append((str(s.day), s.as_totals()))
+
+        days = differences(expected, actual)
+        if days:
+            drift[series] = days
+
+    return drift
+
+class Command(BaseCommand):
+    help = 'Verifies the daily summaries against the raw data and rebuilds them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('child_id', type=int, nargs='*')
+        parser.add_argument('--check', action='store_true',
+                            help="Only report drift, don't repair it.")
+
+    def handle(self, *args, **options):
+        children = Child.objects.order_by("id")
+        if options['child_id']:
+            children = children.filter(id__in=options['child_id'])
+
+        drifted = 0
+
+        for child in children:
+            drift = verify_child(child.id)
+
+            for series, days in drift.items():
+                self.stdout.write(f"{child}: {len(days)} {series} day(s) differ, first: {days[0]}")
+
+            if drift:
+                drifted += 1
+                if not options['check']:
+                    for series in drift:
+                        update_daily_summaries(series, child.id)
+
+        if options['check'] and drifted:
+            raise CommandError(f"Daily summaries of {drifted} child(ren) differ from the raw data.")
+
+        self.stdout.write(f"Checked {children.count()} child(ren), {drifted} with drift.")
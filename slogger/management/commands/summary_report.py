@@ -0,0 +1,115 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from multiprocessing import Pool
+from time import perf_counter
+import django
+import json
+import os
+
+from slogger import functions
+from slogger.models import Child, Diaper, Event, Measurement, SUMMARY_SOURCES, interval_rows, summary_hours, ROW_CHUNK_SIZE
+
+def init_worker():
+    """
+    Gives every worker its own DB connection instead of the ones inherited
+    from the parent process.
+    """
+    django.setup()
+    connections.close_all()
+
+def child_report(child_id):
+    """
+    Returns the daily totals, averages, diaper stats and growth series of a
+    child as a JSON serializable dict.
+    """
+    c = Child.objects.get(id=child_id)
+    days = functions.DayBoundaries(*summary_hours(child_id))
+
+    totals = [
+        functions.calculate_totals(
+            interval_rows(model.objects.filter(child=child_id).order_by("dt", "id")), series, boundaries=days)
+        for series, model in SUMMARY_SOURCES.items()
+    ]
+    totals = list(functions.merge_totals(*totals))
+
+    time, phases, interval = [
+        functions.RollingStats(s).mean() or 0
+        for s in functions.daily_series(totals, "sleep", "sum", "time", "count", "interval", missing=0)
+    ]
+
+    try:
+        interval = interval/phases
+    except ZeroDivisionError:
+        interval = 0
+
+    diaperstats = {}
+    diapers = Diaper.objects.filter(child=child_id).values_list("diaper_type__name", flat=True)
+    for name in diapers.iterator(chunk_size=ROW_CHUNK_SIZE):
+        if name:
+            diaperstats[name] = diaperstats.get(name, 0) + 1
+
+    measurements = Measurement.objects.filter(child=child_id).order_by("dt")
+    events = Event.objects.filter(child=child_id).order_by("dt")
+    growth = functions.merge_totals(
+        functions.convert_to_totals(events.values_list("dt", "event", "description"),
+                                    "events", "event", "description"),
+        functions.convert_to_totals(measurements.values_list("dt", "weight", "height"),
+                                    "measurements", "weight", "height"),
+    )
+
+    return {
+        'child': c.id,
+        'name': c.name,
+        'avg': {
+            'time': time,
+            'phases': phases,
+            'interval': interval,
+        },
+        'diaperstats': diaperstats,
+        'data': [{'day': t[0], 'data': t[1]} for t in totals],
+        'growth': [{'day': t[0], 'data': t[1]} for t in growth],
+    }
+
+class Command(BaseCommand):
+    help = 'Writes the summaries of all (or the given) children to a JSONL file, using several processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('child_id', type=int, nargs='*')
+        parser.add_argument('-o', '--output', required=True,
+                            help="JSONL file to write one report per child to.")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help="Number of worker processes, each with its own DB connection.")
+        parser.add_argument('--chunk-size', type=int, default=8,
+                            help="Number of children handed to a worker at once.")
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError("At least one worker and a chunk size of one are required.")
+
+        children = Child.objects.order_by("id")
+        if options['child_id']:
+            children = children.filter(id__in=options['child_id'])
+        children = list(children.values_list("id", flat=True))
+
+        # The workers must not share the parent's connection.
+        connections.close_all()
+
+        start = perf_counter()
+        last_progress = start
+        done = 0
+
+        with open(options['output'], "w") as f, \
+             Pool(options['workers'], initializer=init_worker) as pool:
+            for report in pool.imap_unordered(child_report, children, chunksize=options['chunk_size']):
+                f.write(json.dumps(report) + "\n")
+                done += 1
+
+                now = perf_counter()
+                if now - last_progress >= 1 or done == len(children):
+                    last_progress = now
+                    self.stderr.write(f"{done}/{len(children)} children, {done/(now - start):.1f} children/s")
+
+        elapsed = perf_counter() - start
+        self.stdout.write(f"Wrote {done} report(s) to {options['output']} in {elapsed:.1f}s "
+                          f"with {options['workers']} worker(s).")
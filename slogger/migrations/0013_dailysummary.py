@@ -0,0 +1,71 @@
+# Generated by Django 3.1.13 on 2026-10-18 09:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    from slogger.functions import aggregate_daily
+
+    Child = apps.get_model('slogger', 'Child')
+    UserSettings = apps.get_model('slogger', 'UserSettings')
+    DailySummary = apps.get_model('slogger', 'DailySummary')
+
+    sources = (
+        ('sleep', apps.get_model('slogger', 'SleepPhase'), ('dt', 'dt_end')),
+        ('meals', apps.get_model('slogger', 'Meal'), ('dt', 'dt_end')),
+        ('diapers', apps.get_model('slogger', 'Diaper'), ('dt',)),
+    )
+
+    for child in Child.objects.all():
+        hours = UserSettings.objects.filter(user=child.created_by_id) \
+                                    .values_list('start_hour_day', 'start_hour_night').first() or (8, 19)
+
+        for series, model, fields in sources:
+            data = model.objects.filter(child=child).order_by('dt').values_list(*fields)
+            totals = aggregate_daily(((r[0], r[-1] if len(r) == 2 else None) for r in data), *hours)
+
+            summaries = []
+            for i, day in totals.days():
+                s = DailySummary(child=child, series=series, day=day, h_day=hours[0], h_night=hours[1])
+                for k, c in enumerate(totals.CATEGORIES):
+                    setattr(s, c + '_count', totals.count[k][i])
+                    setattr(s, c + '_time', totals.time[k][i])
+                    setattr(s, c + '_interval', totals.interval[k][i])
+                summaries.append(s)
+
+            DailySummary.objects.bulk_create(summaries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slogger', '0012_auto_20200525_0843'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('series', models.CharField(choices=[('sleep', 'Sleep'), ('meals', 'Meals'), ('diapers', 'Diapers')], max_length=10)),
+                ('day', models.DateField()),
+                ('h_day', models.IntegerField(default=8)),
+                ('h_night', models.IntegerField(default=19)),
+                ('sum_count', models.IntegerField(default=0)),
+                ('sum_time', models.FloatField(default=0)),
+                ('sum_interval', models.FloatField(default=0)),
+                ('day_count', models.IntegerField(default=0)),
+                ('day_time', models.FloatField(default=0)),
+                ('day_interval', models.FloatField(default=0)),
+                ('night_count', models.IntegerField(default=0)),
+                ('night_time', models.FloatField(default=0)),
+                ('night_interval', models.FloatField(default=0)),
+                ('child', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='slogger.child')),
+            ],
+            options={
+                'unique_together': {('child', 'series', 'day')},
+            },
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.13 on 2026-10-18 09:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slogger', '0013_dailysummary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='diaper',
+            index=models.Index(fields=['child', 'dt'], name='slogger_dia_child_i_1f6ab4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['child', 'dt'], name='slogger_mea_child_i_1c23e9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sleepphase',
+            index=models.Index(fields=['child', 'dt'], name='slogger_sle_child_i_df30f4_idx'),
+        ),
+    ]
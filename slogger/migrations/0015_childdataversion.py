@@ -0,0 +1,33 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def create_versions(apps, schema_editor):
+    Child = apps.get_model('slogger', 'Child')
+    ChildDataVersion = apps.get_model('slogger', 'ChildDataVersion')
+
+    ChildDataVersion.objects.bulk_create([
+        ChildDataVersion(child=c) for c in Child.objects.all()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slogger', '0014_child_dt_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChildDataVersion',
+            fields=[
+                ('child', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='slogger.child')),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('changed', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(create_versions, migrations.RunPython.noop),
+    ]
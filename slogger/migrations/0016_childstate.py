@@ -0,0 +1,45 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_states(apps, schema_editor):
+    Child = apps.get_model('slogger', 'Child')
+    ChildState = apps.get_model('slogger', 'ChildState')
+
+    sources = (
+        (apps.get_model('slogger', 'SleepPhase'), ('id', 'dt', 'dt_end'), ('sleep_id', 'sleep_dt', 'sleep_dt_end')),
+        (apps.get_model('slogger', 'Meal'), ('dt', 'dt_end'), ('meal_dt', 'meal_dt_end')),
+        (apps.get_model('slogger', 'Diaper'), ('dt',), ('diaper_dt',)),
+    )
+
+    for child in Child.objects.all():
+        values = {}
+        for model, columns, fields in sources:
+            row = model.objects.filter(child=child).order_by('-dt', '-id').values_list(*columns).first()
+            values.update(zip(fields, row or (None,)*len(fields)))
+        ChildState.objects.create(child=child, **values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slogger', '0015_childdataversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChildState',
+            fields=[
+                ('child', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='slogger.child')),
+                ('sleep_dt', models.DateTimeField(null=True)),
+                ('sleep_dt_end', models.DateTimeField(null=True)),
+                ('meal_dt', models.DateTimeField(null=True)),
+                ('meal_dt_end', models.DateTimeField(null=True)),
+                ('diaper_dt', models.DateTimeField(null=True)),
+                ('sleep', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='slogger.sleepphase')),
+            ],
+        ),
+        migrations.RunPython(create_states, migrations.RunPython.noop),
+    ]
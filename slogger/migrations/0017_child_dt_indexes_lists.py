@@ -0,0 +1,25 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slogger', '0016_childstate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='diaryentry',
+            index=models.Index(fields=['child', 'dt'], name='slogger_dia_child_i_2994d1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['child', 'dt'], name='slogger_eve_child_i_30ff6e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='measurement',
+            index=models.Index(fields=['child', 'dt'], name='slogger_mea_child_i_963949_idx'),
+        ),
+    ]
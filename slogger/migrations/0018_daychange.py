@@ -0,0 +1,26 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slogger', '0017_child_dt_indexes_lists'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DayChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('child', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='slogger.child')),
+            ],
+            options={
+                'unique_together': {('child', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:21
+
+from django.db import migrations
+
+
+def remove_duplicate_percentiles(apps, schema_editor):
+    # Loading the percentiles again added rows for the same days, of which
+    # the latest ones were used.
+    Percentile = apps.get_model('slogger', 'Percentile')
+
+    seen = set()
+    duplicates = []
+    rows = Percentile.objects.order_by('-dt', '-id').values_list('id', 'gender', 'm_type', 'day')
+    for id, *key in rows.iterator():
+        key = tuple(key)
+        if key in seen:
+            duplicates.append(id)
+        seen.add(key)
+
+    for i in range(0, len(duplicates), 500):
+        Percentile.objects.filter(id__in=duplicates[i:i+500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slogger', '0018_daychange'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_percentiles, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='percentile',
+            unique_together={('gender', 'm_type', 'day')},
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.1.13 on 2026-10-18 10:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_counters(apps, schema_editor):
+    ChildState = apps.get_model('slogger', 'ChildState')
+    Measurement = apps.get_model('slogger', 'Measurement')
+
+    counters = (
+        (apps.get_model('slogger', 'SleepPhase'), 'sleep_count'),
+        (apps.get_model('slogger', 'Meal'), 'meal_count'),
+        (apps.get_model('slogger', 'Diaper'), 'diaper_count'),
+    )
+
+    for state in ChildState.objects.all():
+        for model, field in counters:
+            setattr(state, field, model.objects.filter(child=state.child_id).count())
+        state.measurement_id = Measurement.objects.filter(child=state.child_id) \
+                                                  .order_by('-dt', '-id').values_list('id', flat=True).first()
+        state.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slogger', '0019_percentile_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='childstate',
+            name='diaper_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='childstate',
+            name='meal_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='childstate',
+            name='measurement',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='slogger.measurement'),
+        ),
+        migrations.AddField(
+            model_name='childstate',
+            name='sleep_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
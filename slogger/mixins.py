@@ -1,9 +1,8 @@
-from django.shortcuts import get_object_or_404
 from django.core.exceptions import PermissionDenied
 from django.http import JsonResponse
-from django.utils import timezone as tz
 
 from . import models
+from . import decorators
 
 
 class AddChildContextViewMixin:
@@ -12,28 +11,24 @@ class AddChildContextViewMixin:
     error if the selected child does not have the current user as parent.
     """
 
+    def dispatch(self, request, *args, **kwargs):
+        # Checked here as well, so the JSON of get_json is covered too.
+        if request.user.is_authenticated and kwargs.get('child_id'):
+            decorators.authorize_child(request, kwargs['child_id'])
+        return super().dispatch(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         if self.request.user.is_authenticated:
 
             child = None
-            child_id = ''
-
-            try:
-                child_id = self.kwargs['child_id']
-            except KeyError:
-                pass
+            child_id = self.kwargs.get('child_id')
 
             if child_id:
-                child = get_object_or_404(models.Child, id=child_id)
-
-            children = models.Child.objects.filter(parents__id=self.request.user.id)
-
-            if child and not (child in children or self.request.user == child.created_by ):
-                raise PermissionDenied("Invalid child requested")
+                child = decorators.get_child(self.request, child_id)
 
             context["child"] = child
-            context["children"] = children
+            context["children"] = models.Child.objects.filter(parents__id=self.request.user.id)
 
         return context
 
@@ -43,6 +38,9 @@ class CheckObjectChildRelationMixin(AddChildContextViewMixin):
     Mixin to check whether the edited object was created by the current user.
     """
 
+    def get_queryset(self):
+        return super().get_queryset().filter(child=self.kwargs.get('child_id'))
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
@@ -51,7 +49,7 @@ class CheckObjectChildRelationMixin(AddChildContextViewMixin):
         except KeyError:
             raise PermissionDenied("Invalid child requested")
 
-        if self.object.child.id != child.id:
+        if self.object.child_id != child.id:
             raise PermissionDenied("Invalid child requested")
 
         return context
@@ -89,12 +87,12 @@ class SetChildIdFormMixin:
     """
 
     def form_valid(self, form):
-        form.instance.child = get_object_or_404(models.Child, id=self.kwargs.get('child_id'))
+        form.instance.child = decorators.get_child(self.request, self.kwargs.get('child_id'))
         return super().form_valid(form)
 
     def get_initial(self):
         initial = super().get_initial()
-        initial['child'] = models.Child.objects.get(id=self.kwargs.get('child_id'))
+        initial['child'] = decorators.get_child(self.request, self.kwargs.get('child_id'))
         return initial
 
 
@@ -134,6 +132,18 @@ class AttributeModelMixin:
                 if field.name not in self.SKIP_FIELDS ]
 
 
+class ChildDataETagMixin:
+    """
+    Mixin to answer repeated AJAX requests of a child's list view with
+    304 Not Modified while its data did not change. Must come before
+    AjaxableResponseMixin.
+    """
+    def get(self, request, *args, **kwargs):
+        get = super().get
+        if request.is_ajax():
+            get = decorators.child_data_etag()(get)
+        return get(request, *args, **kwargs)
+
 class AjaxableResponseMixin:
     """
     Mixin to add AJAX support to a (form) view.
@@ -179,32 +189,6 @@ class DurationModelMixin:
         else:
             return 0
 
-    def duration_sec_day(self, tomorrow=False):
-        if self.dt_end and self.dt:
-            start = tz.localtime(self.dt)
-            end = tz.localtime(self.dt_end)
-
-            startdate = start.date()
-            enddate = end.date()
-
-            if end - start > tz.timedelta(days=1):
-                raise ValueError("Durations > 1 day are not supported.")
-
-            if startdate != enddate:
-                if not tomorrow:
-                    d = start
-                    end = tz.make_aware(tz.datetime(d.year,d.month,d.day)+tz.timedelta(days=1))
-                else:
-                    d = start
-                    start = tz.make_aware(tz.datetime(d.year,d.month,d.day)+tz.timedelta(days=1))
-            else:
-                if tomorrow:
-                    return 0
-
-            return (end - start).total_seconds()
-        else:
-            return 0
-
     def duration_hhmm(self):
         d = ""
         sec = self.duration_sec()
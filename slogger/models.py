@@ -1,12 +1,24 @@
-from django.db import models
-from django.db.models import signals
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.db.models import signals, Case, Count, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate, TruncTime
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
 
 from django.utils import timezone as tz
 
+from datetime import time, timedelta
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
+from time import monotonic
+import hashlib
+import threading
+
 from .mixins import AttributeModelMixin, DurationModelMixin
+from . import functions
 
 class UserSettings(models.Model,
                    AttributeModelMixin):
@@ -46,6 +58,89 @@ def default_settings(sender, instance, created, **kwargs):
         defaults.save()
 
 
+# Seconds for which a process keeps the settings of a user. Changes made in
+# another process are seen after at most this long.
+USER_SETTINGS_SECONDS = 30
+
+# Users whose settings a process keeps, the least recently used are dropped.
+USER_SETTINGS_CACHE_SIZE = 1000
+
+_user_settings = OrderedDict()
+
+
+def _shared_settings_cache():
+    alias = getattr(settings, "SLOGGER_SETTINGS_CACHE", None)
+    return caches[alias] if alias else None
+
+
+def _settings_key(user_id):
+    return f"slogger-usersettings-{user_id}"
+
+
+def _settings_values(s):
+    return { f.attname: getattr(s, f.attname) for f in UserSettings._meta.concrete_fields }
+
+
+def user_settings(user_id):
+    """
+    Returns the UserSettings of a user, from this process, the cache named
+    by settings.SLOGGER_SETTINGS_CACHE or the database, in that order. Every
+    call returns a new instance. Users without settings get unsaved
+    defaults.
+    """
+    now = monotonic()
+    entry = _user_settings.get(user_id)
+
+    if entry and entry[0] > now:
+        values = entry[1]
+    else:
+        cache = _shared_settings_cache()
+        values = cache.get(_settings_key(user_id)) if cache else None
+
+        if values is None:
+            s = UserSettings.objects.filter(user=user_id).first()
+            if s is None:
+                return UserSettings(user_id=user_id)
+            values = _settings_values(s)
+            if cache:
+                cache.set(_settings_key(user_id), values)
+
+        _user_settings[user_id] = (now + USER_SETTINGS_SECONDS, values)
+
+    _user_settings.move_to_end(user_id)
+    while len(_user_settings) > USER_SETTINGS_CACHE_SIZE:
+        _user_settings.popitem(last=False)
+
+    # Fields missing in values cached before a migration are deferred.
+    return UserSettings.from_db(DEFAULT_DB_ALIAS, list(values), list(values.values()))
+
+
+def invalidate_user_settings(*user_ids):
+    """
+    Drops the settings of the given users, or of all, kept by this process.
+    """
+    if user_ids:
+        for user_id in user_ids:
+            _user_settings.pop(user_id, None)
+    else:
+        _user_settings.clear()
+
+
+@receiver(signals.post_save, sender=UserSettings)
+@receiver(signals.post_delete, sender=UserSettings)
+def invalidate_user_settings_on_change(sender, instance, signal, **kwargs):
+    invalidate_user_settings(instance.user_id)
+
+    cache = _shared_settings_cache()
+    if cache:
+        key = _settings_key(instance.user_id)
+        if signal is signals.post_delete:
+            transaction.on_commit(lambda: cache.delete(key))
+        else:
+            values = _settings_values(instance)
+            transaction.on_commit(lambda: cache.set(key, values))
+
+
 class Child(models.Model,
             AttributeModelMixin):
 
@@ -84,6 +179,9 @@ class SleepPhase(models.Model,
     dt_end = models.DateTimeField("End", null=True, blank=True)
     comment = models.TextField("Comment", max_length=2000, null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["child", "dt"])]
+
     def add(self, child=None, dt=None, dt_end=None):
         self.child = child
         self.dt = dt
@@ -108,6 +206,9 @@ class Measurement(models.Model,
     height = models.FloatField("Height (cm)", null=True, blank=True)
     comment = models.TextField("Comment", max_length=2000, null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["child", "dt"])]
+
     def __str__(self):
         return str(self.child.name) + " - " + \
                str(tz.localdate(self.dt)) + " - Weight: " + str(self.weight) \
@@ -138,6 +239,9 @@ class Meal(models.Model,
     dt_end = models.DateTimeField("Eaten until", default=None, null=True, blank=True)
     comment = models.TextField("Comment", max_length=2000, null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["child", "dt"])]
+
     def __str__(self):
         return str(self.child.name) + " - " + str(tz.localtime(self.dt))
 
@@ -177,6 +281,9 @@ class Diaper(models.Model,
     diaper_type = models.ForeignKey(DiaperType, null=True, blank=True, on_delete=models.CASCADE)
     comment = models.TextField("Comment", max_length=2000, null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["child", "dt"])]
+
     def __str__(self):
         return str(self.child.name) + " - " + \
                str(tz.localtime(self.dt).date()) + " " + \
@@ -193,6 +300,9 @@ class Event(models.Model,
     event = models.CharField("Name", max_length=100)
     description = models.TextField("Description", max_length=2000, null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["child", "dt"])]
+
     def __str__(self):
         return str(self.child.name) + " - " + \
                str(tz.localdate(self.dt)) + " " + self.event
@@ -206,6 +316,9 @@ class DiaryEntry(models.Model,
     title = models.CharField("Title", max_length=100)
     content = models.TextField("Entry")
 
+    class Meta:
+        indexes = [models.Index(fields=["child", "dt"])]
+
     def __str__(self):
         return str(self.child.name) + " - " + \
                str(tz.localdate(self.dt)) + " " + self.title
@@ -240,4 +353,712 @@ class Percentile(models.Model):
     p95 = models.FloatField()
     p97 = models.FloatField()
     p99 = models.FloatField()
-    p999 = models.FloatField()
\ No newline at end of file
+    p999 = models.FloatField()
+
+    class Meta:
+        unique_together = [("gender", "m_type", "day")]
+
+class DailySummary(models.Model):
+    """
+    Per-day totals of sleep phases, meals or diapers of a child. The rows are
+    kept up to date by the signal handlers below, day/night are split by the
+    hours set up by the child's creator.
+    """
+
+    SERIES_CHOICES=[
+        ("sleep", "Sleep"),
+        ("meals", "Meals"),
+        ("diapers", "Diapers"),
+    ]
+
+    child = models.ForeignKey(Child, on_delete=models.CASCADE)
+    series = models.CharField(max_length=10, choices=SERIES_CHOICES)
+    day = models.DateField()
+
+    h_day = models.IntegerField(default=8)
+    h_night = models.IntegerField(default=19)
+
+    sum_count = models.IntegerField(default=0)
+    sum_time = models.FloatField(default=0)
+    sum_interval = models.FloatField(default=0)
+    day_count = models.IntegerField(default=0)
+    day_time = models.FloatField(default=0)
+    day_interval = models.FloatField(default=0)
+    night_count = models.IntegerField(default=0)
+    night_time = models.FloatField(default=0)
+    night_interval = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = [("child", "series", "day")]
+
+    def __str__(self):
+        return f"{ self.child_id } - { self.day } - { self.series }"
+
+    def as_totals(self):
+        return {
+            c: {
+                'count': getattr(self, c + '_count'),
+                'time': getattr(self, c + '_time'),
+                'interval': getattr(self, c + '_interval'),
+            } for c in functions.DailyTotals.CATEGORIES
+        }
+
+    def as_duration_totals(self):
+        return {
+            c: {
+                'time': getattr(self, c + '_time'),
+                'count': getattr(self, c + '_count'),
+            } for c in functions.DailyTotals.CATEGORIES
+        }
+
+
+class ChildDataVersion(models.Model):
+    """
+    Increased on every change of a child's records, the JSON endpoints
+    derive their ETags from it. Created along with the child.
+    """
+    child = models.OneToOneField(Child, primary_key=True, on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(default=0)
+    changed = models.DateTimeField(default=tz.now)
+
+    def __str__(self):
+        return f"{ self.child_id } - { self.version }"
+
+
+class DayChange(models.Model):
+    """
+    The data version at which the records of a local day of a child last
+    changed, so clients can ask for the days changed since a version.
+    """
+    child = models.ForeignKey(Child, on_delete=models.CASCADE)
+    day = models.DateField()
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [("child", "day")]
+
+    def __str__(self):
+        return f"{ self.child_id } - { self.day } - { self.version }"
+
+
+class ChildState(models.Model):
+    """
+    The latest sleep phase, meal, diaper and measurement of a child and the
+    number of its sleep phases, meals and diapers, kept up to date by the
+    signal handlers below so the check endpoints and the child page need a
+    single read. Created along with the child.
+    """
+    child = models.OneToOneField(Child, primary_key=True, on_delete=models.CASCADE)
+    sleep = models.ForeignKey(SleepPhase, null=True, on_delete=models.SET_NULL, related_name="+")
+    sleep_dt = models.DateTimeField(null=True)
+    sleep_dt_end = models.DateTimeField(null=True)
+    meal_dt = models.DateTimeField(null=True)
+    meal_dt_end = models.DateTimeField(null=True)
+    diaper_dt = models.DateTimeField(null=True)
+    measurement = models.ForeignKey(Measurement, null=True, on_delete=models.SET_NULL, related_name="+")
+
+    sleep_count = models.IntegerField(default=0)
+    meal_count = models.IntegerField(default=0)
+    diaper_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{ self.child_id } - { self.sleep_id }"
+
+    def latest_rows(self):
+        """
+        Returns the latest sleep phase as (id, dt, dt_end), meal as
+        (id, dt, dt_end) and diaper as (id, dt) tuple, or None if there are
+        none. The ids of meals and diapers are not kept and always None.
+        """
+        return (
+            (self.sleep_id, self.sleep_dt, self.sleep_dt_end) if self.sleep_dt else None,
+            (None, self.meal_dt, self.meal_dt_end) if self.meal_dt else None,
+            (None, self.diaper_dt) if self.diaper_dt else None,
+        )
+
+
+SUMMARY_SOURCES = {
+    "sleep": SleepPhase,
+    "meals": Meal,
+    "diapers": Diaper,
+}
+
+
+def summary_hours(child_id):
+    hours = UserSettings.objects.filter(user__created_by__id=child_id) \
+                                .values_list("start_hour_day", "start_hour_night").first()
+    return hours or (8, 19)
+
+
+def local_midnight(day):
+    return tz.make_aware(tz.datetime(day.year, day.month, day.day))
+
+
+def interval_fields(model):
+    if issubclass(model, DurationModelMixin):
+        return ("dt", "dt_end")
+    return ("dt",)
+
+
+ROW_CHUNK_SIZE = 2000
+
+
+def interval_rows(queryset):
+    """
+    Streams (dt, dt_end) tuples from a queryset of sleep phases, meals or
+    diapers without instantiating the model objects.
+    """
+    fields = interval_fields(queryset.model)
+    return functions.as_intervals(queryset.values_list(*fields).iterator(chunk_size=ROW_CHUNK_SIZE))
+
+
+def aggregate_daily_sql(queryset, h_day=None, h_night=None, boundaries=None):
+    """
+    Same as functions.aggregate_daily, but lets the database group the records
+    of a queryset by local day and day/night and sum up their counts,
+    durations and intervals. Only durations crossing midnight are moved to the
+    following days in Python.
+    """
+    days = functions.day_boundaries(h_day, h_night, boundaries)
+    has_end = interval_fields(queryset.model) == ("dt", "dt_end")
+    last_end = Coalesce("dt_end", "dt") if has_end else F("dt")
+
+    # Equal timestamps are ordered by id, as done by calculate_totals.
+    previous = queryset.filter(
+        Q(dt__lt=OuterRef("dt")) | Q(dt=OuterRef("dt"), id__lt=OuterRef("id"))
+    ).order_by("-dt", "-id").annotate(last_end=last_end).values("last_end")[:1]
+
+    queryset = queryset.annotate(
+        day=TruncDate("dt"),
+        end_day=TruncDate(last_end),
+        local_time=TruncTime("dt"),
+    ).annotate(
+        is_day=Case(
+            When(local_time__gte=time(days.h_day), local_time__lte=time(days.h_night), then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField(),
+        ),
+    )
+
+    # Durations crossing midnight are left out here and split below.
+    rows = queryset.annotate(
+        previous_end=Subquery(previous, output_field=models.DateTimeField()),
+    ).annotate(
+        record_interval=Case(
+            When(previous_end__isnull=True, then=Value(None)),
+            When(previous_end__lt=F("dt"),
+                 then=ExpressionWrapper(F("dt") - F("previous_end"), output_field=models.DurationField())),
+            default=Value(timedelta(0), models.DurationField()),
+            output_field=models.DurationField(),
+        ),
+        record_time=Case(
+            When(end_day__lte=F("day"),
+                 then=ExpressionWrapper(F("dt_end") - F("dt"), output_field=models.DurationField())),
+            default=Value(None),
+            output_field=models.DurationField(),
+        ) if has_end else Value(None, models.DurationField()),
+    ).order_by().values("day", "is_day").annotate(
+        count=Count("id"),
+        time=Sum("record_time"),
+        interval=Sum("record_interval"),
+    )
+
+    acc = functions.DailyTotals()
+
+    present = acc.present
+    count_sum, count_day, count_night = acc.count
+    time_sum, time_day, time_night = acc.time
+    interval_sum, interval_day, interval_night = acc.interval
+
+    for row in rows:
+        i = acc.index(row["day"].toordinal())
+
+        if row["is_day"]:
+            count_key, time_key, interval_key = count_day, time_day, interval_day
+        else:
+            count_key, time_key, interval_key = count_night, time_night, interval_night
+
+        present[i] = 1
+        count_sum[i] += row["count"]
+        count_key[i] += row["count"]
+
+        if row["time"] is not None:
+            secs = row["time"].total_seconds()
+            time_sum[i] += secs
+            time_key[i] += secs
+
+        if row["interval"] is not None:
+            secs = row["interval"].total_seconds()
+            interval_sum[i] += secs
+            interval_key[i] += secs
+
+    if not has_end:
+        return acc
+
+    crossing = queryset.filter(end_day__gt=F("day")).values_list("dt", "dt_end", "is_day")
+
+    for dt, dt_end, is_day in crossing.iterator(chunk_size=ROW_CHUNK_SIZE):
+        time_key = time_day if is_day else time_night
+
+        for ordinal, secs in days.split(dt, dt_end):
+            j = acc.index(ordinal)
+            present[j] = 1
+            time_sum[j] += secs
+            time_key[j] += secs
+
+    return acc
+
+
+def update_daily_summaries(series, child_id, first_day=None, last_day=None, hours=None):
+    """
+    Recalculates the DailySummary rows of one series between first_day and
+    last_day (both local dates, None for the whole history) from the raw
+    records. Records of the previous day and the last record before are taken
+    into account as well, since they affect carried durations and intervals.
+    """
+    h_day, h_night = hours or summary_hours(child_id)
+    data = SUMMARY_SOURCES[series].objects.filter(child=child_id).order_by("dt")
+    rows = DailySummary.objects.filter(child=child_id, series=series)
+
+    if first_day:
+        start = local_midnight(first_day - tz.timedelta(days=1))
+        end = local_midnight(last_day + tz.timedelta(days=1))
+
+        previous = list(interval_rows(data.filter(dt__lt=start).reverse()[:1]))
+        intervals = previous + list(interval_rows(data.filter(dt__gte=start, dt__lt=end)))
+        rows = rows.filter(day__range=[first_day, last_day])
+    else:
+        intervals = interval_rows(data)
+
+    totals = functions.aggregate_daily(intervals, h_day, h_night)
+
+    summaries = []
+    for i, day in totals.days():
+        if first_day and not first_day <= day <= last_day:
+            continue
+
+        s = DailySummary(child_id=child_id, series=series, day=day, h_day=h_day, h_night=h_night)
+        for k, c in enumerate(totals.CATEGORIES):
+            setattr(s, c + '_count', totals.count[k][i])
+            setattr(s, c + '_time', totals.time[k][i])
+            setattr(s, c + '_interval', totals.interval[k][i])
+        summaries.append(s)
+
+    with transaction.atomic():
+        rows.delete()
+        DailySummary.objects.bulk_create(summaries)
+
+
+def rebuild_daily_summaries(child_id):
+    hours = summary_hours(child_id)
+    for series in SUMMARY_SOURCES:
+        update_daily_summaries(series, child_id, hours=hours)
+
+
+def _affected_days(model, child_id, dt, dt_end):
+    """
+    Returns the range of local days whose totals depend on a record at dt:
+    the day it starts on, the day it ends on and the day of the next record,
+    whose interval is measured from it.
+    """
+    first_day = tz.localdate(dt)
+    last_day = first_day + tz.timedelta(days=1)
+
+    if dt_end:
+        last_day = max(last_day, tz.localdate(dt_end))
+
+    following = model.objects.filter(child=child_id, dt__gt=dt) \
+                             .order_by("dt").values_list("dt", flat=True).first()
+    if following:
+        last_day = max(last_day, tz.localdate(following))
+
+    return first_day, last_day
+
+
+def _update_affected_days(sender, child_id, dt, dt_end=None):
+    series = [ k for k, v in SUMMARY_SOURCES.items() if v == sender ][0]
+    update_daily_summaries(series, child_id, *_affected_days(sender, child_id, dt, dt_end))
+
+
+@receiver(signals.pre_save, sender=SleepPhase)
+@receiver(signals.pre_save, sender=Meal)
+@receiver(signals.pre_save, sender=Diaper)
+@receiver(signals.pre_save, sender=Measurement)
+@receiver(signals.pre_save, sender=Event)
+@receiver(signals.pre_save, sender=DiaryEntry)
+def remember_summary_position(sender, instance, **kwargs):
+    instance._summary_previous = None
+
+    if instance.pk:
+        fields = ("child_id",) + interval_fields(sender)
+        instance._summary_previous = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+@receiver(signals.post_save, sender=SleepPhase)
+@receiver(signals.post_save, sender=Meal)
+@receiver(signals.post_save, sender=Diaper)
+def update_summary_on_save(sender, instance, **kwargs):
+    current = (instance.child_id,) + tuple(getattr(instance, f) for f in interval_fields(sender))
+    previous = getattr(instance, "_summary_previous", None)
+
+    if previous and previous != current:
+        _update_affected_days(sender, *previous)
+
+    _update_affected_days(sender, *current)
+
+
+@receiver(signals.post_delete, sender=SleepPhase)
+@receiver(signals.post_delete, sender=Meal)
+@receiver(signals.post_delete, sender=Diaper)
+def update_summary_on_delete(sender, instance, **kwargs):
+    if child_deleted(instance.child_id):
+        return
+
+    _update_affected_days(sender, instance.child_id, instance.dt, getattr(instance, "dt_end", None))
+
+
+@receiver(signals.post_save, sender=UserSettings)
+def update_summary_hours(sender, instance, **kwargs):
+    hours = (instance.start_hour_day, instance.start_hour_night)
+
+    for child in Child.objects.filter(created_by=instance.user_id):
+        outdated = DailySummary.objects.filter(child=child) \
+                                       .exclude(h_day=hours[0], h_night=hours[1])
+        if outdated.exists():
+            for series in SUMMARY_SOURCES:
+                update_daily_summaries(series, child.id, hours=hours)
+
+
+# Seconds after which a process checks whether another process changed the
+# percentile table since it was loaded.
+PERCENTILE_CHECK_SECONDS = 300
+
+_percentiles = {
+    'curves': None,
+    'stamp': None,
+    'digest': None,
+    'checked': 0,
+}
+
+
+def _percentile_stamp():
+    return tuple(Percentile.objects.aggregate(
+        count=models.Count("id"), last_id=models.Max("id"), last_dt=models.Max("dt")).values())
+
+
+def invalidate_percentiles():
+    _percentiles['curves'] = None
+
+
+def _percentile_table():
+    now = monotonic()
+
+    if _percentiles['curves'] is not None and now - _percentiles['checked'] > PERCENTILE_CHECK_SECONDS:
+        _percentiles['checked'] = now
+        if _percentile_stamp() != _percentiles['stamp']:
+            invalidate_percentiles()
+
+    if _percentiles['curves'] is None:
+        stamp = _percentile_stamp()
+        rows = Percentile.objects.order_by("gender", "m_type", "day").values_list(
+            "gender", "m_type", "day", *functions.PercentileCurves.COLUMNS)
+
+        curves = {
+            key: functions.PercentileCurves(r[2:] for r in group)
+            for key, group in groupby(rows.iterator(chunk_size=ROW_CHUNK_SIZE), key=itemgetter(0, 1))
+        }
+
+        digest = hashlib.sha1()
+        for key in sorted(curves):
+            digest.update(repr(key).encode())
+            for c in functions.PercentileCurves.COLUMNS:
+                digest.update(curves[key].columns[c].tobytes())
+
+        _percentiles['curves'] = curves
+        _percentiles['stamp'] = stamp
+        _percentiles['digest'] = digest.hexdigest()
+        _percentiles['checked'] = now
+
+    return _percentiles
+
+
+def percentile_curves(gender, m_type):
+    """
+    Returns the functions.PercentileCurves of a gender and measurement type.
+    All curves are loaded at once and kept for the lifetime of the process,
+    until they are invalidated or another process changed the table.
+    """
+    return _percentile_table()['curves'].get((gender, m_type)) or functions.PercentileCurves([])
+
+
+def percentile_digest():
+    """
+    Returns a digest of the loaded percentile curves.
+    """
+    return _percentile_table()['digest']
+
+
+@receiver(signals.post_save, sender=Percentile)
+@receiver(signals.post_delete, sender=Percentile)
+def invalidate_percentiles_on_change(sender, **kwargs):
+    invalidate_percentiles()
+
+
+# Seconds for which a granted access to a child is remembered, so polling
+# requests don't check it again every time. Removing a parent takes effect
+# in other processes after at most this long.
+CHILD_ACCESS_SECONDS = 60
+
+# Remembered accesses above which the expired ones are dropped.
+CHILD_ACCESS_MAX_ENTRIES = 10000
+
+_child_access = {}
+_child_access_lock = threading.Lock()
+
+
+def has_child_access(user, child_id):
+    """
+    Returns whether the user is a parent or the creator of the child, with
+    one query at most.
+    """
+    key = (user.id, child_id)
+    now = monotonic()
+
+    if _child_access.get(key, 0) > now:
+        return True
+
+    allowed = Child.objects.filter(Q(parents=user.id) | Q(created_by=user.id), id=child_id).exists()
+
+    if allowed:
+        with _child_access_lock:
+            if len(_child_access) >= CHILD_ACCESS_MAX_ENTRIES:
+                for k in [ k for k, expires in _child_access.items() if expires <= now ]:
+                    del _child_access[k]
+            _child_access[key] = now + CHILD_ACCESS_SECONDS
+
+    return allowed
+
+
+@receiver(signals.post_save, sender=Child)
+@receiver(signals.post_delete, sender=Child)
+@receiver(signals.m2m_changed, sender=Child.parents.through)
+def forget_child_access(sender, **kwargs):
+    with _child_access_lock:
+        _child_access.clear()
+
+
+# Children whose records are being deleted along with them, by thread.
+_deleting = threading.local()
+
+
+def child_deleted(child_id):
+    """
+    Returns whether the child is being deleted. The signal handlers of its
+    records have nothing to keep up to date then, and return early.
+    """
+    return child_id in getattr(_deleting, "children", ())
+
+
+@receiver(signals.pre_delete, sender=Child)
+def remember_child_deletion(sender, instance, **kwargs):
+    if not hasattr(_deleting, "children"):
+        _deleting.children = set()
+    _deleting.children.add(instance.id)
+
+
+@receiver(signals.post_delete, sender=Child)
+def forget_child_deletion(sender, instance, **kwargs):
+    getattr(_deleting, "children", set()).discard(instance.id)
+
+
+def data_version(child_id):
+    """
+    Returns the version of a child's data and when it last changed. A child
+    without a version gets one, so the following changes bump it.
+    """
+    v = ChildDataVersion.objects.filter(child=child_id).values_list("version", "changed").first()
+    if v is None:
+        row, created = ChildDataVersion.objects.get_or_create(child_id=child_id)
+        v = (row.version, row.changed)
+    return v
+
+
+def bump_data_version(*child_ids):
+    ChildDataVersion.objects.filter(child__in=child_ids).update(version=models.F("version") + 1, changed=tz.now())
+
+
+@receiver(signals.m2m_changed, sender=Meal.food.through)
+@receiver(signals.m2m_changed, sender=Diaper.content.through)
+def bump_data_version_on_m2m_change(sender, instance, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear") and hasattr(instance, "child_id"):
+        bump_data_version(instance.child_id)
+
+
+def changed_days(sender, child_id, dt, dt_end=None):
+    """
+    Returns the local days whose summary depends on a record at dt.
+    """
+    if sender not in SUMMARY_SOURCES.values():
+        return [ tz.localdate(dt) ]
+
+    first_day, last_day = _affected_days(sender, child_id, dt, dt_end)
+    return [ first_day + timedelta(days=k) for k in range((last_day - first_day).days + 1) ]
+
+
+def record_day_changes(child_id, days):
+    """
+    Bumps the data version of the child and marks the days as changed in
+    it. Both are committed together, so a client that gets the new version
+    as its token has been sent the days changed in it.
+    """
+    with transaction.atomic():
+        bump_data_version(child_id)
+        version = ChildDataVersion.objects.filter(child=child_id).values_list("version", flat=True).first()
+        if version is None:
+            return
+
+        DayChange.objects.bulk_create([
+            DayChange(child_id=child_id, day=day, version=version) for day in set(days)
+        ], ignore_conflicts=True)
+        DayChange.objects.filter(child=child_id, day__in=set(days)).update(version=version)
+
+
+@receiver(signals.post_save, sender=SleepPhase)
+@receiver(signals.post_save, sender=Meal)
+@receiver(signals.post_save, sender=Diaper)
+@receiver(signals.post_save, sender=Measurement)
+@receiver(signals.post_save, sender=Event)
+@receiver(signals.post_save, sender=DiaryEntry)
+def record_day_changes_on_save(sender, instance, **kwargs):
+    current = (instance.child_id,) + tuple(getattr(instance, f) for f in interval_fields(sender))
+    previous = getattr(instance, "_summary_previous", None)
+
+    days = changed_days(sender, *current)
+    if previous and previous != current:
+        days += changed_days(sender, *previous)
+
+    record_day_changes(instance.child_id, days)
+
+
+@receiver(signals.post_delete, sender=SleepPhase)
+@receiver(signals.post_delete, sender=Meal)
+@receiver(signals.post_delete, sender=Diaper)
+@receiver(signals.post_delete, sender=Measurement)
+@receiver(signals.post_delete, sender=Event)
+@receiver(signals.post_delete, sender=DiaryEntry)
+def record_day_changes_on_delete(sender, instance, **kwargs):
+    if child_deleted(instance.child_id):
+        return
+
+    days = changed_days(sender, instance.child_id, instance.dt, getattr(instance, "dt_end", None))
+    record_day_changes(instance.child_id, days)
+
+
+@receiver(signals.post_save, sender=Child)
+def bump_data_version_on_child_change(sender, instance, created, **kwargs):
+    if created:
+        ChildDataVersion.objects.get_or_create(child=instance)
+        ChildState.objects.get_or_create(child=instance)
+    else:
+        # Age and gender select the percentiles.
+        bump_data_version(instance.id)
+
+
+@receiver(signals.post_save, sender=Food)
+@receiver(signals.post_save, sender=DiaperContent)
+@receiver(signals.post_save, sender=DiaperType)
+def bump_data_version_on_choice_change(sender, instance, created, **kwargs):
+    # Their names are part of the meal and diaper data.
+    if created:
+        return
+
+    if sender is Food:
+        children = Meal.objects.filter(food=instance)
+    elif sender is DiaperContent:
+        children = Diaper.objects.filter(content=instance)
+    else:
+        children = Diaper.objects.filter(diaper_type=instance)
+
+    bump_data_version(*children.values_list("child_id", flat=True).distinct())
+
+
+STATE_SOURCES = (
+    (SleepPhase, ("id", "dt", "dt_end"), ("sleep_id", "sleep_dt", "sleep_dt_end")),
+    (Meal, ("dt", "dt_end"), ("meal_dt", "meal_dt_end")),
+    (Diaper, ("dt",), ("diaper_dt",)),
+    (Measurement, ("id",), ("measurement_id",)),
+)
+
+STATE_COUNTERS = {
+    SleepPhase: "sleep_count",
+    Meal: "meal_count",
+    Diaper: "diaper_count",
+}
+
+
+def compute_child_state(child_id, *sources):
+    """
+    Returns the ChildState fields of a child, computed from the raw tables.
+    Only the fields of the given models are returned, if any. The counters
+    are only computed for the whole state, the signal handlers keep them up
+    to date without counting.
+    """
+    values = {}
+
+    for model, columns, fields in STATE_SOURCES:
+        if sources and model not in sources:
+            continue
+        row = model.objects.filter(child=child_id).order_by("-dt", "-id").values_list(*columns).first()
+        values.update(zip(fields, row or (None,)*len(fields)))
+
+    if not sources:
+        for model, field in STATE_COUNTERS.items():
+            values[field] = model.objects.filter(child=child_id).count()
+
+    return values
+
+
+def update_child_state(child_id, *sources):
+    """
+    Recomputes the ChildState of a child, or only the fields of the given
+    models. The row is locked while doing so, so concurrent writes are
+    applied one after the other.
+    """
+    with transaction.atomic():
+        if ChildState.objects.select_for_update().filter(child=child_id).exists():
+            ChildState.objects.filter(child=child_id).update(**compute_child_state(child_id, *sources))
+
+
+@receiver(signals.post_save, sender=SleepPhase)
+@receiver(signals.post_save, sender=Meal)
+@receiver(signals.post_save, sender=Diaper)
+@receiver(signals.post_save, sender=Measurement)
+@receiver(signals.post_delete, sender=SleepPhase)
+@receiver(signals.post_delete, sender=Meal)
+@receiver(signals.post_delete, sender=Diaper)
+@receiver(signals.post_delete, sender=Measurement)
+def update_child_state_on_change(sender, instance, **kwargs):
+    if child_deleted(instance.child_id):
+        return
+
+    update_child_state(instance.child_id, sender)
+
+
+@receiver(signals.post_save, sender=SleepPhase)
+@receiver(signals.post_save, sender=Meal)
+@receiver(signals.post_save, sender=Diaper)
+def count_child_records_on_save(sender, instance, created, **kwargs):
+    if created:
+        field = STATE_COUNTERS[sender]
+        ChildState.objects.filter(child=instance.child_id).update(**{ field: F(field) + 1 })
+
+
+@receiver(signals.post_delete, sender=SleepPhase)
+@receiver(signals.post_delete, sender=Meal)
+@receiver(signals.post_delete, sender=Diaper)
+def count_child_records_on_delete(sender, instance, **kwargs):
+    if child_deleted(instance.child_id):
+        return
+
+    field = STATE_COUNTERS[sender]
+    ChildState.objects.filter(child=instance.child_id).update(**{ field: F(field) - 1 })
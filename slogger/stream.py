@@ -0,0 +1,123 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import Http404
+
+from importlib import import_module
+import asyncio
+import io
+import re
+
+from . import decorators, events, helpers
+
+KEEPALIVE_SECONDS = 15
+
+STREAM_PATH = re.compile(r"^/(?P<child_id>[0-9]+)/data/stream/$")
+
+
+def authorize(scope, child_id):
+    """
+    Authenticates the request from its session cookie like the session and
+    authentication middlewares do and checks the access to the child.
+    Returns an HTTP status code if the request is denied, else None.
+    """
+    request = ASGIRequest(scope, io.BytesIO())
+    engine = import_module(settings.SESSION_ENGINE)
+    request.session = engine.SessionStore(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+
+    try:
+        decorators.check_child_access(auth.get_user(request), child_id)
+    except PermissionDenied:
+        return 403
+    except Http404:
+        return 404
+    finally:
+        close_old_connections()
+
+
+def current_state(child_id):
+    try:
+        return events.encode_state(helpers.fetch_child_state(child_id))
+    finally:
+        close_old_connections()
+
+
+async def send_status(send, status):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def child_state_stream(scope, receive, send, child_id):
+    """
+    Streams the state of a child as server-sent events: the current state
+    right away and a new one after every change of its sleep phases, meals
+    and diapers. The database is only queried when connecting, waiting for
+    changes costs nothing but the open connection.
+    """
+    if scope['method'] != 'GET':
+        await send_status(send, 405)
+        return
+
+    status = await sync_to_async(authorize)(scope, child_id)
+    if status:
+        await send_status(send, status)
+        return
+
+    # Subscribed before the state is fetched, so no change in between is
+    # missed.
+    backend = events.get_backend()
+    subscription = backend.subscribe(child_id)
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        subscription.close()
+
+    disconnect = asyncio.ensure_future(wait_for_disconnect())
+
+    try:
+        state = await sync_to_async(current_state)(child_id)
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+
+        while state is not None:
+            if state:
+                body = b"data: %s\n\n" % state
+            else:
+                body = b": keepalive\n\n"
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+            try:
+                state = await asyncio.wait_for(subscription.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                state = b""
+    finally:
+        backend.unsubscribe(subscription)
+        disconnect.cancel()
+
+
+def with_child_state_stream(application):
+    """
+    Wraps the Django ASGI application, answering the requests for
+    /<child_id>/data/stream/ itself.
+    """
+    async def app(scope, receive, send):
+        if scope['type'] == 'http':
+            match = STREAM_PATH.match(scope['path'])
+            if match:
+                await child_state_stream(scope, receive, send, int(match['child_id']))
+                return
+        await application(scope, receive, send)
+
+    return app
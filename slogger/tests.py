@@ -1,3 +1,1198 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone as tz
 
-# Create your tests here.
+from datetime import date, datetime, timedelta
+from unittest import mock
+import asyncio
+import io
+import json
+import os
+import pytz
+import random
+import tempfile
+import threading
+import unittest
+
+from . import events, functions, helpers, models, stream
+from .management.commands import load_percentiles, rebuild_rollups, summary_report
+
+
+def at(*args, **kwargs):
+    return tz.make_aware(datetime(*args), **kwargs)
+
+
+class ChildDataTestCase(TestCase):
+    """
+    A child with a few records of every kind, the client logged in as its
+    parent.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username="parent")
+        cls.other = get_user_model().objects.create(username="other parent")
+        cls.child = models.Child.objects.create(created_by=cls.user, name="Child",
+                                                birthday=date(2020, 1, 1), gender="F")
+        cls.child.parents.add(cls.user, cls.other)
+
+        cls.foods = [ models.Food.objects.create(created_by=cls.user, name=n) for n in ("Milk", "Mash") ]
+        cls.contents = [ models.DiaperContent.objects.create(created_by=cls.user, name=n) for n in ("Pee", "Poo") ]
+        cls.types = [ models.DiaperType.objects.create(created_by=cls.user, name=n) for n in ("Wet", "Dirty") ]
+
+        cls.start = tz.make_aware(datetime(2020, 1, 1, 9))
+        cls.add_days(0, 3)
+
+    @classmethod
+    def add_days(cls, first, count):
+        """
+        Adds a few records of every kind, with all their relations, for
+        each of the given days.
+        """
+        for day in range(first, first + count):
+            dt = cls.start + timedelta(days=day)
+            kwargs = { 'child': cls.child, 'created_by': cls.user }
+
+            models.SleepPhase.objects.create(dt=dt, dt_end=dt + timedelta(hours=2), **kwargs)
+            models.SleepPhase.objects.create(dt=dt + timedelta(hours=10), dt_end=dt + timedelta(hours=20), **kwargs)
+            for hour in (3, 7):
+                meal = models.Meal.objects.create(dt=dt + timedelta(hours=hour),
+                                                  dt_end=dt + timedelta(hours=hour, minutes=20), **kwargs)
+                meal.food.set(cls.foods)
+                diaper = models.Diaper.objects.create(dt=dt + timedelta(hours=hour, minutes=30),
+                                                      diaper_type=cls.types[hour % 2], **kwargs)
+                diaper.content.set(cls.contents)
+            models.Measurement.objects.create(dt=dt, weight=3.5 + day*0.01, height=50 + day*0.05, **kwargs)
+            models.Event.objects.create(dt=dt, event=f"Event {day}", **kwargs)
+            models.DiaryEntry.objects.create(dt=dt, title=f"Day {day}", content="Entry", **kwargs)
+
+    def setUp(self):
+        models.forget_child_access(sender=None)
+        models.has_child_access(self.user, self.child.id)
+        models.invalidate_user_settings()
+        models.user_settings(self.user.id)
+        self.client.force_login(self.user)
+
+    def get(self, name, params={}):
+        url = reverse(name, kwargs={} if name == 'children' else { 'child_id': self.child.id })
+        response = self.client.get(url, params, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 200, url)
+        return response
+
+
+class QueryBudgetTests(ChildDataTestCase):
+    """
+    Every list and data endpoint has to run a constant number of queries,
+    however many rows it returns. The budgets are the exact counts, so a
+    query added on purpose means updating the budget here, and one added by
+    accident (like a relation read per row) fails the test. The access to
+    the child and the user's settings are cached already, like for a client
+    polling the data.
+    """
+
+    # url name: queries of a request, or of a page of a list
+    BUDGETS = {
+        'children':             4,
+        'child':                5,
+        'sleepphases':          4,
+        'measurements':         4,
+        'meals':                5,
+        'diapers':              5,
+        'events':               4,
+        'diary':                4,
+        'check_data':           3,
+        'check_sleepphase':     4,
+        'summary_data_graph':   4,
+        'summary_data_list':    9,
+        'histogram_data':       6,
+        'heatmap_data':         6,
+        'dashboard_data':       7,
+        'measurement_data':     6,
+    }
+
+    PAGINATED = ('sleepphases', 'measurements', 'meals', 'diapers', 'events', 'diary')
+
+    def assertBudgets(self):
+        for name, budget in self.BUDGETS.items():
+            with self.subTest(endpoint=name):
+                with self.assertNumQueries(budget):
+                    self.get(name)
+
+        for name in self.PAGINATED:
+            with self.subTest(endpoint=name, page=True):
+                first = self.get(name, { 'limit': 2 }).json()
+                with self.assertNumQueries(self.BUDGETS[name]):
+                    self.get(name, { 'cursor': first['next'], 'limit': 2 })
+
+    def test_budgets(self):
+        self.assertBudgets()
+
+    def test_budgets_independent_of_row_count(self):
+        self.add_days(3, 10)
+        self.assertBudgets()
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', "Checks SQLite query plans.")
+class QueryPlanTests(ChildDataTestCase):
+    """
+    The queries of the endpoints of a child must find their rows through an
+    index and get them in the requested order, without scanning a table or
+    sorting in a temporary B-tree.
+    """
+
+    def plan(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return [ row[-1] for row in cursor.fetchall() ]
+
+    def test_indexes_used(self):
+        names = [ n for n in QueryBudgetTests.BUDGETS if n != 'children' ] + [ 'sleepphases_quickadd' ]
+        for name in names:
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse(name, kwargs={ 'child_id': self.child.id }),
+                                HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+
+            for q in queries.captured_queries:
+                if not q['sql'].startswith("SELECT"):
+                    continue
+                for step in self.plan(q['sql']):
+                    with self.subTest(endpoint=name, sql=q['sql']):
+                        self.assertNotIn("TEMP B-TREE", step)
+                        self.assertFalse(step.startswith("SCAN"), step)
+
+    def test_percentile_index(self):
+        sql = str(models.Percentile.objects.order_by("gender", "m_type", "day").query)
+        self.assertEqual(self.plan(sql), [ "SCAN slogger_percentile USING INDEX "
+                                           "slogger_percentile_gender_m_type_day_d63f874a_uniq" ])
+
+
+class QuickAddTests(ChildDataTestCase):
+    def test_quick_add_edits_latest_open_phase(self):
+        sp = models.SleepPhase.objects.create(child=self.child, created_by=self.user,
+                                              dt=tz.now() - timedelta(hours=30))
+        url = reverse('sleepphases_quickadd', kwargs={ 'child_id': self.child.id })
+        self.assertRedirects(self.client.get(url), reverse('sleepphases_edit', kwargs={
+            'child_id': self.child.id, 'pk': sp.id }), fetch_redirect_response=False)
+
+        sp.dt_end = tz.now()
+        sp.save()
+        self.assertRedirects(self.client.get(url), reverse('sleepphases_add', kwargs={
+            'child_id': self.child.id }), fetch_redirect_response=False)
+
+
+class CursorPaginationTests(ChildDataTestCase):
+    def paginate(self, **params):
+        request = RequestFactory().get("/", params)
+        request.user = self.user
+        data = models.Event.objects.filter(child=self.child).order_by("-dt", "-id")
+        return helpers.paginate_GET_cursor(request, data)
+
+    def test_walk_equal_dts(self):
+        # Pages have to split runs of rows with the same dt, and the cursor
+        # must not skip or repeat any of them.
+        dt = self.start + timedelta(days=1)
+        models.Event.objects.bulk_create([ models.Event(child=self.child, created_by=self.user, dt=dt,
+                                                        event=f"Same {i}") for i in range(7) ])
+        expected = list(models.Event.objects.filter(child=self.child).order_by("-dt", "-id")
+                                            .values_list("id", flat=True))
+
+        for limit in (1, 2, 3, len(expected), len(expected) + 1):
+            with self.subTest(limit=limit):
+                ids, cursor, pages = [], None, 0
+                while True:
+                    page = self.paginate(limit=limit, **({ 'cursor': cursor } if cursor else {}))
+                    ids += [ e.id for e in page ]
+                    pages += 1
+                    cursor = page.next
+                    if cursor is None:
+                        break
+
+                self.assertEqual(ids, expected)
+                self.assertEqual(pages, max(-(-len(expected) // limit), 1))
+
+    def test_page_size_limit(self):
+        self.assertEqual(len(self.paginate(limit=helpers.MAX_PAGE_SIZE)), 3)
+
+        for limit in (0, -1, helpers.MAX_PAGE_SIZE + 1, "x"):
+            with self.subTest(limit=limit):
+                with self.assertRaises(ValidationError):
+                    self.paginate(limit=limit)
+
+        with self.assertRaises(ValidationError):
+            self.paginate(cursor="not a cursor")
+
+
+class ChildDataETagTests(ChildDataTestCase):
+    ENDPOINTS = ('summary_data_graph', 'sleepphases')
+
+    def get_etag(self, name, etag=None, status=200):
+        headers = { 'HTTP_IF_NONE_MATCH': etag } if etag else {}
+        response = self.client.get(reverse(name, kwargs={ 'child_id': self.child.id }),
+                                    HTTP_X_REQUESTED_WITH="XMLHttpRequest", **headers)
+        self.assertEqual(response.status_code, status)
+        self.assertIn('Last-Modified', response)
+        return response['ETag']
+
+    def test_not_modified(self):
+        for name in self.ENDPOINTS:
+            with self.subTest(endpoint=name):
+                etag = self.get_etag(name)
+                self.assertEqual(self.get_etag(name, etag, status=304), etag)
+
+    def test_changed_after_write(self):
+        etags = { name: self.get_etag(name) for name in self.ENDPOINTS }
+        models.SleepPhase.objects.create(child=self.child, created_by=self.user,
+                                         dt=self.start + timedelta(days=5))
+        for name, etag in etags.items():
+            with self.subTest(endpoint=name):
+                self.assertNotEqual(self.get_etag(name, etag), etag)
+
+    def test_missing_version(self):
+        models.ChildDataVersion.objects.filter(child=self.child).delete()
+        etag = self.get_etag('summary_data_graph')
+        self.assertEqual(self.get_etag('summary_data_graph', etag, status=304), etag)
+
+        models.SleepPhase.objects.create(child=self.child, created_by=self.user,
+                                         dt=self.start + timedelta(days=5))
+        self.assertNotEqual(self.get_etag('summary_data_graph', etag), etag)
+
+
+class SummarySyncTests(ChildDataTestCase):
+    def test_changed_days_match_full_summary(self):
+        token = self.get('summary_data_list').json()['token']
+
+        models.SleepPhase.objects.create(child=self.child, created_by=self.user,
+                                         dt=self.start + timedelta(days=1, hours=5),
+                                         dt_end=self.start + timedelta(days=1, hours=6))
+        models.Event.objects.create(child=self.child, created_by=self.user,
+                                    dt=self.start + timedelta(days=4), event="Event")
+        models.Diaper.objects.filter(child=self.child).order_by("dt").last().delete()
+
+        full = self.get('summary_data_list').json()
+        # The changed days, the sleep totals and the number of days on top.
+        with self.assertNumQueries(QueryBudgetTests.BUDGETS['summary_data_list'] + 3):
+            changed = self.get('summary_data_list', { 'since': token }).json()
+
+        days = { d['day'] for d in changed['data'] }
+        self.assertEqual(days, { "2020-01-02", "2020-01-03", "2020-01-04", "2020-01-05" })
+        self.assertEqual(changed['data'], [ d for d in full['data'] if d['day'] in days ])
+        self.assertEqual(changed['removed'], [])
+        self.assertEqual(changed['avg'], full['avg'])
+        self.assertEqual(changed['diaperstats'], full['diaperstats'])
+
+    def test_token_read_after_write(self):
+        # A TestCase never commits, so nothing done after the commit of the
+        # write has happened when the token is read.
+        token = self.get('summary_data_list').json()['token']
+        models.Event.objects.create(child=self.child, created_by=self.user,
+                                    dt=self.start + timedelta(days=1), event="Event")
+        next_token = self.get('summary_data_list').json()['token']
+
+        changed = self.get('summary_data_list', { 'since': token }).json()
+        self.assertEqual([ d['day'] for d in changed['data'] ], [ "2020-01-02" ])
+        self.assertEqual(self.get('summary_data_list', { 'since': next_token }).json()['data'], [])
+
+
+class SummaryBackendTests(ChildDataTestCase):
+    """
+    The Python and SQL summary backends must return the same totals, also
+    for the records the local days are hard to split for.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+
+        kwargs = { 'child': cls.child, 'created_by': cls.user }
+        phases = [
+            # DST starts, the night has 23 hours.
+            (at(2021, 3, 27, 21, 30), at(2021, 3, 28, 6, 45)),
+            (at(2021, 3, 28, 1, 15), at(2021, 3, 28, 3, 30)),
+            # DST ends, the night has 25 hours and 2:00-3:00 comes twice.
+            (at(2021, 10, 30, 20), at(2021, 10, 31, 2, 30, is_dst=True)),
+            (at(2021, 10, 31, 2, 10, is_dst=False), at(2021, 10, 31, 7, 5)),
+            # Over several days.
+            (at(2021, 4, 2, 18), at(2021, 4, 5, 9, 20)),
+            (at(2021, 10, 29, 12), at(2021, 11, 1, 3)),
+            # Ending at midnight.
+            (at(2021, 4, 6, 13), at(2021, 4, 7)),
+            (at(2021, 4, 7, 0), at(2021, 4, 7, 1, 11, 11)),
+            # Open.
+            (at(2021, 11, 2, 20, 30), None),
+        ]
+        for dt, dt_end in phases:
+            models.SleepPhase.objects.create(dt=dt, dt_end=dt_end, **kwargs)
+            models.Meal.objects.create(dt=dt, dt_end=dt_end and dt + (dt_end - dt)/4, **kwargs)
+            models.Diaper.objects.create(dt=dt_end or dt, **kwargs)
+
+    def calculate(self, backend, h_day, h_night):
+        with override_settings(SLOGGER_SUMMARY_BACKEND=backend):
+            return helpers.calculate_summary_totals(RequestFactory().get("/"), self.child.id, h_day, h_night)
+
+    def test_same_totals(self):
+        for hours in ((8, 19), (6, 22), (2, 21), (0, 12), (3, 2)):
+            with self.subTest(hours=hours):
+                self.assertEqual(self.calculate('python', *hours), self.calculate('sql', *hours))
+
+    def test_same_payloads(self):
+        # Other hours than the creator's, so the summaries are calculated.
+        s = models.UserSettings.objects.get(user=self.other)
+        s.start_hour_day = 2
+        s.start_hour_night = 21
+        s.save()
+        self.client.force_login(self.other)
+
+        for name in ('summary_data_list', 'summary_data_graph'):
+            with self.subTest(endpoint=name):
+                with override_settings(SLOGGER_SUMMARY_BACKEND='python'):
+                    python = self.get(name).content
+                with override_settings(SLOGGER_SUMMARY_BACKEND='sql'):
+                    sql = self.get(name).content
+                self.assertEqual(python, sql)
+
+
+class ChildStateTests(ChildDataTestCase):
+    def assertStateUpToDate(self):
+        expected = models.compute_child_state(self.child.id)
+        self.assertEqual(models.ChildState.objects.filter(child=self.child).values(*expected).get(), expected)
+
+    def test_counters_and_measurement(self):
+        self.assertStateUpToDate()
+
+        self.add_days(3, 2)
+        self.assertStateUpToDate()
+
+        models.Meal.objects.filter(child=self.child).first().delete()
+        models.SleepPhase.objects.filter(child=self.child).last().delete()
+        latest = models.Measurement.objects.filter(child=self.child).order_by("dt").last()
+        latest.delete()
+        self.assertStateUpToDate()
+
+        first = models.Measurement.objects.filter(child=self.child).order_by("dt").first()
+        first.dt = self.start + timedelta(days=30)
+        first.save()
+        self.assertStateUpToDate()
+        self.assertEqual(models.ChildState.objects.get(child=self.child).measurement_id, first.id)
+
+    def test_child_page_independent_of_user_count(self):
+        url = reverse('child', kwargs={ 'child_id': self.child.id })
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+
+        for n in range(20):
+            get_user_model().objects.create(username=f"user {n}")
+
+        with self.assertNumQueries(len(before)):
+            response = self.client.get(url)
+        self.assertEqual(response.context["parents"], [ self.user, self.other ])
+
+
+class RollupTests(ChildDataTestCase):
+    """
+    The daily summaries kept up to date by the signal handlers must match
+    the ones computed from the raw data.
+    """
+
+    def assertNoDrift(self):
+        self.assertEqual(rebuild_rollups.verify_child(self.child.id), {})
+
+    def test_phase_moved_across_day_boundary(self):
+        sp = models.SleepPhase.objects.filter(child=self.child).order_by("dt").first()
+        sp.dt = self.start + timedelta(days=1, hours=14)
+        sp.dt_end = self.start + timedelta(days=2, hours=-6)
+        sp.save()
+        self.assertNoDrift()
+
+    def test_record_deleted(self):
+        # The interval of the following meal is measured from the one before.
+        models.Meal.objects.filter(child=self.child).order_by("dt")[2].delete()
+        models.Diaper.objects.filter(child=self.child).order_by("dt").last().delete()
+        self.assertNoDrift()
+
+    def test_hours_changed(self):
+        s = models.UserSettings.objects.get(user=self.user)
+        s.start_hour_day = 6
+        s.start_hour_night = 21
+        s.save()
+        self.assertNoDrift()
+
+
+class SummaryReportTests(ChildDataTestCase):
+    def test_parallel_matches_serial(self):
+        second = models.Child.objects.create(created_by=self.user, name="Second",
+                                             birthday=date(2021, 1, 1), gender="M")
+        models.SleepPhase.objects.create(child=second, created_by=self.user, dt=at(2021, 3, 27, 22),
+                                         dt_end=at(2021, 3, 28, 6))
+        models.Event.objects.create(child=second, created_by=self.user, dt=at(2021, 3, 28, 9), event="Event")
+        third = models.Child.objects.create(created_by=self.user, name="Empty",
+                                            birthday=date(2021, 1, 1), gender="F")
+        ids = [ self.child.id, second.id, third.id ]
+
+        with tempfile.TemporaryDirectory() as path:
+            output = os.path.join(path, "report.jsonl")
+            call_command("summary_report", *ids, output=output, workers=2, chunk_size=1,
+                         stdout=io.StringIO(), stderr=io.StringIO())
+            with open(output) as f:
+                parallel = [ json.loads(line) for line in f ]
+
+        serial = [ json.loads(json.dumps(summary_report.child_report(id))) for id in ids ]
+        self.assertEqual(sorted(parallel, key=lambda r: r['child']), serial)
+
+
+class ChildDeletionTests(ChildDataTestCase):
+    def test_delete_independent_of_row_count(self):
+        # The handlers of the records have nothing to update, the queries
+        # are the collector's, one or two per table.
+        self.add_days(3, 10)
+        with self.assertNumQueries(26):
+            models.Child.objects.filter(id=self.child.id).delete()
+        self.assertFalse(models.SleepPhase.objects.filter(child=self.child.id).exists())
+        self.assertFalse(models.child_deleted(self.child.id))
+
+
+class ChildAccessTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username="parent")
+        cls.stranger = get_user_model().objects.create(username="stranger")
+        cls.child = models.Child.objects.create(created_by=cls.user, name="Child",
+                                                birthday=date(2020, 1, 1), gender="F")
+        cls.child.parents.add(cls.user)
+
+    def setUp(self):
+        models.forget_child_access(sender=None)
+
+    def get(self, name, child_id, user):
+        self.client.force_login(user)
+        return self.client.get(reverse(name, kwargs={ 'child_id': child_id }),
+                               HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+
+    def test_denied(self):
+        for name in ('child', 'child_edit', 'sleepphases', 'meals', 'check_data'):
+            with self.subTest(endpoint=name):
+                self.assertEqual(self.get(name, self.child.id, self.stranger).status_code, 403)
+                self.assertEqual(self.get(name, self.child.id + 1, self.user).status_code, 404)
+
+    def test_one_query_then_remembered(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(models.has_child_access(self.user, self.child.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(models.has_child_access(self.user, self.child.id))
+
+    def test_forgotten_when_parents_change(self):
+        self.assertEqual(self.get('check_data', self.child.id, self.user).status_code, 200)
+        self.child.parents.set([ self.stranger ])
+        self.assertEqual(self.get('check_data', self.child.id, self.user).status_code, 200)  # still the creator
+        self.child.created_by = self.stranger
+        self.child.save()
+        self.assertEqual(self.get('check_data', self.child.id, self.user).status_code, 403)
+
+
+class UserSettingsCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username="parent")
+
+    def setUp(self):
+        models.invalidate_user_settings()
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(models.user_settings(self.user.id).paginate_by, 20)
+        with self.assertNumQueries(0):
+            s = models.user_settings(self.user.id)
+        self.assertIsNot(s, models.user_settings(self.user.id))
+
+    def test_once_per_request(self):
+        user = get_user_model().objects.get(id=self.user.id)
+        with self.assertNumQueries(1):
+            self.assertIs(helpers.get_user_settings(user), user.usersettings)
+            self.assertIs(helpers.get_user_settings(user).user, user)
+
+    def test_invalidated_on_save(self):
+        s = models.user_settings(self.user.id)
+        s.paginate_by = 50
+        s.save()
+        self.assertEqual(models.user_settings(self.user.id).paginate_by, 50)
+
+    def test_least_recently_used_dropped(self):
+        users = [ get_user_model().objects.create(username=f"user {n}") for n in range(3) ]
+        with mock.patch.object(models, "USER_SETTINGS_CACHE_SIZE", 2):
+            for u in users:
+                models.user_settings(u.id)
+            with self.assertNumQueries(0):
+                models.user_settings(users[1].id)
+                models.user_settings(users[2].id)
+            with self.assertNumQueries(1):
+                models.user_settings(users[0].id)
+
+    @override_settings(SLOGGER_SETTINGS_CACHE='default')
+    def test_shared_cache(self):
+        caches['default'].clear()
+        models.user_settings(self.user.id)
+        # Like another process, which only shares the cache.
+        models.invalidate_user_settings()
+        with self.assertNumQueries(0):
+            self.assertEqual(models.user_settings(self.user.id).paginate_by, 20)
+
+
+class DayBoundariesTests(SimpleTestCase):
+    """
+    Splitting at local midnight, in the CET time zone of the settings.
+    """
+
+    def split(self, dt, dt_end):
+        return [ (date.fromordinal(o), secs/3600) for o, secs in functions.DayBoundaries().split(dt, dt_end) ]
+
+    def test_split_over_dst_start(self):
+        self.assertEqual(self.split(at(2021, 3, 27, 22), at(2021, 3, 29, 2)), [
+            (date(2021, 3, 27), 2), (date(2021, 3, 28), 23), (date(2021, 3, 29), 2) ])
+
+    def test_split_over_dst_end(self):
+        self.assertEqual(self.split(at(2021, 10, 30, 22), at(2021, 11, 1, 2)), [
+            (date(2021, 10, 30), 2), (date(2021, 10, 31), 25), (date(2021, 11, 1), 2) ])
+
+    def test_split_at_midnight(self):
+        self.assertEqual(self.split(at(2021, 4, 6, 13), at(2021, 4, 7)), [ (date(2021, 4, 6), 11) ])
+        self.assertEqual(self.split(at(2021, 4, 7), at(2021, 4, 7, 1)), [ (date(2021, 4, 7), 1) ])
+
+    def test_day_starts_with_first_repeated_hour(self):
+        days = functions.DayBoundaries(2, 21)
+        i = days.index(at(2021, 10, 31, 12))
+        self.assertFalse(days.is_day(i, at(2021, 10, 31, 1, 59)))
+        self.assertTrue(days.is_day(i, at(2021, 10, 31, 2, 30, is_dst=True)))
+        self.assertTrue(days.is_day(i, at(2021, 10, 31, 2, 30, is_dst=False)))
+
+        days = functions.DayBoundaries(2, 21)
+        i = days.index(at(2021, 3, 28, 12))
+        self.assertFalse(days.is_day(i, at(2021, 3, 28, 1, 59)))
+        self.assertTrue(days.is_day(i, at(2021, 3, 28, 3)))
+
+    def test_aggregate_daily(self):
+        totals = functions.aggregate_daily([
+            (at(2021, 3, 27, 22), at(2021, 3, 29, 2)),
+            (at(2021, 3, 29, 8), None),
+        ]).totals("sleep")
+
+        self.assertEqual([ day for day, t in totals ], [ "2021-03-27", "2021-03-28", "2021-03-29" ])
+        sums = [ t["sleep"]["sum"] for day, t in totals ]
+        self.assertEqual([ s["time"]/3600 for s in sums ], [ 2, 23, 2 ])
+        self.assertEqual([ s["count"] for s in sums ], [ 1, 0, 1 ])
+        self.assertEqual([ s["interval"]/3600 for s in sums ], [ 0, 0, 6 ])
+
+        # The parts after midnight belong to the night the phase started in.
+        self.assertEqual([ t["sleep"]["night"]["time"]/3600 for day, t in totals ], [ 2, 23, 2 ])
+        self.assertEqual(totals[2][1]["sleep"]["day"], { 'count': 1, 'time': 0, 'interval': 21600.0 })
+
+    def test_aggregate_daily_25_hour_day(self):
+        totals = functions.aggregate_daily([
+            (at(2021, 10, 30, 23), at(2021, 10, 31, 23, 30)),
+        ]).totals("sleep")
+
+        self.assertEqual([ (day, t["sleep"]["sum"]["time"]/3600) for day, t in totals ], [
+            ("2021-10-30", 1), ("2021-10-31", 24.5) ])
+
+    def test_hours_or_boundaries(self):
+        data = [ (at(2021, 4, 6, 7), None), (at(2021, 4, 6, 20), None) ]
+        day_counts = lambda totals: [ t["sleep"]["day"]["count"] for day, t in totals ]
+
+        self.assertEqual(day_counts(functions.calculate_totals(data, "sleep")), [ 0 ])
+        self.assertEqual(day_counts(functions.calculate_totals(data, "sleep", 6, 21)), [ 2 ])
+        self.assertEqual(day_counts(functions.calculate_totals(data, "sleep", h_night=21)), [ 1 ])
+
+        days = functions.DayBoundaries(6, 21)
+        self.assertEqual(day_counts(functions.calculate_totals(data, "sleep", boundaries=days)), [ 2 ])
+
+        for hours in ((6, 21), (8, None), (None, 19)):
+            with self.subTest(hours=hours):
+                with self.assertRaises(ValueError):
+                    functions.aggregate_daily(data, *hours, boundaries=days)
+
+
+class RollingStatsTests(SimpleTestCase):
+    """
+    Compared with computing every window on its own.
+    """
+
+    # Calendar days 3 to 5 and 9 have no data, the series has None gaps.
+    DAYS = [ date(2021, 1, d).isoformat() for d in (1, 2, 6, 7, 8, 10, 11, 12, 13, 14) ]
+    VALUES = [ 5, None, 3, 8, None, None, 1, 7, 2, 6 ]
+
+    def naive(self, values, window):
+        stats = { 'mean': [], 'min': [], 'max': [] }
+        for k, day in enumerate(self.DAYS):
+            first = date.fromisoformat(day) - timedelta(days=window - 1)
+            v = [ values[j] for j in range(k + 1)
+                  if date.fromisoformat(self.DAYS[j]) >= first and values[j] is not None ]
+            stats['mean'].append(sum(v) / len(v) if v else None)
+            stats['min'].append(min(v) if v else None)
+            stats['max'].append(max(v) if v else None)
+        return stats
+
+    def test_window_starts(self):
+        self.assertEqual(functions.window_starts(self.DAYS, 1), list(range(len(self.DAYS))))
+        self.assertEqual(functions.window_starts(self.DAYS, 3), [ 0, 0, 2, 2, 2, 4, 5, 5, 6, 7 ])
+        self.assertEqual(functions.window_starts(self.DAYS, 100), [ 0 ] * len(self.DAYS))
+
+    def test_rolling(self):
+        stats = functions.RollingStats(self.VALUES)
+        for window in (1, 2, 3, 5, 7, 14, 100):
+            with self.subTest(window=window):
+                self.assertEqual(stats.rolling(functions.window_starts(self.DAYS, window)),
+                                 self.naive(self.VALUES, window))
+
+    def test_ranges(self):
+        stats = functions.RollingStats(self.VALUES)
+        for lo in range(len(self.VALUES) + 1):
+            for hi in range(lo, len(self.VALUES) + 1):
+                v = [ x for x in self.VALUES[lo:hi] if x is not None ]
+                with self.subTest(lo=lo, hi=hi):
+                    self.assertEqual(stats.mean(lo, hi), sum(v) / len(v) if v else None)
+                    self.assertEqual(stats.min(lo, hi), min(v) if v else None)
+                    self.assertEqual(stats.max(lo, hi), max(v) if v else None)
+
+        empty = functions.RollingStats([ None, None ])
+        self.assertEqual((empty.mean(), empty.min(), empty.max()), (None, None, None))
+
+
+class PercentileCurvesTests(SimpleTestCase):
+    # Stored for days 3 and 13 only, column k holds 10+k and 20+k.
+    ROWS = [ (3, *(10.0 + k for k in range(15))), (13, *(20.0 + k for k in range(15))) ]
+
+    def setUp(self):
+        self.curves = functions.PercentileCurves(self.ROWS)
+
+    def test_interpolation(self):
+        self.assertEqual(len(self.curves), 14)
+        self.assertEqual(self.curves.value("p50", 3), 17)
+        self.assertEqual(self.curves.value("p50", 8), 22)
+        self.assertEqual(self.curves.value("p50", 8.5), 22.5)
+        # Before the first stored day, the curves start with it.
+        self.assertEqual(self.curves.value("p50", 0), 17)
+
+        self.assertEqual(self.curves.zscore(8, 22), 0)
+        self.assertAlmostEqual(self.curves.rank(8, 22), 50)
+        z = functions.PercentileCurves.Z
+        self.assertAlmostEqual(self.curves.zscore(8, 22.5), z[8] / 2)
+        self.assertAlmostEqual(self.curves.zscore(8.5, 23), z[8] / 2)
+
+    def test_outside_stored_range(self):
+        self.assertIsNone(self.curves.value("p50", 13.5))
+        self.assertIsNone(self.curves.value("p50", -1))
+        self.assertIsNone(self.curves.zscore(14, 22))
+        self.assertIsNone(self.curves.rank(-1, 22))
+        self.assertIsNone(self.curves.zscore(8, None))
+
+        # Values beyond the outer percentiles are extrapolated.
+        z = functions.PercentileCurves.Z
+        self.assertAlmostEqual(self.curves.zscore(8, 14), z[0] - (z[1] - z[0]))
+        self.assertAlmostEqual(self.curves.zscore(8, 30), z[14] + (z[14] - z[13]))
+        self.assertLess(self.curves.rank(8, 14), 0.1)
+        self.assertGreater(self.curves.rank(8, 30), 99.9)
+
+    def test_missing_curve(self):
+        curves = functions.PercentileCurves([])
+        self.assertEqual(len(curves), 0)
+        self.assertIsNone(curves.value("p50", 0))
+        self.assertIsNone(curves.zscore(0, 10))
+        self.assertIsNone(curves.rank(0, 10))
+
+
+class LoadPercentilesTests(TestCase):
+    def data(self, offset):
+        rows = [ "\t".join(str(v) for v in (day, 0, 0, 0, *(offset + day + k for k in range(15))))
+                 for day in range(3) ]
+        return "\r\n".join([ "Day\tL\tM\tS" ] + rows + [ "" ])
+
+    def setUp(self):
+        # Rolling the test back doesn't invalidate the loaded curves.
+        models.invalidate_percentiles()
+        self.addCleanup(models.invalidate_percentiles)
+
+    def test_curve_replaced(self):
+        load_percentiles.import_percentiles("wfa", "girls", tz.now(), self.data(10))
+        self.assertEqual(models.percentile_curves("F", "W").value("p50", 2), 19)
+        digest = models.percentile_digest()
+
+        load_percentiles.import_percentiles("wfa", "girls", tz.now(), self.data(20))
+        self.assertEqual(models.Percentile.objects.filter(gender="F", m_type="W").count(), 3)
+        self.assertEqual(models.percentile_curves("F", "W").value("p50", 2), 29)
+        self.assertNotEqual(models.percentile_digest(), digest)
+
+        self.assertEqual(len(models.percentile_curves("M", "W")), 0)
+
+
+class DownsampleTests(SimpleTestCase):
+    def test_real_rows_kept(self):
+        xs = list(range(1000))
+        real = [ x % 3 == 0 for x in xs ]
+        keep = functions.downsample(xs, real, points=100)
+
+        self.assertTrue(set(x for x in xs if real[x]) <= set(keep))
+        self.assertEqual(keep, sorted(set(keep)))
+        self.assertIn(999, keep)
+
+    def test_other_rows_sampled(self):
+        xs = list(range(1000))
+        real = [ x == 500 for x in xs ]
+
+        keep = functions.downsample(xs, real, points=11)
+        self.assertLessEqual(len(keep), 13)
+        self.assertEqual(keep[:2], [ 0, 100 ])
+        self.assertIn(500, keep)
+
+        keep = functions.downsample(xs, real, resolution=250)
+        self.assertEqual(keep, [ 0, 250, 500, 750, 999 ])
+
+        self.assertEqual(functions.downsample(xs, real), xs)
+
+
+def decode_column(column):
+    values = column['values']
+    if 'counts' in column:
+        values = [ v for v, n in zip(values, column['counts']) for _ in range(n) ]
+    if column['type'] == "date":
+        base = date.fromisoformat(column['base'])
+        values = [ v if v is None else (base + timedelta(days=v)).isoformat() for v in values ]
+    return values
+
+
+class CompactTests(SimpleTestCase):
+    def test_run_lengths(self):
+        values = [ 1, 1, 1, 1, 2, 2, 2, 3 ]
+        column = functions.compact_column(values)
+        self.assertEqual(column, { 'type': "int", 'values': [ 1, 2, 3 ], 'counts': [ 4, 3, 1 ] })
+        self.assertEqual(decode_column(column), values)
+
+        values = [ 1, 2, 2, 3, 4 ]
+        column = functions.compact_column(values)
+        self.assertNotIn('counts', column)
+        self.assertEqual(decode_column(column), values)
+
+        values = [ True, True, False, False ]
+        self.assertEqual(decode_column(functions.compact_column(values)), values)
+
+    def test_none_values(self):
+        values = [ None, None, 3, 3, None, None, None, 5 ]
+        self.assertEqual(decode_column(functions.compact_column(values)), values)
+
+        column = functions.compact_column([ None ] * 4)
+        self.assertEqual(column['type'], "null")
+        self.assertEqual(decode_column(column), [ None ] * 4)
+
+        values = [ None, "2021-03-27", "2021-03-27", None, "2021-04-02" ]
+        column = functions.compact_column(values)
+        self.assertEqual(column['base'], "2021-03-27")
+        self.assertEqual(decode_column(column), values)
+
+        days = [ date(2021, 3, 27), None, date(2021, 3, 28), date(2021, 3, 29) ]
+        decoded = [ d if d is None else d.isoformat() for d in days ]
+        self.assertEqual(decode_column(functions.compact_column(days)), decoded)
+
+    def test_precision(self):
+        values = [ 1.23456, 1.23449, 1.2, None, None, 2 ]
+
+        for precision in (0, 1, 3):
+            column = functions.compact_column(values, precision)
+            self.assertEqual(column['type'], "float")
+            self.assertEqual(decode_column(column), [ v if v is None else round(v, precision) for v in values ])
+
+        column = functions.compact_column(values, 1)
+        self.assertEqual(column['values'], [ 1.2, None, 2 ])
+        self.assertEqual(column['counts'], [ 3, 2, 1 ])
+
+    def test_empty(self):
+        column = functions.compact_column([])
+        self.assertEqual(column, { 'type': "null", 'values': [] })
+        self.assertEqual(decode_column(column), [])
+
+        self.assertEqual(functions.compact({ 'x': [], 'y': {} }), { 'x': column, 'y': {} })
+
+    def test_nested(self):
+        data = {
+            'labels': [ "a", "a", "b" ],
+            'datasets': [ { 'data': [ 0.5, 0.5, 0.5, 0.5 ], 'label': "x" } ],
+            'mixed': [ 1, "a" ],
+        }
+        compacted = functions.compact(data, 2)
+
+        self.assertEqual(decode_column(compacted['labels']), data['labels'])
+        self.assertEqual(decode_column(compacted['datasets'][0]['data']), data['datasets'][0]['data'])
+        self.assertEqual(compacted['datasets'][0]['label'], "x")
+        self.assertEqual(compacted['mixed'], data['mixed'])
+
+
+class HistogramTests(SimpleTestCase):
+    def test_reversed_intervals_skipped(self):
+        data = [ (at(2021, 4, 6, 13), at(2021, 4, 6, 14)), (at(2021, 4, 7, 13), at(2021, 4, 6, 22)) ]
+
+        self.assertEqual(functions.get_hist_data(data, 60, 60), functions.get_hist_data(data[:1], 60, 60))
+        self.assertEqual(functions.day_slot_ranges(data, 60), functions.day_slot_ranges(data[:1], 60))
+
+    def per_minute_hist(self, data, raster):
+        """
+        The histogram as it used to be counted: stepping through every
+        raster point of every interval.
+        """
+        key = lambda dt: tz.localtime(dt).strftime("%H:%M")
+        step = timedelta(minutes=raster)
+        hist = { f"{(k*raster)//60:02d}:{(k*raster)%60:02d}": 0 for k in range(24*60 // raster) }
+
+        for dt, dt_end in data:
+            s = dt.replace(second=0, microsecond=0)
+            s -= timedelta(minutes=s.minute % raster)
+
+            if dt_end is None:
+                hist[key(s)] += 1
+                continue
+
+            e = dt_end.replace(second=0, microsecond=0)
+            e += timedelta(minutes=-e.minute % raster)
+
+            while s <= e:
+                if dt <= s <= dt_end:
+                    hist[key(s)] += 1
+                s += step
+
+        return sorted(hist.items())
+
+    def random_intervals(self):
+        rnd = random.Random(2)
+        start = at(2021, 1, 4)
+        data = [
+            (at(2021, 1, 5, 10), at(2021, 1, 5, 10)),
+            (at(2021, 1, 5, 23, 30), at(2021, 1, 6, 0, 0)),
+            (at(2021, 1, 6, 0, 0, 30), None),
+        ]
+
+        for i in range(200):
+            dt = start + timedelta(seconds=rnd.randrange(40*24*3600))
+            length = rnd.choice((None, 0, 60, 20*60, 3*3600, 13*3600, 50*3600))
+            data.append((dt, None if length is None else dt + timedelta(seconds=rnd.randrange(length + 1))))
+
+        return data
+
+    def test_matches_per_minute_hist(self):
+        data = self.random_intervals()
+
+        for raster in (1, 2, 3, 5, 10, 15, 20, 30, 60):
+            with self.subTest(raster=raster):
+                self.assertEqual(functions.get_hist_data(data, raster, raster), self.per_minute_hist(data, raster))
+
+    def test_resolution(self):
+        data = self.random_intervals()
+        counts = [ c for t, c in functions.get_hist_data(data, 10, 10) ]
+
+        coarse = functions.get_hist_data(data, 10, 60)
+        self.assertEqual([ t for t, c in coarse ], [ f"{h:02d}:00" for h in range(24) ])
+        self.assertEqual([ c for t, c in coarse ], [ sum(counts[h*6:h*6 + 6]) for h in range(24) ])
+
+        fine = functions.get_hist_data(data, 10, 5)
+        self.assertEqual(len(fine), 24*12)
+        self.assertEqual(fine[3], ("00:15", counts[1]))
+        self.assertEqual([ c for t, c in fine ], [ c for c in counts for _ in range(2) ])
+
+        self.assertEqual(functions.get_hist_data(data, 10, 24*60), [ ("00:00", sum(counts)) ])
+
+        # Buckets not a multiple of the raster get the slots starting in them.
+        uneven = [ 0 ] * -(-24*60 // 25)
+        for k, c in enumerate(counts):
+            uneven[(k*10) // 25] += c
+        self.assertEqual([ c for t, c in functions.get_hist_data(data, 10, 25) ], uneven)
+
+        with self.assertRaises(ValueError):
+            functions.get_hist_data(data, 10, 0)
+
+
+def local_instants(wall):
+    """
+    Returns the instants a local wall clock time occurs at: none in a skipped
+    hour, two in a repeated one.
+    """
+    zone = tz.get_current_timezone()
+    try:
+        return [ zone.localize(wall, is_dst=None) ]
+    except pytz.AmbiguousTimeError:
+        return [ zone.localize(wall, is_dst=True), zone.localize(wall, is_dst=False) ]
+    except pytz.NonExistentTimeError:
+        return []
+
+
+def naive_heatmap(data, raster, first, last):
+    """
+    Counts every raster point of every local day by checking it against all
+    intervals.
+    """
+    slots = -(-24*60 // raster)
+    matrix = [ [ 0 ] * slots for o in range(first, last + 1) ]
+
+    for o in range(first, last + 1):
+        for s in range(slots):
+            wall = datetime.combine(date.fromordinal(o), datetime.min.time()) + timedelta(minutes=s*raster)
+            for dt, dt_end in data:
+                if dt_end is None:
+                    start = tz.localtime(dt)
+                    if start.toordinal() == o and (start.hour*60 + start.minute) // raster == s:
+                        matrix[o - first][s] += 1
+                else:
+                    matrix[o - first][s] += sum(dt <= p <= dt_end for p in local_instants(wall))
+
+    return matrix
+
+
+class HeatmapTests(ChildDataTestCase):
+    def assertMatchesNaive(self, data, rasters=(1, 7, 10, 60)):
+        first = min(tz.localdate(dt) for dt, dt_end in data).toordinal()
+        last = max(tz.localdate(dt_end or dt) for dt, dt_end in data).toordinal()
+
+        for raster in rasters:
+            with self.subTest(raster=raster):
+                ranges = functions.day_slot_ranges(data, raster)
+                self.assertEqual(functions.get_heatmap_data(ranges, raster, first, last),
+                                 naive_heatmap(data, raster, first, last))
+
+    def test_matrix(self):
+        self.assertMatchesNaive([
+            (at(2021, 4, 6, 13, 5), at(2021, 4, 6, 14, 55)),
+            (at(2021, 4, 6, 13), at(2021, 4, 6, 13)),
+            (at(2021, 4, 6, 22, 3), at(2021, 4, 8, 0)),
+            (at(2021, 4, 7, 23, 59), None),
+            (at(2021, 4, 8, 0, 0, 30), None),
+            (at(2021, 4, 8, 23, 50), at(2021, 4, 9, 0, 10)),
+        ])
+
+    def test_dst_days(self):
+        # 2021-03-28 02:00 to 02:59 is skipped, 2021-10-31 02:00 to 02:59
+        # happens twice: a phase over the whole hour covers its slots twice.
+        data = [
+            (at(2021, 3, 27, 22), at(2021, 3, 28, 4, 20)),
+            (at(2021, 3, 28, 1, 40), at(2021, 3, 28, 3, 10)),
+            (at(2021, 3, 28, 12), None),
+            (at(2021, 10, 30, 23), at(2021, 10, 31, 4)),
+            (at(2021, 10, 31, 2, 30, is_dst=True), at(2021, 10, 31, 2, 15, is_dst=False)),
+            (at(2021, 10, 31, 2, 40, is_dst=False), None),
+        ]
+        self.assertMatchesNaive(data, rasters=(10, 60))
+
+        spring = date(2021, 3, 28).toordinal()
+        fall = date(2021, 10, 31).toordinal()
+        matrix = functions.get_heatmap_data(functions.day_slot_ranges(data, 60), 60, spring, fall)
+        self.assertEqual(matrix[0][1:5], [ 1, 0, 2, 1 ])
+        self.assertEqual(matrix[-1][1:5], [ 1, 4, 1, 1 ])
+
+    def test_weekdays(self):
+        self.add_days(3, 12)
+
+        by_day = self.get('heatmap_data', { 'rows': "day", 'format': "json" }).json()
+        by_weekday = self.get('heatmap_data', { 'rows': "weekday", 'format': "json" }).json()
+        days = [ date.fromisoformat(d) for d in by_day['day'] ]
+
+        self.assertEqual(by_weekday['weekday'], list(range(7)))
+        self.assertEqual(by_weekday['days'], [ sum(d.weekday() == k for d in days) for k in range(7) ])
+
+        for key in ('sleep', 'meals', 'diapers'):
+            expected = [ [ 0 ] * len(by_day['time']) for k in range(7) ]
+            for d, row in zip(days, by_day[key]):
+                expected[d.weekday()] = [ a + b for a, b in zip(expected[d.weekday()], row) ]
+            self.assertEqual(by_weekday[key], expected, key)
+
+
+class LocalBackendTests(SimpleTestCase):
+    def test_delivery(self):
+        backend = events.LocalBackend()
+
+        async def run():
+            first, second, other = backend.subscribe(1), backend.subscribe(1), backend.subscribe(2)
+
+            # Published by the thread of a write, only the latest one is kept.
+            writer = threading.Thread(target=lambda: [ backend.publish(1, m) for m in (b"old", b"new") ])
+            writer.start()
+            writer.join()
+
+            self.assertEqual(await asyncio.wait_for(first.get(), 5), b"new")
+            self.assertEqual(await asyncio.wait_for(second.get(), 5), b"new")
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(other.get(), 0.05)
+
+            backend.unsubscribe(first)
+            self.assertTrue(backend.has_subscribers(1))
+            backend.unsubscribe(second)
+            self.assertFalse(backend.has_subscribers(1))
+
+            other.close()
+            self.assertIsNone(await asyncio.wait_for(other.get(), 5))
+
+        asyncio.run(run())
+
+
+class StateStreamTests(ChildDataTestCase):
+    """
+    The ASGI application is called directly, its sync parts run in the
+    thread of the test and its transaction.
+    """
+
+    def setUp(self):
+        super().setUp()
+        for patcher in (mock.patch.object(events, "_backend", events.LocalBackend()),
+                        # It would take the test's transaction for a leftover.
+                        mock.patch.object(stream, "close_old_connections")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.app = stream.with_child_state_stream(None)
+
+    def open(self, child_id, talk=None, method="GET"):
+        """
+        Opens the stream of the child, lets talk(next_body) await the bodies
+        sent, if it is answered with 200, and disconnects. Returns the status.
+        """
+        cookie = f"{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}"
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': f"/{child_id}/data/stream/",
+            'query_string': b'',
+            'headers': [(b'cookie', cookie.encode())],
+        }
+
+        async def run():
+            sent = asyncio.Queue()
+            disconnect = asyncio.Event()
+            requested = False
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def next_body():
+                return (await asyncio.wait_for(sent.get(), 5))['body']
+
+            task = asyncio.ensure_future(self.app(scope, receive, sent.put))
+            start = await asyncio.wait_for(sent.get(), 5)
+            if start['status'] == 200 and talk:
+                self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+                await talk(next_body)
+            disconnect.set()
+            await asyncio.wait_for(task, 5)
+            return start['status']
+
+        return async_to_sync(run)()
+
+    def state(self):
+        return b"data: %s\n\n" % events.encode_state(helpers.fetch_child_state(self.child.id))
+
+    def test_denied(self):
+        stranger = get_user_model().objects.create(username="stranger")
+        foreign = models.Child.objects.create(created_by=stranger, name="Foreign",
+                                              birthday=date(2020, 1, 1), gender="M")
+
+        self.assertEqual(self.open(foreign.id), 403)
+        self.assertEqual(self.open(foreign.id + 1), 404)
+        self.assertEqual(self.open(self.child.id, method="POST"), 405)
+        self.assertFalse(events.get_backend().subscribers)
+
+    def test_initial_state_and_changes(self):
+        def write():
+            models.SleepPhase.objects.create(child=self.child, created_by=self.user, dt=tz.now())
+            # What the commit of the write would do.
+            events.publish_child_state(self.child.id)
+            return self.state()
+
+        async def talk(next_body):
+            self.assertEqual(await next_body(), await sync_to_async(self.state)())
+            self.assertTrue(events.get_backend().has_subscribers(self.child.id))
+
+            changed = await sync_to_async(write)()
+            self.assertEqual(await next_body(), changed)
+
+        self.assertEqual(self.open(self.child.id, talk), 200)
+        self.assertFalse(events.get_backend().has_subscribers(self.child.id))
+
+    def test_change_while_connecting(self):
+        current_state = stream.current_state
+
+        def publish_first(child_id):
+            events.get_backend().publish(child_id, b"{}")
+            return current_state(child_id)
+
+        async def talk(next_body):
+            self.assertEqual(await next_body(), await sync_to_async(self.state)())
+            self.assertEqual(await next_body(), b"data: {}\n\n")
+
+        with mock.patch.object(stream, "current_state", publish_first):
+            self.open(self.child.id, talk)
+
+    def test_keepalive(self):
+        async def talk(next_body):
+            await next_body()
+            self.assertEqual(await next_body(), b": keepalive\n\n")
+
+        with mock.patch.object(stream, "KEEPALIVE_SECONDS", 0.01):
+            self.open(self.child.id, talk)
+
+
+class BrokerBackendTests(SimpleTestCase):
+    def test_publish_does_not_wait_for_broker(self):
+        connecting = threading.Event()
+        reachable = threading.Event()
+        done = threading.Event()
+        sent = []
+
+        def create_connection(address, timeout):
+            connecting.set()
+            reachable.wait()
+            return mock.Mock(sendall=send)
+
+        def send(line):
+            sent.append(line)
+            if line.startswith(b"2 "):
+                done.set()
+
+        backend = events.BrokerBackend("127.0.0.1:8765")
+        with mock.patch("socket.create_connection", create_connection):
+            backend.publish(1, b"first")
+            self.assertTrue(connecting.wait(5))
+            # While the first one waits for the broker, only the latest
+            # state of a child is kept.
+            backend.publish(2, b"old")
+            backend.publish(2, b"new")
+            reachable.set()
+            self.assertTrue(done.wait(5))
+
+        self.assertEqual(sent, [ b"publish\n", b"1 first\n", b"2 new\n" ])
+
+    def test_bad_lines_skipped(self):
+        async def handle(reader, writer):
+            await reader.readline()
+            writer.write(b"garbage\n1x {}\n7 good\n")
+            await writer.drain()
+            writer.close()
+
+        async def receive():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            backend = events.BrokerBackend("127.0.0.1:%d" % server.sockets[0].getsockname()[1])
+            subscription = backend.subscribe(7)
+            try:
+                return await asyncio.wait_for(subscription.get(), 5)
+            finally:
+                for listener in backend.listeners.values():
+                    listener.cancel()
+                server.close()
+                await server.wait_closed()
+
+        with self.assertLogs("slogger.events", "WARNING") as logs:
+            self.assertEqual(asyncio.run(receive()), b"good")
+        self.assertEqual(len(logs.records), 2)
@@ -58,6 +58,8 @@ urlpatterns = [
     path('<int:child_id>/data/summary/graph/',      json.get_summary_data_graph,            name="summary_data_graph"),
     path('<int:child_id>/data/summary/list/',       json.get_summary_data_list,             name="summary_data_list"),
     path('<int:child_id>/data/histogram/',          json.get_histogram_data,                name="histogram_data"),
+    path('<int:child_id>/data/heatmap/',            json.get_heatmap_data,                  name="heatmap_data"),
+    path('<int:child_id>/data/dashboard/',          json.get_dashboard_data,                name="dashboard_data"),
     path('<int:child_id>/data/measurements/',       json.get_growth_data,                   name="measurement_data"),
     path('<int:child_id>/data/percentiles/<str:m_type>/', json.get_percentile_data,         name="percentile_data"),
 
@@ -2,7 +2,7 @@ from django.views.generic import (
     TemplateView, ListView, CreateView, FormView, UpdateView, DeleteView, DetailView
 )
 
-from django.contrib.auth import get_user_model, logout
+from django.contrib.auth import logout
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
@@ -31,7 +31,7 @@ class IndexView(mixins.AddChildContextViewMixin,
 
     def get_template_names(self):
         if settings.USE_VUE_FRONTEND \
-            and ( (self.request.user.is_authenticated and self.request.user.usersettings.use_new_ui) \
+            and ( (self.request.user.is_authenticated and helpers.get_user_settings(self.request.user).use_new_ui) \
                  or not self.request.user.is_authenticated):
             if settings.DEBUG:
                 return ['app.html']
@@ -43,12 +43,12 @@ class IndexView(mixins.AddChildContextViewMixin,
     def render_to_response(self, context, **response_kwargs):
         if not settings.USE_VUE_FRONTEND \
            or (self.request.user.is_authenticated \
-               and not self.request.user.usersettings.use_new_ui):
+               and not helpers.get_user_settings(self.request.user).use_new_ui):
             children = models.Child.objects.filter(parents__id=self.request.user.id)
             if self.request.user.is_authenticated:
-                s = self.request.user.usersettings
-                if s.default_child:
-                    return redirect('child', child_id=s.default_child.id)
+                s = helpers.get_user_settings(self.request.user)
+                if s.default_child_id:
+                    return redirect('child', child_id=s.default_child_id)
 
             if children:
                 return redirect('child', child_id=children.reverse()[0].id)
@@ -65,8 +65,8 @@ class IndexView(mixins.AddChildContextViewMixin,
             my_children = []
 
         default_child = None
-        if request.user.is_authenticated and request.user.usersettings.default_child:
-            c = request.user.usersettings.default_child
+        if request.user.is_authenticated and helpers.get_user_settings(request.user).default_child_id:
+            c = helpers.get_user_settings(request.user).default_child
             default_child = { "id": c.id, "name": c.name }
 
         return JsonResponse(
@@ -88,7 +88,8 @@ class IndexView(mixins.AddChildContextViewMixin,
 @login_required
 @decorators.only_own_children
 def quick_add_sleepphase(request, child_id=None):
-    sp = models.SleepPhase.objects.filter(child=child_id).last()
+    # The latest phase, like the check and current_phase endpoints.
+    sp = models.SleepPhase.objects.filter(child=child_id).order_by("-dt", "-id").first()
 
     if not sp or (sp.dt and sp.dt_end):
         return redirect('sleepphases_add', child_id=child_id)
@@ -107,12 +108,13 @@ class SummaryPlotView(LoginRequiredMixin,
 
 class SleepPhaseListView(LoginRequiredMixin,
                          mixins.AddChildContextViewMixin,
+                         mixins.ChildDataETagMixin,
                          mixins.AjaxableResponseMixin,
                          ListView):
     model = models.SleepPhase
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
@@ -120,17 +122,17 @@ class SleepPhaseListView(LoginRequiredMixin,
 
     def get_json(self, request, *args, **kwargs):
         self.paginate_by = None
-        data = models.SleepPhase.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt")
+        data = models.SleepPhase.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt", "-id")
         data = helpers.filter_GET_daterage(request, data)
+        data = helpers.paginate_GET_cursor(request, data)
 
-        return JsonResponse(
+        return helpers.list_response(data,
             [{
                 'id': d.id,
                 'dt': d.dt,
                 'dt_end': d.dt_end if d.dt_end else None,
                 'comment': d.comment,
-            } for d in data.all() ],
-        safe=False)
+            } for d in data ])
 
 class SleepPhaseCreateView(LoginRequiredMixin,
                            SuccessMessageMixin,
@@ -220,20 +222,22 @@ class ChildView(LoginRequiredMixin,
     model = models.Child
     pk_url_kwarg = "child_id"
 
+    def get_object(self, queryset=None):
+        return decorators.get_child(self.request, self.kwargs['child_id'])
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["parents"] = [ p for p in get_user_model().objects.all() if p in self.object.parents.all() ]
+        context["parents"] = list(self.object.parents.order_by("id"))
         return context
 
     def get_json(self, request, *args, **kwargs):
         c = self.get_object()
-        diapers = models.Diaper.objects.filter(child= c.id).count()
-        meals = models.Meal.objects.filter(child= c.id).count()
-        sleep = models.SleepPhase.objects.filter(child= c.id).count()
+        state = helpers.fetch_child_state(c.id, "measurement")
+        diapers = state.diaper_count
+        meals = state.meal_count
+        sleep = state.sleep_count
 
-        m = models.Measurement.objects.filter(child=c.id)
-        if m:
-            m = m.latest('dt')
+        m = state.measurement
 
         return JsonResponse(
         {
@@ -292,6 +296,9 @@ class ChildUpdateView(LoginRequiredMixin,
     success_message = "Child details updated."
     form_class = forms.ChildForm
 
+    def get_object(self, queryset=None):
+        return decorators.get_child(self.request, self.kwargs['child_id'])
+
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
 
@@ -319,10 +326,11 @@ class ChildListView(LoginRequiredMixin,
                     mixins.AjaxableResponseMixin,
                     ListView):
     def get_queryset(self):
-        return models.Child.objects.filter(parents__id=self.request.user.id)
+        return models.Child.objects.filter(parents__id=self.request.user.id).prefetch_related("parents")
 
     def get_json(self, request, *args, **kwargs):
-        data = models.Child.objects.filter(parents__id=self.request.user.id).order_by("-dt")
+        data = models.Child.objects.filter(parents__id=self.request.user.id).order_by("-dt") \
+                                   .prefetch_related("parents")
 
         return JsonResponse(
             [{
@@ -342,12 +350,18 @@ class SummaryListView(LoginRequiredMixin,
     template_name = "slogger/summary.html"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
-        data = models.SleepPhase.objects.filter(child=self.kwargs.get('child_id'))
-        self.totals = functions.calculate_duration_totals(data)[::-1]
+        summaries = models.DailySummary.objects.filter(child=self.kwargs.get('child_id'), series="sleep")
+
+        if summaries.exclude(h_day=8, h_night=19).exists():
+            data = models.SleepPhase.objects.filter(child=self.kwargs.get('child_id')).order_by("dt")
+            self.totals = functions.calculate_duration_totals(models.interval_rows(data))[::-1]
+        else:
+            self.totals = [ (str(s.day), s.as_duration_totals()) for s in summaries.order_by("-day") ]
+
         return self.totals
 
     def get_context_data(self, **kwargs):
@@ -366,13 +380,14 @@ class SummaryListView(LoginRequiredMixin,
 
 class MeasurementListView(LoginRequiredMixin,
                           mixins.AddChildContextViewMixin,
+                          mixins.ChildDataETagMixin,
                           mixins.AjaxableResponseMixin,
                           ListView):
     model = models.Measurement
     pk_url_kwarg = "child_id"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
@@ -380,18 +395,18 @@ class MeasurementListView(LoginRequiredMixin,
 
     def get_json(self, request, *args, **kwargs):
         self.paginate_by = None
-        data = models.Measurement.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt")
+        data = models.Measurement.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt", "-id")
         data = helpers.filter_GET_daterage(request, data)
+        data = helpers.paginate_GET_cursor(request, data)
 
-        return JsonResponse(
+        return helpers.list_response(data,
             [{
                 'id': d.id,
                 'time': d.dt,
                 'height': d.height,
                 'weight': d.weight,
                 'comment': d.comment,
-            } for d in data.all() ],
-        safe=False)
+            } for d in data ])
 
 class MeasurementCreateView(LoginRequiredMixin,
                             mixins.AddChildContextViewMixin,
@@ -465,7 +480,7 @@ class FoodListView(LoginRequiredMixin,
     pk_url_kwarg = "child_id"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
@@ -527,32 +542,35 @@ class FoodUpdateView(LoginRequiredMixin,
 
 class MealListView(LoginRequiredMixin,
                    mixins.AddChildContextViewMixin,
+                   mixins.ChildDataETagMixin,
                    mixins.AjaxableResponseMixin,
                    ListView):
     model = models.Meal
     pk_url_kwarg = "child_id"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
-        return models.Meal.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt")
+        return models.Meal.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt") \
+                                  .prefetch_related("food")
 
     def get_json(self, request, *args, **kwargs):
         self.paginate_by = None
-        data = models.Meal.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt")
+        data = models.Meal.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt", "-id") \
+                                  .prefetch_related("food")
         data = helpers.filter_GET_daterage(request, data)
+        data = helpers.paginate_GET_cursor(request, data)
 
-        return JsonResponse(
+        return helpers.list_response(data,
             [{
                 'id': d.id,
                 'dt': d.dt,
                 'dt_end': d.dt_end,
                 'food': [ f.name for f in d.food.all() ],
                 'comment': d.comment,
-            } for d in data.all() ],
-        safe=False)
+            } for d in data ])
 
 class MealCreateView(LoginRequiredMixin,
                      mixins.AddChildContextViewMixin,
@@ -569,14 +587,14 @@ class MealCreateView(LoginRequiredMixin,
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         ctx["headline"] = "Add meal"
-        ctx["form"] = forms.MealForm(child = models.Child.objects.get(id=self.kwargs.get('child_id')))
+        ctx["form"] = forms.MealForm(child = ctx["child"])
         return ctx
 
     def get_success_url(self):
         return reverse_lazy('meals', kwargs = {'child_id': self.kwargs['child_id']})
 
     def get_json(self, request, *args, **kwargs):
-        child = models.Child.objects.get(id=self.kwargs['child_id'])
+        child = decorators.get_child(request, self.kwargs['child_id'])
         foods = models.Food.objects.filter( Q(created_by__in=child.parents.all()) | Q(is_default=True))
         return JsonResponse({
             'food_choices': [ { 'id': f.id, 'name': f.name } for f in foods.all() ],
@@ -600,7 +618,7 @@ class MealUpdateView(LoginRequiredMixin,
         return reverse_lazy('meals', kwargs = {'child_id': self.kwargs['child_id']})
 
     def get_json(self, request, *args, **kwargs):
-        child = models.Child.objects.get(id=self.kwargs['child_id'])
+        child = decorators.get_child(request, self.kwargs['child_id'])
         foods = models.Food.objects.filter( Q(created_by__in=child.parents.all()) | Q(is_default=True))
 
         o = self.get_object()
@@ -639,7 +657,7 @@ class DiaperContentListView(LoginRequiredMixin,
     pk_url_kwarg = "child_id"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
@@ -707,7 +725,7 @@ class DiaperTypeListView(LoginRequiredMixin,
     pk_url_kwarg = "child_id"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
@@ -769,32 +787,35 @@ class DiaperTypeUpdateView(LoginRequiredMixin,
 
 class DiaperListView(LoginRequiredMixin,
                      mixins.AddChildContextViewMixin,
+                     mixins.ChildDataETagMixin,
                      mixins.AjaxableResponseMixin,
                      ListView):
     model = models.Diaper
     pk_url_kwarg = "child_id"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
-        return models.Diaper.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt")
+        return models.Diaper.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt") \
+                                    .select_related("diaper_type").prefetch_related("content")
 
     def get_json(self, request, *args, **kwargs):
         self.paginate_by = None
-        data = models.Diaper.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt")
+        data = models.Diaper.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt", "-id") \
+                                    .select_related("diaper_type").prefetch_related("content")
         data = helpers.filter_GET_daterage(request, data)
+        data = helpers.paginate_GET_cursor(request, data)
 
-        return JsonResponse(
+        return helpers.list_response(data,
             [{
                 'id': d.id,
                 'time': d.dt,
                 'comment': d.comment,
                 'contents': [ c.name for c in d.content.all() ],
                 'diaper_type': d.diaper_type.name if d.diaper_type else None,
-            } for d in data.all() ],
-        safe=False)
+            } for d in data ])
 
 class DiaperCreateView(LoginRequiredMixin,
                        mixins.AddChildContextViewMixin,
@@ -811,14 +832,14 @@ class DiaperCreateView(LoginRequiredMixin,
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         ctx["headline"] = "Add a changed diaper"
-        ctx["form"] = forms.DiaperForm(child = models.Child.objects.get(id=self.kwargs.get('child_id')))
+        ctx["form"] = forms.DiaperForm(child = ctx["child"])
         return ctx
 
     def get_success_url(self):
         return reverse_lazy('diapers', kwargs = {'child_id': self.kwargs['child_id']})
 
     def get_json(self, request, *args, **kwargs):
-        child = models.Child.objects.get(id=self.kwargs['child_id'])
+        child = decorators.get_child(request, self.kwargs['child_id'])
         dc = models.DiaperContent.objects.filter( Q(created_by__in=child.parents.all()) | Q(is_default=True))
         dt = models.DiaperType.objects.filter( Q(created_by__in=child.parents.all()) | Q(is_default=True))
         return JsonResponse({
@@ -844,7 +865,7 @@ class DiaperUpdateView(LoginRequiredMixin,
         return reverse_lazy('diapers', kwargs = {'child_id': self.kwargs['child_id']})
 
     def get_json(self, request, *args, **kwargs):
-        child = models.Child.objects.get(id=self.kwargs['child_id'])
+        child = decorators.get_child(request, self.kwargs['child_id'])
         dc = models.DiaperContent.objects.filter( Q(created_by__in=child.parents.all()) | Q(is_default=True))
         dt = models.DiaperType.objects.filter( Q(created_by__in=child.parents.all()) | Q(is_default=True))
 
@@ -879,13 +900,14 @@ class DiaperDeleteView(LoginRequiredMixin,
 
 class EventListView(LoginRequiredMixin,
                     mixins.AddChildContextViewMixin,
+                    mixins.ChildDataETagMixin,
                     mixins.AjaxableResponseMixin,
                     ListView):
     model = models.Event
     pk_url_kwarg = "child_id"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
@@ -893,17 +915,17 @@ class EventListView(LoginRequiredMixin,
 
     def get_json(self, request, *args, **kwargs):
         self.paginate_by = None
-        data = models.Event.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt")
+        data = models.Event.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt", "-id")
         data = helpers.filter_GET_daterage(request, data)
+        data = helpers.paginate_GET_cursor(request, data)
 
-        return JsonResponse(
+        return helpers.list_response(data,
             [{
                 'id': d.id,
                 'time': d.dt,
                 'event': d.event,
                 'description': d.description,
-            } for d in data.all() ],
-        safe=False)
+            } for d in data ])
 
 class EventCreateView(LoginRequiredMixin,
                       mixins.AddChildContextViewMixin,
@@ -971,13 +993,14 @@ class EventDeleteView(LoginRequiredMixin,
 
 class DiaryEntryListView(LoginRequiredMixin,
                          mixins.AddChildContextViewMixin,
+                         mixins.ChildDataETagMixin,
                          mixins.AjaxableResponseMixin,
                          ListView):
     model = models.DiaryEntry
     pk_url_kwarg = "child_id"
 
     def setup(self, request, *args, **kwargs):
-        self.paginate_by = request.user.usersettings.paginate_by
+        self.paginate_by = helpers.get_user_settings(request.user).paginate_by
         return super().setup(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
@@ -985,17 +1008,17 @@ class DiaryEntryListView(LoginRequiredMixin,
 
     def get_json(self, request, *args, **kwargs):
         self.paginate_by = None
-        data = models.DiaryEntry.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt")
+        data = models.DiaryEntry.objects.filter(child=self.kwargs.get('child_id')).order_by("-dt", "-id")
         data = helpers.filter_GET_daterage(request, data)
+        data = helpers.paginate_GET_cursor(request, data)
 
-        return JsonResponse(
+        return helpers.list_response(data,
             [{
                 'id': d.id,
                 'time': d.dt,
                 'title': d.title,
                 'content': d.content,
-            } for d in data.all() ],
-        safe=False)
+            } for d in data ])
 
 class DiaryEntryCreateView(LoginRequiredMixin,
                            mixins.AddChildContextViewMixin,